@@ -1,16 +1,18 @@
+import collections
+import json
 import logging
 import os
+import threading
+import time
 
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
-import SimpleITK as sitk
-import sitkUtils
 import numpy as np
-from skimage.restoration import unwrap_phase
 
-from math import sqrt, pow
+# Pipeline names are resolved on first use (see SimpleNeedleTrackingLib/__init__.py): the module loads quickly at startup
+import SimpleNeedleTrackingLib
 
 
 class SimpleNeedleTracking(ScriptedLoadableModule):
@@ -103,6 +105,20 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     inputModeHBoxLayout.addWidget(self.inputModeMagPhase)
     inputModeHBoxLayout.addWidget(self.inputModeRealImag)
     imagesFormLayout.addRow('Input Mode:',inputModeHBoxLayout)
+
+    # Phase difference mode
+    self.differenceModeUnwrapped = qt.QRadioButton('Unwrapped')
+    self.differenceModeComplex = qt.QRadioButton('Complex')
+    self.differenceModeUnwrapped.checked = 1
+    self.differenceModeUnwrapped.setToolTip('Unwrap each frame and subtract the unwrapped baseline')
+    self.differenceModeComplex.setToolTip('Take the difference as frame * conj(baseline) in a padded window around the ROI (implies ROI unwrap) and unwrap it only if it wraps inside the window')
+    self.differenceModeButtonGroup = qt.QButtonGroup()
+    self.differenceModeButtonGroup.addButton(self.differenceModeUnwrapped)
+    self.differenceModeButtonGroup.addButton(self.differenceModeComplex)
+    differenceModeHBoxLayout = qt.QHBoxLayout()
+    differenceModeHBoxLayout.addWidget(self.differenceModeUnwrapped)
+    differenceModeHBoxLayout.addWidget(self.differenceModeComplex)
+    imagesFormLayout.addRow('Difference Mode:',differenceModeHBoxLayout)
     
     ### Baseline images
     imagesFormLayout.addRow(SeparatorWidget('Baseline images'))
@@ -216,6 +232,15 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.tipPredictionSelector.setToolTip('Select the tip prediction node')
     trackingFormLayout.addRow('Tip prediction:', self.tipPredictionSelector)
 
+    # Tip predictions of other needles (tracked in the same frames)
+    self.otherNeedlesSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.otherNeedlesSelector.nodeTypes = ['vtkMRMLLinearTransformNode']
+    self.otherNeedlesSelector.showHidden = False
+    self.otherNeedlesSelector.showChildNodeTypes = False
+    self.otherNeedlesSelector.setMRMLScene(slicer.mrmlScene)
+    self.otherNeedlesSelector.setToolTip('Check the tip prediction nodes of other needles to track in the same frames (e.g. a reference needle). The phase difference is computed once per frame and each needle gets its own tracked tip node (CurrentTrackedTipTransform2, 3...). Not used with multi-plane tracking')
+    trackingFormLayout.addRow('Other needles:', self.otherNeedlesSelector)
+
     # Start/Stop tracking 
     trackingHBoxLayout = qt.QHBoxLayout()    
     self.startTrackingButton = qt.QPushButton('Start Tracking')
@@ -227,10 +252,181 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.stopTrackingButton.enabled = False    
     trackingHBoxLayout.addWidget(self.stopTrackingButton)
     trackingFormLayout.addRow('', trackingHBoxLayout)
+
+    # Processed/dropped frame counters
+    self.frameCountersLabel = qt.QLabel('-')
+    self.frameCountersLabel.setToolTip('Frames processed and dropped (background execution skips stale frames)')
+    trackingFormLayout.addRow('Frames:', self.frameCountersLabel)
+
+    # Rolling success rate and last outcome
+    self.outcomeLabel = qt.QLabel('-')
+    self.outcomeLabel.setToolTip('Success rate over the recent tracking attempts and outcome of the last one (counts per reason in the Performance section)')
+    trackingFormLayout.addRow('Outcome:', self.outcomeLabel)
+
+    # Baseline drift (rolling baseline) and full rebuild
+    baselineDriftHBoxLayout = qt.QHBoxLayout()
+    self.baselineDriftLabel = qt.QLabel('-')
+    self.baselineDriftLabel.setToolTip('Spread of the base phase change since the baseline was saved or rebuilt (rolling baseline). Rebuild the baseline when it grows large')
+    baselineDriftHBoxLayout.addWidget(self.baselineDriftLabel)
+    self.rebuildBaselineButton = qt.QPushButton('Rebuild Baseline')
+    self.rebuildBaselineButton.toolTip = 'Unwrap the current rolling base phase again and reset the drift'
+    self.rebuildBaselineButton.enabled = False
+    baselineDriftHBoxLayout.addWidget(self.rebuildBaselineButton)
+    trackingFormLayout.addRow('Baseline drift:', baselineDriftHBoxLayout)
     
     ## Advanced parameters            
     ####################################
 
+    ## Multi-plane tracking
+    ####################################
+
+    multiPlaneCollapsibleButton = ctk.ctkCollapsibleButton()
+    multiPlaneCollapsibleButton.text = 'Multi-plane tracking'
+    multiPlaneCollapsibleButton.collapsed=1
+    self.layout.addWidget(multiPlaneCollapsibleButton)
+    multiPlaneFormLayout = qt.QFormLayout(multiPlaneCollapsibleButton)
+
+    # Enable multi-plane tracking
+    self.multiPlaneCheckBox = qt.QCheckBox()
+    self.multiPlaneCheckBox.checked = False
+    self.multiPlaneCheckBox.setToolTip('If checked, track the images above (plane 1) and the planes below at the same time, each with its own baseline, and fuse the plane tips into one 3D tip')
+    multiPlaneFormLayout.addRow('Enable:', self.multiPlaneCheckBox)
+
+    # Baseline and real-time images of the additional planes (e.g. interleaved axial/sagittal/coronal acquisitions)
+    self.planeSelectors = collections.OrderedDict()
+    for planeName in ('Plane 2', 'Plane 3'):
+      multiPlaneFormLayout.addRow(SeparatorWidget(planeName))
+      selectors = collections.OrderedDict()
+      for (key, label, toolTip) in (('FirstBaseline', 'Baseline Magnitude/Real: ', 'Select the baseline magnitude/real image'),
+                                    ('SecondBaseline', 'Baseline Phase/Imaginary: ', 'Select the baseline phase/imaginary image'),
+                                    ('First', 'Magnitude/Real: ', 'Select the real-time magnitude/real image'),
+                                    ('Second', 'Phase/Imaginary: ', 'Select the real-time phase/imaginary image')):
+        selector = slicer.qMRMLNodeComboBox()
+        selector.nodeTypes = ['vtkMRMLScalarVolumeNode']
+        selector.selectNodeUponCreation = True
+        selector.addEnabled = False
+        selector.removeEnabled = False
+        selector.noneEnabled = True
+        selector.showHidden = False
+        selector.showChildNodeTypes = False
+        selector.setMRMLScene(slicer.mrmlScene)
+        selector.setToolTip(toolTip)
+        multiPlaneFormLayout.addRow(label, selector)
+        selectors[key] = selector
+      self.planeSelectors[planeName] = selectors
+
+    ## Performance
+    ####################################
+
+    performanceCollapsibleButton = ctk.ctkCollapsibleButton()
+    performanceCollapsibleButton.text = 'Performance'
+    performanceCollapsibleButton.collapsed=1
+    self.layout.addWidget(performanceCollapsibleButton)
+    performanceFormLayout = qt.QFormLayout(performanceCollapsibleButton)
+
+    # Latency statistics table (rolling window)
+    self.latencyTableView = slicer.qMRMLTableView()
+    self.latencyTableView.setMRMLScene(slicer.mrmlScene)
+    self.latencyTableView.setMinimumHeight(200)
+    self.latencyTableView.setToolTip('Rolling latency statistics of each tracking stage (ms)')
+    performanceFormLayout.addRow(self.latencyTableView)
+
+    # Tracking outcome counters (attempts per reason since the reset)
+    self.outcomeTableView = slicer.qMRMLTableView()
+    self.outcomeTableView.setMRMLScene(slicer.mrmlScene)
+    self.outcomeTableView.setMinimumHeight(120)
+    self.outcomeTableView.setToolTip('Tracking attempts per outcome reason since the reset. The table node (NeedleTrackingOutcomes) also has the rolling success rate, attempt rate and last outcome as attributes')
+    performanceFormLayout.addRow(self.outcomeTableView)
+
+    # Reset/Export statistics
+    latencyHBoxLayout = qt.QHBoxLayout()
+    self.resetLatencyButton = qt.QPushButton('Reset')
+    self.resetLatencyButton.toolTip = 'Clear latency statistics and outcome counters of the session'
+    latencyHBoxLayout.addWidget(self.resetLatencyButton)
+    self.exportLatencyButton = qt.QPushButton('Export CSV')
+    self.exportLatencyButton.toolTip = 'Save the stage durations of the recent cycles (up to 72000, about an hour at 20 frames/s) to a CSV file'
+    latencyHBoxLayout.addWidget(self.exportLatencyButton)
+    performanceFormLayout.addRow('', latencyHBoxLayout)
+
+    # Export tracking history (last attempts: prediction, tip, error, blob size, reason, stage durations)
+    historyHBoxLayout = qt.QHBoxLayout()
+    self.exportHistoryButton = qt.QPushButton('Export History')
+    self.exportHistoryButton.toolTip = 'Save the recent tracking attempts to a CSV or HDF5 file (HDF5 requires h5py)'
+    historyHBoxLayout.addWidget(self.exportHistoryButton)
+    self.historySequenceButton = qt.QPushButton('History to Sequence')
+    self.historySequenceButton.toolTip = 'Copy the tips of the recent successful tracking attempts into a transform sequence (TrackedTipSequence)'
+    historyHBoxLayout.addWidget(self.historySequenceButton)
+    performanceFormLayout.addRow('History:', historyHBoxLayout)
+
+    ## Synthetic frames
+    ####################################
+
+    syntheticCollapsibleButton = ctk.ctkCollapsibleButton()
+    syntheticCollapsibleButton.text = 'Synthetic frames'
+    syntheticCollapsibleButton.collapsed=1
+    self.layout.addWidget(syntheticCollapsibleButton)
+    syntheticFormLayout = qt.QFormLayout(syntheticCollapsibleButton)
+
+    # Needle tip path
+    self.syntheticPathSelector = slicer.qMRMLNodeComboBox()
+    self.syntheticPathSelector.nodeTypes = ['vtkMRMLMarkupsNode']
+    self.syntheticPathSelector.selectNodeUponCreation = True
+    self.syntheticPathSelector.addEnabled = False
+    self.syntheticPathSelector.removeEnabled = False
+    self.syntheticPathSelector.noneEnabled = True
+    self.syntheticPathSelector.showHidden = False
+    self.syntheticPathSelector.showChildNodeTypes = True
+    self.syntheticPathSelector.setMRMLScene(slicer.mrmlScene)
+    self.syntheticPathSelector.setToolTip('Select the markups whose control points (in order) define the path of the synthetic needle tip')
+    syntheticFormLayout.addRow('Tip path:', self.syntheticPathSelector)
+
+    # Frame rate
+    self.syntheticRateSpinBox = qt.QDoubleSpinBox()
+    self.syntheticRateSpinBox.minimum = 0.5
+    self.syntheticRateSpinBox.maximum = 100
+    self.syntheticRateSpinBox.singleStep = 1
+    self.syntheticRateSpinBox.value = 5
+    self.syntheticRateSpinBox.suffix = ' fps'
+    self.syntheticRateSpinBox.setToolTip('Rate at which synthetic frames are written into the real-time images')
+    syntheticFormLayout.addRow('Frame rate:', self.syntheticRateSpinBox)
+
+    # Tip speed
+    self.syntheticSpeedSpinBox = qt.QDoubleSpinBox()
+    self.syntheticSpeedSpinBox.minimum = 0
+    self.syntheticSpeedSpinBox.maximum = 50
+    self.syntheticSpeedSpinBox.singleStep = 0.5
+    self.syntheticSpeedSpinBox.value = 5
+    self.syntheticSpeedSpinBox.suffix = ' mm/s'
+    self.syntheticSpeedSpinBox.setToolTip('Speed of the synthetic needle tip along the path (back and forth)')
+    syntheticFormLayout.addRow('Tip speed:', self.syntheticSpeedSpinBox)
+
+    # Phase noise
+    self.syntheticNoiseSpinBox = qt.QDoubleSpinBox()
+    self.syntheticNoiseSpinBox.minimum = 0
+    self.syntheticNoiseSpinBox.maximum = np.pi
+    self.syntheticNoiseSpinBox.singleStep = 0.01
+    self.syntheticNoiseSpinBox.value = 0.05
+    self.syntheticNoiseSpinBox.suffix = ' rad'
+    self.syntheticNoiseSpinBox.setToolTip('Standard deviation of the phase noise added to every frame')
+    syntheticFormLayout.addRow('Phase noise:', self.syntheticNoiseSpinBox)
+
+    # Start/Stop feeding frames
+    syntheticHBoxLayout = qt.QHBoxLayout()
+    self.startSyntheticButton = qt.QPushButton('Start Frames')
+    self.startSyntheticButton.toolTip = 'Write synthetic frames, built on the baseline images, into the real-time images at the frame rate'
+    self.startSyntheticButton.enabled = False
+    syntheticHBoxLayout.addWidget(self.startSyntheticButton)
+    self.stopSyntheticButton = qt.QPushButton('Stop Frames')
+    self.stopSyntheticButton.toolTip = 'Stop writing synthetic frames'
+    self.stopSyntheticButton.enabled = False
+    syntheticHBoxLayout.addWidget(self.stopSyntheticButton)
+    syntheticFormLayout.addRow('', syntheticHBoxLayout)
+
+    # Frames written and achieved rate
+    self.syntheticStatusLabel = qt.QLabel('-')
+    self.syntheticStatusLabel.setToolTip('Synthetic frames written and achieved frame rate (lower than requested when tracking cannot keep up)')
+    syntheticFormLayout.addRow('Written:', self.syntheticStatusLabel)
+
     advancedCollapsibleButton = ctk.ctkCollapsibleButton()
     advancedCollapsibleButton.text = 'Advanced'
     advancedCollapsibleButton.collapsed=1
@@ -242,6 +438,43 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.debugFlagCheckBox.checked = False
     self.debugFlagCheckBox.setToolTip('If checked, output images at intermediate steps')
     advancedFormLayout.addRow('Debug', self.debugFlagCheckBox)
+
+    # Debug sampling (capture every Nth frame)
+    self.debugSamplingSpinBox = qt.QSpinBox()
+    self.debugSamplingSpinBox.minimum = 1
+    self.debugSamplingSpinBox.maximum = 1000
+    self.debugSamplingSpinBox.value = 1
+    self.debugSamplingSpinBox.setToolTip('Output intermediate images only every Nth frame (images are saved in the background, one archive per frame)')
+    advancedFormLayout.addRow('Debug Every N Frames:', self.debugSamplingSpinBox)
+
+    # Execution mode
+    self.executionComboBox = qt.QComboBox()
+    self.executionComboBox.addItem('Synchronous', 'Synchronous')
+    self.executionComboBox.addItem('Background thread', 'Thread')
+    self.executionComboBox.addItem('Process pool', 'Process')
+    self.executionComboBox.setToolTip('Synchronous: track each frame in the main thread. Background thread: track the latest frame in a worker thread and drop stale frames. Process pool: track frames in worker processes (frames shared through shared memory)')
+    advancedFormLayout.addRow('Execution:', self.executionComboBox)
+
+    # Frame budget (degrade the tracking settings when the cycles are late)
+    self.frameBudgetSpinBox = qt.QDoubleSpinBox()
+    self.frameBudgetSpinBox.minimum = 0
+    self.frameBudgetSpinBox.maximum = 10000
+    self.frameBudgetSpinBox.decimals = 0
+    self.frameBudgetSpinBox.singleStep = 10
+    self.frameBudgetSpinBox.suffix = ' ms'
+    self.frameBudgetSpinBox.specialValueText = 'Off'
+    self.frameBudgetSpinBox.value = 0
+    self.frameBudgetSpinBox.setToolTip('Time budget of a tracking cycle (ms, usually the frame interval). When the cycles are late, the settings are degraded in order: no debug images, ROI unwrap, smaller ROI, then frame skipping; they are restored once the cycles are back within budget. Off: no degradation')
+    advancedFormLayout.addRow('Frame Budget:', self.frameBudgetSpinBox)
+
+    self.reacquireAfterSpinBox = qt.QSpinBox()
+    self.reacquireAfterSpinBox.minimum = 0
+    self.reacquireAfterSpinBox.maximum = 1000
+    self.reacquireAfterSpinBox.suffix = ' failures'
+    self.reacquireAfterSpinBox.specialValueText = 'Off'
+    self.reacquireAfterSpinBox.value = 0
+    self.reacquireAfterSpinBox.setToolTip('Search the tip over the whole field of view after this many consecutive failures (single needle): a downsampled phase difference gives tip candidates, which are then tracked at full resolution in a ROI. The re-acquired tip is followed until the tip prediction moves. Off: the ROI stays on the prediction')
+    advancedFormLayout.addRow('Re-acquire After:', self.reacquireAfterSpinBox)
     
     # ROI size
     self.roiSizeWidget = ctk.ctkSliderWidget()
@@ -271,6 +504,54 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.errorThresholdWidget.setToolTip('Set error threshold value (mm) for valid tip detection.')
     advancedFormLayout.addRow('Error Threshold:', self.errorThresholdWidget)
 
+    # ROI-first unwrapping check box
+    self.roiUnwrapCheckBox = qt.QCheckBox()
+    self.roiUnwrapCheckBox.checked = False
+    self.roiUnwrapCheckBox.setToolTip('If checked, unwrap only a padded window around the ROI (full frame when the window reaches the image border)')
+    advancedFormLayout.addRow('ROI-first Unwrap:', self.roiUnwrapCheckBox)
+
+    # Multi-slice tracking check box
+    self.allSlicesCheckBox = qt.QCheckBox()
+    self.allSlicesCheckBox.checked = False
+    self.allSlicesCheckBox.setToolTip('If checked, track every slice of the stack in parallel and combine the slice detections into one 3D tip (instead of the slice shown in the scene view)')
+    advancedFormLayout.addRow('Track All Slices:', self.allSlicesCheckBox)
+
+    # Motion prediction check box
+    self.motionPredictionCheckBox = qt.QCheckBox()
+    self.motionPredictionCheckBox.checked = False
+    self.motionPredictionCheckBox.setToolTip('If checked, predict the tip from the recent tracked tips (constant-velocity Kalman filter) to center the ROI, shrink it while the track is stable and check the error threshold. The tip prediction node is used until the track is established')
+    advancedFormLayout.addRow('Motion Prediction:', self.motionPredictionCheckBox)
+
+    # Phase unwrapping backend
+    self.unwrapBackendComboBox = qt.QComboBox()
+    self.unwrapBackendComboBox.addItem('Reliability sorting', 'Reliability')
+    self.unwrapBackendComboBox.addItem('Least squares (FFT)', 'LeastSquares')
+    self.unwrapBackendComboBox.setToolTip('Reliability sorting: scikit-image unwrapper. Least squares (FFT): unweighted least-squares unwrapper in NumPy. Frames without phase wraps are not unwrapped')
+    advancedFormLayout.addRow('Unwrap Backend:', self.unwrapBackendComboBox)
+
+    # Tip detector
+    self.tipDetectorComboBox = qt.QComboBox()
+    self.tipDetectorComboBox.addItem('Gradient blobs', 'Blobs')
+    self.tipDetectorComboBox.addItem('Template matching (FFT)', 'Template')
+    self.tipDetectorComboBox.setToolTip('Gradient blobs: threshold the phase gradient and take the largest round blob (Blob Threshold). Template matching (FFT): correlate the ROI with oriented needle tip templates and take the best match')
+    advancedFormLayout.addRow('Tip Detector:', self.tipDetectorComboBox)
+
+    # Rolling baseline check box
+    self.rollingBaselineCheckBox = qt.QCheckBox()
+    self.rollingBaselineCheckBox.checked = False
+    self.rollingBaselineCheckBox.setToolTip('If checked, blend every frame where the needle is found into the baseline (exponential average, away from the needle tips) to follow slow phase drift. Not available with multi-plane tracking or the process pool')
+    advancedFormLayout.addRow('Rolling Baseline:', self.rollingBaselineCheckBox)
+
+    # Rolling baseline rate
+    self.rollingBaselineRateSpinBox = qt.QDoubleSpinBox()
+    self.rollingBaselineRateSpinBox.minimum = 0.001
+    self.rollingBaselineRateSpinBox.maximum = 1
+    self.rollingBaselineRateSpinBox.decimals = 3
+    self.rollingBaselineRateSpinBox.singleStep = 0.01
+    self.rollingBaselineRateSpinBox.value = 0.05
+    self.rollingBaselineRateSpinBox.setToolTip('Weight of each new frame in the rolling baseline (higher follows drift faster)')
+    advancedFormLayout.addRow('Rolling Baseline Rate:', self.rollingBaselineRateSpinBox)
+
     self.layout.addStretch(1)
     
     ####################################
@@ -288,6 +569,8 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     # (in the selected parameter node).
     self.inputModeMagPhase.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.inputModeRealImag.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.differenceModeUnwrapped.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.differenceModeComplex.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.firstBaselineVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
     self.secondBaselineVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
     self.firstVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
@@ -296,20 +579,48 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.sceneViewButton_yellow.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.sceneViewButton_green.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.tipPredictionSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
+    self.otherNeedlesSelector.connect('checkedNodesChanged()', self.updateParameterNodeFromGUI)
     self.roiSizeWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.blobThresholdWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.errorThresholdWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.debugFlagCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.debugSamplingSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.executionComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    self.roiUnwrapCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.allSlicesCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.motionPredictionCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.multiPlaneCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    for selectors in self.planeSelectors.values():
+      for selector in selectors.values():
+        selector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
+    self.unwrapBackendComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    self.tipDetectorComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    self.rollingBaselineCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.rollingBaselineRateSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.frameBudgetSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.reacquireAfterSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.syntheticPathSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
+    self.syntheticRateSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.syntheticSpeedSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.syntheticNoiseSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     
     # Connect UI buttons to event calls
     self.saveBaselineButton.connect('clicked(bool)', self.saveBaseline)
     self.startTrackingButton.connect('clicked(bool)', self.startTracking)
     self.stopTrackingButton.connect('clicked(bool)', self.stopTracking)
+    self.rebuildBaselineButton.connect('clicked(bool)', self.rebuildBaseline)
+    self.resetLatencyButton.connect('clicked(bool)', self.resetLatency)
+    self.exportLatencyButton.connect('clicked(bool)', self.exportLatency)
+    self.exportHistoryButton.connect('clicked(bool)', self.exportHistory)
+    self.historySequenceButton.connect('clicked(bool)', self.exportHistoryToSequence)
+    self.startSyntheticButton.connect('clicked(bool)', self.startSyntheticFrames)
+    self.stopSyntheticButton.connect('clicked(bool)', self.stopSyntheticFrames)
     self.firstBaselineVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
     self.secondBaselineVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
     self.firstVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
     self.secondVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
     self.tipPredictionSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
+    self.syntheticPathSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
 
     # Internal variables
     self.isBaselineSaved = False
@@ -321,13 +632,37 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.secondVolume = None
     self.sliceIndex = None
     self.inputMode = None
+    self.differenceMode = None
     self.roiSize = None
     self.sliceIndex = None
     self.blobThreshold = None
     self.debugFlag = None
+    self.unwrapMode = None
+    self.unwrapBackend = None
+    self.tipDetector = None
+    self.execution = None
+    self.planeVolumes = []
+    self.tipPredictions = []
+
+    # Timer to publish results from background tracking
+    self.resultTimer = qt.QTimer()
+    self.resultTimer.setInterval(10)
+    self.resultTimer.connect('timeout()', self.publishResults)
+
+    # Timer to refresh latency statistics while tracking
+    self.latencyTimer = qt.QTimer()
+    self.latencyTimer.setInterval(1000)
+    self.latencyTimer.connect('timeout()', self.updateLatency)
+
+    # Timer to refresh the synthetic frame counters
+    self.syntheticStatusTimer = qt.QTimer()
+    self.syntheticStatusTimer.setInterval(1000)
+    self.syntheticStatusTimer.connect('timeout()', self.updateSyntheticStatus)
 
     # Initialize module logic
     self.logic = SimpleNeedleTrackingLogic()
+    self.latencyTableView.setMRMLTableNode(self.logic.getLatencyTableNode())
+    self.outcomeTableView.setMRMLTableNode(self.logic.getOutcomeTableNode())
   
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
@@ -338,6 +673,13 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
   # Called when the application closes and the module widget is destroyed.
   def cleanup(self):
     self.removeObservers()
+    self.resultTimer.stop()
+    self.latencyTimer.stop()
+    self.syntheticStatusTimer.stop()
+    if self.logic:
+      self.logic.stopSyntheticFrames()
+      self.logic.stopScheduler()
+      self.logic.debugWriter.stop()
 
   # Called each time the user opens this module.
   # Make sure parameter node exists and observed
@@ -398,14 +740,39 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.secondVolumeSelector.setCurrentNode(self._parameterNode.GetNodeReference('SecondVolume'))
     self.inputModeMagPhase.checked = (self._parameterNode.GetParameter('InputMode') == 'MagPhase')
     self.inputModeRealImag.checked = (self._parameterNode.GetParameter('InputMode') == 'RealImag')
+    self.differenceModeUnwrapped.checked = (self._parameterNode.GetParameter('DifferenceMode') == 'Unwrapped')
+    self.differenceModeComplex.checked = (self._parameterNode.GetParameter('DifferenceMode') == 'Complex')
     self.sceneViewButton_red.checked = (self._parameterNode.GetParameter('SceneView') == 'Red')
     self.sceneViewButton_yellow.checked = (self._parameterNode.GetParameter('SceneView') == 'Yellow')
     self.sceneViewButton_green.checked = (self._parameterNode.GetParameter('SceneView') == 'Green')
     self.tipPredictionSelector.setCurrentNode(self._parameterNode.GetNodeReference('TipPrediction'))
+    otherNeedleIDs = [self._parameterNode.GetNthNodeReferenceID('OtherNeedlePrediction', i) for i in range(self._parameterNode.GetNumberOfNodeReferences('OtherNeedlePrediction'))]
+    for i in range(self.otherNeedlesSelector.nodeCount()):
+      node = self.otherNeedlesSelector.nodeFromIndex(i)
+      self.otherNeedlesSelector.setCheckState(node, qt.Qt.Checked if node.GetID() in otherNeedleIDs else qt.Qt.Unchecked)
     self.roiSizeWidget.value = float(self._parameterNode.GetParameter('ROISize'))
     self.blobThresholdWidget.value = float(self._parameterNode.GetParameter('BlobThreshold'))
     self.errorThresholdWidget.value = float(self._parameterNode.GetParameter('ErrorThreshold'))
     self.debugFlagCheckBox.checked = (self._parameterNode.GetParameter('Debug') == 'True')
+    self.debugSamplingSpinBox.value = int(self._parameterNode.GetParameter('DebugSampling'))
+    self.executionComboBox.setCurrentIndex(self.executionComboBox.findData(self._parameterNode.GetParameter('Execution')))
+    self.roiUnwrapCheckBox.checked = (self._parameterNode.GetParameter('UnwrapMode') == 'ROI')
+    self.allSlicesCheckBox.checked = (self._parameterNode.GetParameter('AllSlices') == 'True')
+    self.motionPredictionCheckBox.checked = (self._parameterNode.GetParameter('MotionPrediction') == 'True')
+    self.multiPlaneCheckBox.checked = (self._parameterNode.GetParameter('MultiPlane') == 'True')
+    for (planeName, selectors) in self.planeSelectors.items():
+      for (key, selector) in selectors.items():
+        selector.setCurrentNode(self._parameterNode.GetNodeReference(planeName.replace(' ', '') + key + 'Volume'))
+    self.unwrapBackendComboBox.setCurrentIndex(self.unwrapBackendComboBox.findData(self._parameterNode.GetParameter('UnwrapBackend')))
+    self.tipDetectorComboBox.setCurrentIndex(self.tipDetectorComboBox.findData(self._parameterNode.GetParameter('TipDetector')))
+    self.rollingBaselineCheckBox.checked = (self._parameterNode.GetParameter('RollingBaseline') == 'True')
+    self.rollingBaselineRateSpinBox.value = float(self._parameterNode.GetParameter('RollingBaselineRate'))
+    self.frameBudgetSpinBox.value = float(self._parameterNode.GetParameter('FrameBudget'))
+    self.reacquireAfterSpinBox.value = int(self._parameterNode.GetParameter('ReacquireAfter'))
+    self.syntheticPathSelector.setCurrentNode(self._parameterNode.GetNodeReference('SyntheticPath'))
+    self.syntheticRateSpinBox.value = float(self._parameterNode.GetParameter('SyntheticRate'))
+    self.syntheticSpeedSpinBox.value = float(self._parameterNode.GetParameter('SyntheticSpeed'))
+    self.syntheticNoiseSpinBox.value = float(self._parameterNode.GetParameter('SyntheticNoise'))
     
     # Update buttons states
     self.updateButtons()
@@ -425,12 +792,35 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self._parameterNode.SetNodeReferenceID('FirstVolume', self.firstVolumeSelector.currentNodeID)
     self._parameterNode.SetNodeReferenceID('SecondVolume', self.secondVolumeSelector.currentNodeID)
     self._parameterNode.SetParameter('InputMode', 'MagPhase' if self.inputModeMagPhase.checked else 'RealImag')
+    self._parameterNode.SetParameter('DifferenceMode', 'Complex' if self.differenceModeComplex.checked else 'Unwrapped')
     self._parameterNode.SetParameter('SceneView', self.getSelectedView())
     self._parameterNode.SetNodeReferenceID('TipPrediction', self.tipPredictionSelector.currentNodeID)
+    self._parameterNode.RemoveNodeReferenceIDs('OtherNeedlePrediction')
+    for node in self.otherNeedlesSelector.checkedNodes():
+      self._parameterNode.AddNodeReferenceID('OtherNeedlePrediction', node.GetID())
     self._parameterNode.SetParameter('ROISize', str(self.roiSizeWidget.value))
     self._parameterNode.SetParameter('BlobThreshold', str(self.blobThresholdWidget.value))
     self._parameterNode.SetParameter('ErrorThreshold', str(self.errorThresholdWidget.value))
     self._parameterNode.SetParameter('Debug', 'True' if self.debugFlagCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('DebugSampling', str(self.debugSamplingSpinBox.value))
+    self._parameterNode.SetParameter('Execution', self.executionComboBox.currentData)
+    self._parameterNode.SetParameter('UnwrapMode', 'ROI' if self.roiUnwrapCheckBox.checked else 'Full')
+    self._parameterNode.SetParameter('AllSlices', 'True' if self.allSlicesCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('MotionPrediction', 'True' if self.motionPredictionCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('MultiPlane', 'True' if self.multiPlaneCheckBox.checked else 'False')
+    for (planeName, selectors) in self.planeSelectors.items():
+      for (key, selector) in selectors.items():
+        self._parameterNode.SetNodeReferenceID(planeName.replace(' ', '') + key + 'Volume', selector.currentNodeID)
+    self._parameterNode.SetParameter('UnwrapBackend', self.unwrapBackendComboBox.currentData)
+    self._parameterNode.SetParameter('TipDetector', self.tipDetectorComboBox.currentData)
+    self._parameterNode.SetParameter('RollingBaseline', 'True' if self.rollingBaselineCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('RollingBaselineRate', str(self.rollingBaselineRateSpinBox.value))
+    self._parameterNode.SetParameter('FrameBudget', str(self.frameBudgetSpinBox.value))
+    self._parameterNode.SetParameter('ReacquireAfter', str(self.reacquireAfterSpinBox.value))
+    self._parameterNode.SetNodeReferenceID('SyntheticPath', self.syntheticPathSelector.currentNodeID)
+    self._parameterNode.SetParameter('SyntheticRate', str(self.syntheticRateSpinBox.value))
+    self._parameterNode.SetParameter('SyntheticSpeed', str(self.syntheticSpeedSpinBox.value))
+    self._parameterNode.SetParameter('SyntheticNoise', str(self.syntheticNoiseSpinBox.value))
     self._parameterNode.EndModify(wasModified)
                         
   # Update button states
@@ -441,6 +831,10 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.saveBaselineButton.enabled = baselineNodesDefined and not self.isTrackingOn
     self.startTrackingButton.enabled = rtNodesDefined and positionNodeDefined and self.isBaselineSaved and not self.isTrackingOn
     self.stopTrackingButton.enabled = self.isTrackingOn
+    self.rebuildBaselineButton.enabled = self.isBaselineSaved
+    syntheticRunning = self.logic is not None and self.logic.isSyntheticFramesRunning()
+    self.startSyntheticButton.enabled = bool(baselineNodesDefined and rtNodesDefined and self.syntheticPathSelector.currentNode()) and not syntheticRunning
+    self.stopSyntheticButton.enabled = syntheticRunning
     
   # Get selected scene view for tracking
   def getSelectedView(self):
@@ -471,6 +865,33 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.debugFlag = self.debugFlagCheckBox.checked
     # Set base images
     self.logic.updateBaseImages(self.firstBaselineVolume, self.secondBaselineVolume, self.segmentationNode, self.inputMode, self.debugFlag)
+    # Set base images of every plane (the images above are plane 1)
+    if self.multiPlaneCheckBox.checked:
+      planes = [('Plane 1', self.firstBaselineVolume, self.secondBaselineVolume)] + self.getPlaneVolumes('FirstBaseline', 'SecondBaseline')
+      self.logic.updatePlaneBaseImages(planes, self.segmentationNode, self.inputMode, self.debugFlag)
+    # Run the pipeline once with the current settings, so that the first tracked frame runs at steady-state latency
+    sliceIndex = None if self.allSlicesCheckBox.checked else self.getSliceIndex(self.getSelectedView())
+    self.logic.warmUpPipeline(sliceIndex, int(self.roiSizeWidget.value), float(self.blobThresholdWidget.value), float(self.errorThresholdWidget.value), self.inputMode,
+                              'ROI' if self.roiUnwrapCheckBox.checked else 'Full', 'Complex' if self.differenceModeComplex.checked else 'Unwrapped',
+                              self.unwrapBackendComboBox.currentData, self.tipPredictionSelector.currentNode(), self.tipDetectorComboBox.currentData,
+                              self.multiPlaneCheckBox.checked)
+    self.updateLatency()
+
+  # Get (plane name, first volume, second volume) of the additional planes with both volumes selected
+  def getPlaneVolumes(self, firstKey, secondKey):
+    planes = []
+    for (planeName, selectors) in self.planeSelectors.items():
+      firstVolume = selectors[firstKey].currentNode()
+      secondVolume = selectors[secondKey].currentNode()
+      if firstVolume and secondVolume:
+        planes.append((planeName, firstVolume, secondVolume))
+    return planes
+
+  # Get volumes whose updates trigger a tracking cycle
+  def getObservedVolumes(self):
+    if self.planeVolumes:
+      return [secondVolume for (_, _, secondVolume) in self.planeVolumes]
+    return [self.secondVolume]
 
     
   def startTracking(self):
@@ -482,17 +903,47 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.firstVolume = self.firstVolumeSelector.currentNode()
     self.secondVolume = self.secondVolumeSelector.currentNode()    
     self.tipPrediction = self.tipPredictionSelector.currentNode()
-    # Create listener to sequence node
-    self.addObserver(self.secondVolume, self.secondVolume.ImageDataModifiedEvent, self.receivedImage)
-    # Initialize CurrentTrackedTipNode with current prediction value
-    self.logic.initializeTipPrediction(self.tipPrediction)
+    # Start background tracking
+    self.execution = self.executionComboBox.currentData
+    # Planes tracked at the same time (empty: single plane)
+    self.planeVolumes = []
+    if self.multiPlaneCheckBox.checked:
+      self.planeVolumes = [('Plane 1', self.firstVolume, self.secondVolume)] + self.getPlaneVolumes('First', 'Second')
+    # Needles tracked at the same time (one item: single needle)
+    self.tipPredictions = [self.tipPrediction] + [node for node in self.otherNeedlesSelector.checkedNodes() if node != self.tipPrediction]
+    if len(self.tipPredictions) > 1:
+      if self.planeVolumes:
+        print('Multi-needle tracking is not available with multi-plane tracking: only the first needle is tracked')
+        self.tipPredictions = [self.tipPrediction]
+    if self.rollingBaselineCheckBox.checked and (self.planeVolumes or self.execution == 'Process'):
+      print('Rolling baseline is not available with multi-plane tracking or the process pool: the baseline stays fixed')
+    self.logic.frameBudget.reset()
+    self.logic.resetReacquisition()
+    if self.execution != 'Synchronous':
+      self.logic.startScheduler(self.execution, bool(self.planeVolumes))
+      self.resultTimer.start()
+    self.latencyTimer.start()
+    # Create listener to sequence node (of every plane)
+    for volume in self.getObservedVolumes():
+      self.addObserver(volume, volume.ImageDataModifiedEvent, self.receivedImage)
+    # Initialize CurrentTrackedTipNode with current prediction value (of every needle)
+    for (needleIndex, tipPrediction) in enumerate(self.tipPredictions):
+      self.logic.initializeTipPrediction(tipPrediction, needleIndex)
   
   def stopTracking(self):
     self.isTrackingOn = False
     self.updateButtons()
     #TODO: Define what should to be refreshed
     print('Stop Tracking')
-    self.removeObserver(self.secondVolume, self.secondVolume.ImageDataModifiedEvent, self.receivedImage)
+    for volume in self.getObservedVolumes():
+      self.removeObserver(volume, volume.ImageDataModifiedEvent, self.receivedImage)
+    # Stop background tracking and publish the last results
+    if self.execution != 'Synchronous':
+      self.resultTimer.stop()
+      self.logic.stopScheduler()
+      self.publishResults()
+    self.latencyTimer.stop()
+    self.updateLatency()
   
   def receivedImage(self, caller=None, event=None):
     # Execute one tracking cycle
@@ -500,15 +951,124 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
       # Get parameters
       self.inputMode = 'MagPhase' if self.inputModeMagPhase.checked else 'RealImag'
       self.roiSize = int(self.roiSizeWidget.value)
-      self.sliceIndex = self.getSliceIndex(self.getSelectedView())
+      # None: track all slices
+      self.sliceIndex = None if self.allSlicesCheckBox.checked else self.getSliceIndex(self.getSelectedView())
       self.blobThreshold = float(self.blobThresholdWidget.value)
       self.errorThreshold = float(self.errorThresholdWidget.value)
       self.debugFlag = self.debugFlagCheckBox.checked
+      self.logic.setDebugSampling(self.debugSamplingSpinBox.value)
+      self.logic.useMotionPrediction = self.motionPredictionCheckBox.checked
+      self.logic.useRollingBaseline = self.rollingBaselineCheckBox.checked
+      self.logic.rollingBaselineRate = self.rollingBaselineRateSpinBox.value
+      self.logic.frameBudget.setBudget(self.frameBudgetSpinBox.value)
+      self.logic.reacquireAfter = self.reacquireAfterSpinBox.value
+      self.unwrapMode = 'ROI' if self.roiUnwrapCheckBox.checked else 'Full'
+      self.unwrapBackend = self.unwrapBackendComboBox.currentData
+      self.tipDetector = self.tipDetectorComboBox.currentData
+      self.differenceMode = 'Complex' if self.differenceModeComplex.checked else 'Unwrapped'
+      # Multi-plane tracking
+      if self.planeVolumes:
+        if self.execution != 'Synchronous':
+          self.logic.submitNeedleMultiPlane(self.planeVolumes, self.tipPrediction, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag, self.unwrapMode, self.differenceMode, self.unwrapBackend, self.tipDetector)
+          return
+        self.logic.getNeedleMultiPlane(self.planeVolumes, self.tipPrediction, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag, self.unwrapMode, self.differenceMode, self.unwrapBackend, self.tipDetector)
+        self.updateFrameCounters()
+        return
+      # Multi-needle tracking
+      if len(self.tipPredictions) > 1:
+        if self.execution != 'Synchronous':
+          self.logic.submitNeedles(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPredictions, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag, self.unwrapMode, self.differenceMode, self.unwrapBackend, self.tipDetector)
+          return
+        self.logic.getNeedles(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPredictions, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag, self.unwrapMode, self.differenceMode, self.unwrapBackend, self.tipDetector)
+        self.updateFrameCounters()
+        return
+      # Queue frame for background tracking (results are published by the result timer)
+      if self.execution != 'Synchronous':
+        self.logic.submitNeedle(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPrediction, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag, self.unwrapMode, self.differenceMode, self.unwrapBackend, self.tipDetector)
+        return
       # Get needle tip
-      if self.logic.getNeedle(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPrediction, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag):
-        print('Tracking successful')
-      else:
-        print('Tracking failed')
+      self.logic.getNeedle(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPrediction, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag, self.unwrapMode, self.differenceMode, self.unwrapBackend, self.tipDetector)
+      self.updateFrameCounters()
+
+  # Publish needle tips tracked in background
+  def publishResults(self):
+    results = self.logic.publishScheduledResults()
+    if results:
+      self.updateFrameCounters()
+
+  # Refresh latency statistics and outcome tables (and baseline drift)
+  def updateLatency(self):
+    self.logic.updateLatencyTable()
+    self.logic.updateOutcomeTable()
+    self.baselineDriftLabel.text = '%.3f rad' % self.logic.baselineDrift
+
+  # Full rebuild of the baseline (in the worker thread, before its next frame, when the thread tracks with the main engine)
+  # Worker processes and multi-plane tracking do not use the main engine baseline: rebuilt at once
+  def rebuildBaseline(self):
+    if self.isTrackingOn and (self.execution == 'Thread') and not self.planeVolumes:
+      self.logic.requestBaselineRebuild()
+    else:
+      self.logic.rebuildBaseline()
+      self.updateLatency()
+
+  def resetLatency(self):
+    self.logic.resetLatencyStatistics()
+    self.logic.resetOutcomeStatistics()
+    self.updateOutcomeLabel()
+
+  def exportLatency(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Export latency statistics', 'NeedleTrackingLatency.csv', 'CSV files (*.csv)')
+    if path:
+      self.logic.exportLatencyStatistics(path)
+      print('Latency statistics saved to %s' % path)
+
+  def exportHistory(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Export tracking history', 'NeedleTrackingHistory.csv', 'CSV files (*.csv);;HDF5 files (*.h5 *.hdf5)')
+    if path:
+      self.logic.exportHistory(path)
+      print('Tracking history saved to %s' % path)
+
+  def exportHistoryToSequence(self):
+    sequenceNode = self.logic.exportHistoryToSequence()
+    print('Tracking history copied to %s' % sequenceNode.GetName())
+
+  # Show processed/dropped frame counters
+  def updateFrameCounters(self):
+    (processed, dropped) = self.logic.getFrameCounters(self.execution != 'Synchronous')
+    self.frameCountersLabel.text = 'processed: %d, dropped: %d' % (processed, dropped)
+    self.updateOutcomeLabel()
+
+  # Show rolling success rate and last outcome
+  def updateOutcomeLabel(self):
+    statistics = self.logic.outcomeStatistics
+    successRate = statistics.getSuccessRate()
+    if successRate is None:
+      self.outcomeLabel.text = '-'
+      return
+    self.outcomeLabel.text = 'success %.0f%% (last %d), last: %s' % (100*successRate, len(statistics.recent), statistics.lastResult.message)
+    if self.logic.frameBudget.level:
+      self.outcomeLabel.text += ', degraded: %s' % ', '.join(SimpleNeedleTrackingLib.getDegradationNames(self.logic.frameBudget.getDegradations()))
+    if self.logic.isTrackLost():
+      self.outcomeLabel.text += ', track lost: re-acquiring'
+
+  # Write synthetic frames (needle tip moving along the path) into the real-time images
+  def startSyntheticFrames(self):
+    self.logic.startSyntheticFrames(self.firstBaselineVolumeSelector.currentNode(), self.secondBaselineVolumeSelector.currentNode(),
+                                    self.firstVolumeSelector.currentNode(), self.secondVolumeSelector.currentNode(), self.syntheticPathSelector.currentNode(),
+                                    self.syntheticRateSpinBox.value, self.syntheticSpeedSpinBox.value, self.syntheticNoiseSpinBox.value)
+    self.syntheticStatusTimer.start()
+    self.updateButtons()
+
+  def stopSyntheticFrames(self):
+    self.logic.stopSyntheticFrames()
+    self.syntheticStatusTimer.stop()
+    self.updateSyntheticStatus()
+    self.updateButtons()
+
+  # Show synthetic frames written and achieved frame rate
+  def updateSyntheticStatus(self):
+    (written, rate) = self.logic.getSyntheticFrameCounters()
+    self.syntheticStatusLabel.text = '%d frames, %.1f fps' % (written, rate)
       
     
 ################################################################################################################################################
@@ -521,17 +1081,56 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
     ScriptedLoadableModuleLogic.__init__(self)
     self.cliParamNode = None
     
-    # Phase rescaling filter
-    self.phaseRescaleFilter = sitk.RescaleIntensityImageFilter()
-    self.phaseRescaleFilter.SetOutputMaximum(2*np.pi)
-    self.phaseRescaleFilter.SetOutputMinimum(0)
-    
-    # ROI filter
-    self.roiFilter = sitk.RegionOfInterestImageFilter()
+    # Tracking pipeline (Slicer-independent)
+    self.engine = SimpleNeedleTrackingLib.NeedleTrackingEngine()
+    self.engine.debugCallback = self.pushDebugImage
 
-    # Image file writer
+    # Tip motion model fed by the accepted tips (centers and sizes the ROI when enabled)
+    self.tipPredictor = SimpleNeedleTrackingLib.TipPredictor()
+    self.useMotionPrediction = False
+
+    # Multi-plane tracking (one engine and baseline per plane)
+    self.multiPlaneTracker = SimpleNeedleTrackingLib.MultiPlaneTracker()
+    self.multiPlaneTracker.debugCallback = self.pushDebugImage
+
+    # Per-stage latency statistics
+    self.latencyStatistics = SimpleNeedleTrackingLib.LatencyStatistics()
+    self.latencyTableNode = None
+
+    # Tracking outcome counters per reason code and rolling success rate
+    self.outcomeStatistics = SimpleNeedleTrackingLib.OutcomeStatistics()
+    self.outcomeTableNode = None
+
+    # Frame budget: tracking settings degraded in order while the cycles are late
+    self.frameBudget = SimpleNeedleTrackingLib.FrameBudgetController()
+
+    # Re-acquisition: after reacquireAfter consecutive failures (0: never), the tip is searched over the whole field of view
+    # (single needle). The re-acquired tip is followed until the prediction node moves.
+    self.reacquireAfter = 0
+    self.failureCount = 0
+    self.reacquisitionCount = 0
+    self.followedTipRAS = None
+    self.followedPredictionRAS = None
+
+    # Recent tracking attempts (ring buffer)
+    self.history = SimpleNeedleTrackingLib.TrackingHistory()
+
+    # Rolling baseline: frames with a tracked tip are blended into the base phase away from the needle
+    self.useRollingBaseline = False
+    self.rollingBaselineRate = 0.05
+    self.baselineDrift = 0.0
+    self.reportedBaselineDrift = 0.0    # Drift when last checked in the main thread (warning once above the threshold)
+    self.baselineDriftThreshold = 0.5  # rad, a full rebuild is advised above
+    self.isBaselineRebuildRequested = False
+
+    # Background tracking (latest frame wins)
+    self.scheduler = None
+    self.pendingDebugImages = collections.deque()
+
+    # Debug image writer (one compressed archive per frame, written in background)
     self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'Debug')
-    self.fileWriter = sitk.ImageFileWriter()
+    self.debugWriter = SimpleNeedleTrackingLib.DebugImageWriter(self.path)
+    self.debugFrameIndex = None
 
     # Check if tracked tip node exists, if not, create a new one
     try:
@@ -542,11 +1141,22 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
         self.tipTrackedNode.SetName('CurrentTrackedTipTransform')
         print('Created Tracked Tip TransformNode')
 
-    # Base ITK images
-    self.sitk_base_m = None
-    self.sitk_base_p = None
-    self.sitk_mask = None
+    # Sequence counter
     self.count = None
+    # Baseline inputs (first, second, geometry, mask, inputMode), used to initialize worker processes
+    self.baselineFrame = None
+    self.planeBaselineFrames = collections.OrderedDict()  # Baseline of each plane (multi-plane tracking), sent to worker processes
+    # Settings of the pipeline warm-up (NeedleTrackingEngine.warmUp arguments after the frame), None: no warm-up
+    self.warmUpArguments = None
+
+    # Synthetic frames for load testing (written into the real-time images by a timer)
+    self.syntheticGenerator = None
+    self.syntheticVolumes = None
+    self.syntheticTimer = qt.QTimer()
+    self.syntheticTimer.connect('timeout()', self.writeSyntheticFrame)
+    self.syntheticStartTime = None
+    self.syntheticFrameCount = 0
+    self.syntheticTipNode = None
     
   # Initialize parameter node with default settings
   def setDefaultParameters(self, parameterNode):
@@ -558,9 +1168,42 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
         parameterNode.SetParameter('ErrorThreshold', '15.0')   
     if not parameterNode.GetParameter('Debug'):
         parameterNode.SetParameter('Debug', 'False')   
+    if not parameterNode.GetParameter('DebugSampling'):
+        parameterNode.SetParameter('DebugSampling', '1')   
+    if not parameterNode.GetParameter('Execution'):
+        parameterNode.SetParameter('Execution', 'Synchronous')   
+    if not parameterNode.GetParameter('UnwrapMode'):
+        parameterNode.SetParameter('UnwrapMode', 'Full')   
+    if not parameterNode.GetParameter('MultiPlane'):
+        parameterNode.SetParameter('MultiPlane', 'False')   
+    if not parameterNode.GetParameter('MotionPrediction'):
+        parameterNode.SetParameter('MotionPrediction', 'False')   
+    if not parameterNode.GetParameter('AllSlices'):
+        parameterNode.SetParameter('AllSlices', 'False')   
+    if not parameterNode.GetParameter('UnwrapBackend'):
+        parameterNode.SetParameter('UnwrapBackend', 'Reliability')   
+    if not parameterNode.GetParameter('TipDetector'):
+        parameterNode.SetParameter('TipDetector', 'Blobs')   
+    if not parameterNode.GetParameter('DifferenceMode'):
+        parameterNode.SetParameter('DifferenceMode', 'Unwrapped')   
+    if not parameterNode.GetParameter('RollingBaseline'):
+        parameterNode.SetParameter('RollingBaseline', 'False')   
+    if not parameterNode.GetParameter('RollingBaselineRate'):
+        parameterNode.SetParameter('RollingBaselineRate', '0.05')   
+    if not parameterNode.GetParameter('FrameBudget'):
+        parameterNode.SetParameter('FrameBudget', '0')   
+    if not parameterNode.GetParameter('ReacquireAfter'):
+        parameterNode.SetParameter('ReacquireAfter', '0')   
+    if not parameterNode.GetParameter('SyntheticRate'):
+        parameterNode.SetParameter('SyntheticRate', '5.0')   
+    if not parameterNode.GetParameter('SyntheticSpeed'):
+        parameterNode.SetParameter('SyntheticSpeed', '5.0')   
+    if not parameterNode.GetParameter('SyntheticNoise'):
+        parameterNode.SetParameter('SyntheticNoise', '0.05')   
           
   # Create Slicer node and push ITK image to it
-  def pushitkToSlicer(self, sitkImage, name, debugFlag=False):
+  def pushitkToSlicer(self, sitkImage, name):
+    import sitkUtils  # Loads SimpleITK, only needed for debug images
     # Check if tracked tip node exists, if not, create a new one
     try:
       node = slicer.util.getNode(name)
@@ -568,306 +1211,772 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
       node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
       node.SetName(name)
     sitkUtils.PushVolumeToSlicer(sitkImage, node)
-    if (debugFlag==True):
-      self.fileWriter.Execute(sitkImage, os.path.join(self.path, name)+'.nrrd', False, 0)
-
-  # Return sitk Image from numpy array
-  def numpyToitk(self, array, sitkReference, type=None):
-    image = sitk.GetImageFromArray(array, isVector=False)
-    if (type is None):
-      image = sitk.Cast(image, sitkReference.GetPixelID())
-    else:
-      image = sitk.Cast(image, type)
-    image.CopyInformation(sitkReference)
-    return image
-  
-  # Return blank itk Image with same information from reference volume
-  def createBlankItk(self, sitkReference, type=None, pixelValue=0):
-    image = sitk.Image(sitkReference.GetSize(), sitk.sitkUInt8)
-    image.CopyInformation(sitkReference)
-    if pixelValue != 0: 
-      image = sitk.Not(image)
-    if (type is None):
-      image = sitk.Cast(image, sitkReference.GetPixelID())
-    else:
-      image = sitk.Cast(image, type)  
-    if pixelValue != 0:
-      image = pixelValue*image 
-    return image
-
-  # Unwrap phase images with implementation from scikit-image (module: restoration)
-  def unwrap_phase_array(self, array_p, array_mask):
-    array_p_masked = np.ma.array(array_p, mask=np.logical_not(array_mask).astype(int))  # Mask phase image (inverted mask)
-    if array_p.shape[0] == 1: # 2D image in a 3D array: make it 2D array for improved performance
-        array_p_unwraped = np.ma.copy(array_p_masked)  # Initialize unwraped array as the original
-        array_p_unwraped[0,:,:] = unwrap_phase(array_p_masked[0,:,:], wrap_around=(False,False))               
-    else:
-        array_p_unwraped = unwrap_phase(array_p_masked, wrap_around=(False,False,False))   
-    return array_p_unwraped
-  
-  def realImagToMagPhase(self, realVolume, imagVolume):
-    # Pull the real/imaginary volumes from the MRML scene and convert them to magnitude/phase volumes
-    sitk_real = sitkUtils.PullVolumeFromSlicer(realVolume)
-    sitk_imag = sitkUtils.PullVolumeFromSlicer(imagVolume)
-    numpy_real = sitk.GetArrayFromImage(sitk_real)
-    numpy_imag = sitk.GetArrayFromImage(sitk_imag)
-    numpy_comp = numpy_real + 1.0j * numpy_imag
-    numpy_magn = np.absolute(numpy_comp)
-    numpy_phase = np.angle(numpy_comp)
-    sitk_magn = self.numpyToitk(numpy_magn, sitk_real)
-    sitk_phase = self.numpyToitk(numpy_phase, sitk_real)
-    return (sitk_magn, sitk_phase)
+
+  # Push intermediate images from the tracking engine and queue them for the debug writer
+  # Images produced in the worker thread are pushed later from the main thread
+  def pushDebugImage(self, sitkImage, name):
+    self.debugWriter.add(self.debugFrameIndex, name, sitkImage)
+    if threading.current_thread() is not threading.main_thread():
+      self.pendingDebugImages.append((sitkImage, name))
+      return
+    self.pushitkToSlicer(sitkImage, name)
+
+  # Capture debug output only every Nth frame
+  def setDebugSampling(self, sampling):
+    self.debugWriter.sampling = max(1, int(sampling))
+
+  # Get voxel array (slice, row, column) and geometry from MRML volume node
+  # The array is a view of the node voxels (no copy), valid until the node is updated.
+  # snapshot: return a new float32 copy instead, for frames tracked later by the worker thread (the node voxels are
+  # overwritten by the next frame while the frame waits in the queue, and the worker may still read the previous copy,
+  # so a buffer cannot be reused)
+  def getFrameFromVolume(self, volumeNode, snapshot=False):
+    numpy_view = slicer.util.arrayFromVolume(volumeNode)
+    geometry = self.getVolumeGeometry(volumeNode)
+    if snapshot:
+      return (numpy_view.astype(np.float32), geometry)
+    return (numpy_view, geometry)
+
+  # Get volume node geometry in ITK convention (LPS)
+  def getVolumeGeometry(self, volumeNode):
+    ijkToRASDirections = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASDirectionMatrix(ijkToRASDirections)
+    direction = []
+    for row in range(3):
+      sign = -1.0 if row < 2 else 1.0  # RAS to LPS
+      for col in range(3):
+        direction.append(sign*ijkToRASDirections.GetElement(row, col))
+    origin = volumeNode.GetOrigin()
+    return SimpleNeedleTrackingLib.FrameGeometry((-origin[0], -origin[1], origin[2]), volumeNode.GetSpacing(), direction)
 
   def getMaskFromSegmentation(self, segmentationNode, referenceVolumeNode):
     if segmentationNode is None:
-      sitk_reference = sitkUtils.PullVolumeFromSlicer(referenceVolumeNode)
-      sitk_mask = self.createBlankItk(sitk_reference, pixelValue=1)
-    else:
-      labelmapVolumeNode = slicer.util.getFirstNodeByName('mask_labelmap')
-      if labelmapVolumeNode is None or labelmapVolumeNode.GetClassName() != 'vtkMRMLLabelMapVolumeNode':      
-        labelmapVolumeNode = slicer.vtkMRMLLabelMapVolumeNode()
-        slicer.mrmlScene.AddNode(labelmapVolumeNode)
-        labelmapVolumeNode.SetName('mask_labelmap')
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelmapVolumeNode, referenceVolumeNode)
-      sitk_mask = sitkUtils.PullVolumeFromSlicer(labelmapVolumeNode)
-    return sitk.Cast(sitk_mask, sitk.sitkUInt8)
-
-  def initializeTipPrediction(self, tipPredictedNode):
+      return None
+    labelmapVolumeNode = slicer.util.getFirstNodeByName('mask_labelmap')
+    if labelmapVolumeNode is None or labelmapVolumeNode.GetClassName() != 'vtkMRMLLabelMapVolumeNode':      
+      labelmapVolumeNode = slicer.vtkMRMLLabelMapVolumeNode()
+      slicer.mrmlScene.AddNode(labelmapVolumeNode)
+      labelmapVolumeNode.SetName('mask_labelmap')
+    slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelmapVolumeNode, referenceVolumeNode)
+    return slicer.util.arrayFromVolume(labelmapVolumeNode).astype(np.uint8)
+
+  # Get transform node position (RAS)
+  def getTipRAS(self, transformNode):
+    transformMatrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToWorld(transformMatrix)
+    return (transformMatrix.GetElement(0,3), transformMatrix.GetElement(1,3), transformMatrix.GetElement(2,3))
+
+  # Get tracked tip node of a needle: CurrentTrackedTipTransform for the first one, CurrentTrackedTipTransform2, 3... for the others
+  def getTrackedTipNode(self, needleIndex=0):
+    if needleIndex == 0:
+      return self.tipTrackedNode
+    name = 'CurrentTrackedTipTransform%i' % (needleIndex+1)
+    node = slicer.util.getFirstNodeByName(name)
+    if node is None or node.GetClassName() != 'vtkMRMLLinearTransformNode':
+      node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', name)
+    return node
+
+  def initializeTipPrediction(self, tipPredictedNode, needleIndex=0):
+    if needleIndex == 0:
+      self.tipPredictor.reset()
     try:
       transformMatrix = vtk.vtkMatrix4x4()
       tipPredictedNode.GetMatrixTransformToWorld(transformMatrix)
-      self.tipTrackedNode.SetMatrixTransformToParent(transformMatrix)
+      self.getTrackedTipNode(needleIndex).SetMatrixTransformToParent(transformMatrix)
       print('Initialized CurrentTrackedTipNode')
       return True
     except:
       print('Could not initilize CurrentTrackedTipNode')
       return False
   
+  # Get tip prediction (RAS) at timestamp: from the motion model when enabled and tracking, else from the prediction node
+  # (or the re-acquired tip while the prediction node has not moved)
+  def getPredictedTipRAS(self, tipPrediction, timestamp):
+    if self.useMotionPrediction and self.tipPredictor.isInitialized(timestamp):
+      return self.tipPredictor.predict(timestamp)
+    tipRAS = self.getTipRAS(tipPrediction)
+    if self.followedTipRAS is not None:
+      if np.linalg.norm(np.subtract(tipRAS, self.followedPredictionRAS)) < 1.0:
+        return self.followedTipRAS
+      self.followedTipRAS = None
+    return tipRAS
+
+  # Check if the track is lost: reacquireAfter consecutive failures (the next frame is searched over the whole field of view)
+  def isTrackLost(self):
+    return bool(self.reacquireAfter) and (self.failureCount >= self.reacquireAfter)
+
+  # Count consecutive failures and follow the tips found since a re-acquisition
+  def updateReacquisition(self, result, tipPrediction):
+    if not result:
+      self.failureCount += 1
+      return
+    self.failureCount = 0
+    if result.reacquired:
+      self.reacquisitionCount += 1
+      self.followedPredictionRAS = self.getTipRAS(tipPrediction)
+    if self.followedPredictionRAS is not None:
+      self.followedTipRAS = result.tipRAS
+
+  # Clear the consecutive failures and the followed tip (new tracking session)
+  def resetReacquisition(self):
+    self.failureCount = 0
+    self.followedTipRAS = None
+    self.followedPredictionRAS = None
+
+  # Get ROI size (px) at timestamp: shrunk by the motion model while the track is stable
+  def getPredictedROISize(self, roiSize, geometry, timestamp):
+    if not self.useMotionPrediction:
+      return roiSize
+    return self.tipPredictor.getROISize(timestamp, roiSize, geometry.spacing[0])
+
+  # Feed an accepted tip to the motion model
+  def updateTipPredictor(self, result, timestamp):
+    if result:
+      self.tipPredictor.update(result.tipRAS, timestamp)
+
   # Update the stored base images
   def updateBaseImages(self, firstBaselineVolume, secondBaselineVolume, segmentationNode, inputMode, debugFlag=False):
     # Initialize sequence counter
     self.count = 0
-    # Get itk images from MRML volume nodes 
-    if (inputMode == 'RealImag'): # Convert to magnitude/phase
-      (self.sitk_base_m, self.sitk_base_p) = self.realImagToMagPhase(firstBaselineVolume, secondBaselineVolume)
-    else:                         # Already as magnitude/phase
-      self.sitk_base_m = sitkUtils.PullVolumeFromSlicer(firstBaselineVolume)
-      self.sitk_base_p = sitkUtils.PullVolumeFromSlicer(secondBaselineVolume)
-    # Force 32Float
-    self.sitk_base_m = sitk.Cast(self.sitk_base_m, sitk.sitkFloat32)
-    self.sitk_base_p = sitk.Cast(self.sitk_base_p, sitk.sitkFloat32)
-    # Phase scaling to angle interval [0 to 2*pi]
-    self.sitk_base_p = self.phaseRescaleFilter.Execute(self.sitk_base_p)
-    # Get base mask: Generate bool mask from magnitude image to remove background
-    self.sitk_mask = self.getMaskFromSegmentation(segmentationNode, firstBaselineVolume)
-    # Unwrapped base phase
-    numpy_base_p = sitk.GetArrayFromImage(self.sitk_base_p)
-    numpy_mask = sitk.GetArrayFromImage(self.sitk_mask)
-    self.numpy_base_unwraped_p = self.unwrap_phase_array(numpy_base_p, numpy_mask)# Rescale MARIANA
-    # Push debug images to Slicer
+    startTime = time.perf_counter()
+    # Get images from MRML volume nodes (float32 copies, kept for worker processes)
+    (numpy_first, geometry) = self.getFrameFromVolume(firstBaselineVolume)
+    (numpy_second, _) = self.getFrameFromVolume(secondBaselineVolume)
+    numpy_first = numpy_first.astype(np.float32)
+    numpy_second = numpy_second.astype(np.float32)
+    # Get base mask (None: whole image)
+    numpy_mask = self.getMaskFromSegmentation(segmentationNode, firstBaselineVolume)
+    pullTime = 1000*(time.perf_counter() - startTime)
+    # Engine keeps both the unwrapped and the complex base phase (for either difference mode)
+    self.debugFrameIndex = 'baseline'
+    self.engine.setBaseline(numpy_first, numpy_second, geometry, numpy_mask, inputMode, debugFlag)
+    if debugFlag:
+      self.debugWriter.endFrame(self.debugFrameIndex)
+    self.baselineFrame = (numpy_first, numpy_second, geometry, numpy_mask, inputMode)
+    self.baselineDrift = 0.0
+    self.reportedBaselineDrift = 0.0
+    self.isBaselineRebuildRequested = False
+    # Record baseline stage durations
+    timings = {'Baseline Pull': pullTime}
+    for (stage, duration) in self.engine.baselineTimings.items():
+      timings['Baseline ' + stage] = duration
+    self.latencyStatistics.add(timings)
     if debugFlag:
-      self.pushitkToSlicer(self.sitk_base_m, 'debug_base_m', debugFlag)
-      self.pushitkToSlicer(self.sitk_base_p, 'debug_base_p', debugFlag)
-      self.pushitkToSlicer(self.sitk_mask, 'debug_mask', debugFlag)
-      sitk_base_unwraped_p = self.numpyToitk(self.numpy_base_unwraped_p, self.sitk_base_p)
-      self.pushitkToSlicer(sitk_base_unwraped_p, 'debug_base_unwraped_p', debugFlag)
       print('Baseline saved')
+
+  # Run the tracking pipeline once on the baseline frame (result discarded), so that the first tracked frame does not
+  # pay for first use of the filters, lazy imports and allocations. Same parameters as getNeedle; worker processes
+  # started later run the same warm-up
+  # multiPlane: warm the engines of every plane (multi-plane tracking) instead of the main engine. The slice engines
+  # are warmed with them when all slices are tracked (sliceIndex None, or multi-slice planes)
+  def warmUpPipeline(self, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipPrediction=None, tipDetector='Blobs', multiPlane=False):
+    if self.baselineFrame is None:
+      return
+    (numpy_first, numpy_second, geometry, _, _) = self.baselineFrame
+    tipRAS = self.getTipRAS(tipPrediction) if tipPrediction is not None else None
+    self.warmUpArguments = (sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode, unwrapMode, differenceMode, unwrapBackend, tipRAS, tipDetector)
+    if multiPlane and self.planeBaselineFrames:
+      # Engines of every plane (tracked on all their slices)
+      frames = collections.OrderedDict((planeName, planeBaseline[:3]) for (planeName, planeBaseline) in self.planeBaselineFrames.items())
+      self.multiPlaneTracker.warmUp(frames, *self.warmUpArguments[1:])
+      self.latencyStatistics.add({'Baseline Warm-up': self.multiPlaneTracker.baselineTimings['Warm-up']})
+      return
+    self.engine.warmUp(numpy_first, numpy_second, geometry, *self.warmUpArguments)
+    self.latencyStatistics.add({'Baseline Warm-up': self.engine.baselineTimings['Warm-up']})
+
+  # Update the stored base images of every plane for multi-plane tracking
+  # planes: list of (plane name, first baseline volume, second baseline volume)
+  # The mask segmentation is resampled to each plane
+  def updatePlaneBaseImages(self, planes, segmentationNode, inputMode, debugFlag=False):
+    startTime = time.perf_counter()
+    self.multiPlaneTracker.clear()
+    self.planeBaselineFrames = collections.OrderedDict()
+    self.debugFrameIndex = 'baseline'
+    for (planeName, firstBaselineVolume, secondBaselineVolume) in planes:
+      (numpy_first, geometry) = self.getFrameFromVolume(firstBaselineVolume)
+      (numpy_second, _) = self.getFrameFromVolume(secondBaselineVolume)
+      numpy_mask = self.getMaskFromSegmentation(segmentationNode, firstBaselineVolume)
+      self.multiPlaneTracker.setBaseline(planeName, numpy_first.astype(np.float32), numpy_second.astype(np.float32), geometry, numpy_mask, inputMode, debugFlag)
+      self.planeBaselineFrames[planeName] = (numpy_first.astype(np.float32), numpy_second.astype(np.float32), geometry, numpy_mask, inputMode)
+    if debugFlag:
+      self.debugWriter.endFrame(self.debugFrameIndex)
+    self.latencyStatistics.add({'Baseline Planes': 1000*(time.perf_counter() - startTime)})
     
   
-  def getNeedle(self, firstVolume, secondVolume, sliceIndex, tipPrediction, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False):
-    if (self.sitk_base_m is None) or (self.sitk_base_p is None):
+  def getNeedle(self, firstVolume, secondVolume, sliceIndex, tipPrediction, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipDetector='Blobs'):
+    if not self.engine.isInitialized():
       print('ERROR: Mag/Phase base images were not initialized')    
-      return False
+      return SimpleNeedleTrackingLib.TrackingResult(message='ERROR: Mag/Phase base images were not initialized', reason=SimpleNeedleTrackingLib.REASON_NOT_INITIALIZED)
+    # Skip the frame when the cycles are late even with degraded settings (frame budget)
+    if self.frameBudget.skipFrame():
+      return self.recordSkippedFrame()[0]
     # Increment sequence counter
     self.count += 1    
-    # Get itk images from MRML volume nodes 
-    if (inputMode == 'RealImag'): # Convert to magnitude/phase
-      (sitk_img_m, sitk_img_p) = self.realImagToMagPhase(firstVolume, secondVolume)
-    else:                         # Already as magnitude/phase
-      sitk_img_m = sitkUtils.PullVolumeFromSlicer(firstVolume)
-      sitk_img_p = sitkUtils.PullVolumeFromSlicer(secondVolume)
-    # Force 32Float
-    sitk_img_m = sitk.Cast(sitk_img_m, sitk.sitkFloat32)
-    sitk_img_p = sitk.Cast(sitk_img_p, sitk.sitkFloat32)
-    numpy_base_p = sitk.GetArrayFromImage(self.sitk_base_p)
-    numpy_mask = sitk.GetArrayFromImage(self.sitk_mask)
-    # Phase scaling to angle interval [0 to 2*pi]
-    sitk_img_p = self.phaseRescaleFilter.Execute(sitk_img_p) # Rescale MARIANA
-    # Push debug images to Slicer     
+    startTime = time.perf_counter()
+    # Debug output only on sampled frames
+    debugFlag = debugFlag and self.debugWriter.isSampled(self.count)
+    self.debugFrameIndex = self.count
+    # Degrade the settings when the cycles are late (frame budget)
+    (debugFlag, roiSize, unwrapMode, degradations) = self.frameBudget.apply(debugFlag, roiSize, unwrapMode)
+    # Get images from MRML volume nodes (views of the node voxels, converted to float32 once by the engine)
+    (numpy_first, geometry) = self.getFrameFromVolume(firstVolume)
+    (numpy_second, _) = self.getFrameFromVolume(secondVolume)
+    pullTime = 1000*(time.perf_counter() - startTime)
+    # Get tip predicted coordinates: 3D Slicer (RAS)
+    tipRAS = self.getPredictedTipRAS(tipPrediction, startTime)
+    roiSize = self.getPredictedROISize(roiSize, geometry, startTime)
+    # Run tracking pipeline (over the whole field of view when the track is lost)
+    track = self.engine.reacquire if self.isTrackLost() else self.engine.track
+    result = track(numpy_first, numpy_second, geometry, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+    result.degradations = degradations
     if debugFlag:
-      self.pushitkToSlicer(sitk_img_m, 'debug_img_m', debugFlag)
-      self.pushitkToSlicer(sitk_img_p, 'debug_img_p', debugFlag)
-
-    ######################################
-    ##                                  ##
-    ## Step 1: Unwrap phase image       ##
-    ##                                  ##
-    ######################################
+      self.debugWriter.endFrame(self.count)
+    self.maintainBaseline(numpy_first, numpy_second, geometry, [result], inputMode)
+    self.updateTipPredictor(result, startTime)
+    self.updateReacquisition(result, tipPrediction)
+    if result:
+      # Push coordinates to tip Node
+      self.publishTip(result.tipRAS, tipPrediction)
+    self.recordTimings([result], pullTime, startTime, self.count)
+    return result
 
-    # Unwrapped img phase
-    numpy_img_p = sitk.GetArrayFromImage(sitk_img_p)
-    numpy_mask = sitk.GetArrayFromImage(self.sitk_mask)
-    numpy_img_unwraped_p = self.unwrap_phase_array(numpy_img_p, numpy_mask)
+  # Track the tip in several planes at once and publish the fused tip
+  # planeVolumes: list of (plane name, first volume, second volume), other parameters as getNeedle
+  def getNeedleMultiPlane(self, planeVolumes, tipPrediction, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipDetector='Blobs'):
+    if not self.multiPlaneTracker.isInitialized():
+      print('ERROR: Mag/Phase base images were not initialized')    
+      return SimpleNeedleTrackingLib.TrackingResult(message='ERROR: Mag/Phase base images were not initialized', reason=SimpleNeedleTrackingLib.REASON_NOT_INITIALIZED)
+    # Skip the frame when the cycles are late even with degraded settings (frame budget)
+    if self.frameBudget.skipFrame():
+      return self.recordSkippedFrame()[0]
+    # Increment sequence counter
+    self.count += 1    
+    startTime = time.perf_counter()
+    # Debug output only on sampled frames
+    debugFlag = debugFlag and self.debugWriter.isSampled(self.count)
+    self.debugFrameIndex = self.count
+    # Degrade the settings when the cycles are late (frame budget)
+    (debugFlag, roiSize, unwrapMode, degradations) = self.frameBudget.apply(debugFlag, roiSize, unwrapMode)
+    # Get images from MRML volume nodes (views of the node voxels, converted to float32 once by the plane engines)
+    frames = {}
+    for (planeName, firstVolume, secondVolume) in planeVolumes:
+      (numpy_first, geometry) = self.getFrameFromVolume(firstVolume)
+      (numpy_second, _) = self.getFrameFromVolume(secondVolume)
+      frames[planeName] = (numpy_first, numpy_second, geometry)
+    pullTime = 1000*(time.perf_counter() - startTime)
+    # Get tip predicted coordinates: 3D Slicer (RAS)
+    tipRAS = self.getPredictedTipRAS(tipPrediction, startTime)
+    roiSize = self.getPredictedROISize(roiSize, frames[planeVolumes[0][0]][2], startTime)
+    # Run tracking pipeline in all planes
+    result = self.multiPlaneTracker.track(frames, tipRAS, roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+    result.degradations = degradations
+    if debugFlag:
+      self.debugWriter.endFrame(self.count)
+    self.updateTipPredictor(result, startTime)
+    if result:
+      # Push coordinates to tip Node
+      self.publishTip(result.tipRAS, tipPrediction)
+    self.recordTimings([result], pullTime, startTime, self.count)
+    return result
 
-    # Plot
+  # Track several needles in the same frame and publish one tracked tip per needle
+  # tipPredictions: tip prediction node of each needle (the motion model, when enabled, predicts the first one)
+  # The phase difference is computed once; other parameters as getNeedle. Returns the result of each needle
+  def getNeedles(self, firstVolume, secondVolume, sliceIndex, tipPredictions, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipDetector='Blobs'):
+    if not self.engine.isInitialized():
+      print('ERROR: Mag/Phase base images were not initialized')    
+      return [SimpleNeedleTrackingLib.TrackingResult(message='ERROR: Mag/Phase base images were not initialized', reason=SimpleNeedleTrackingLib.REASON_NOT_INITIALIZED) for _ in tipPredictions]
+    # Skip the frame when the cycles are late even with degraded settings (frame budget)
+    if self.frameBudget.skipFrame():
+      return self.recordSkippedFrame(len(tipPredictions))
+    # Increment sequence counter
+    self.count += 1    
+    startTime = time.perf_counter()
+    # Debug output only on sampled frames
+    debugFlag = debugFlag and self.debugWriter.isSampled(self.count)
+    self.debugFrameIndex = self.count
+    # Degrade the settings when the cycles are late (frame budget)
+    (debugFlag, roiSize, unwrapMode, degradations) = self.frameBudget.apply(debugFlag, roiSize, unwrapMode)
+    # Get images from MRML volume nodes (views of the node voxels, converted to float32 once by the engine)
+    (numpy_first, geometry) = self.getFrameFromVolume(firstVolume)
+    (numpy_second, _) = self.getFrameFromVolume(secondVolume)
+    pullTime = 1000*(time.perf_counter() - startTime)
+    # Get tip predicted coordinates: 3D Slicer (RAS)
+    tipRASList = [self.getPredictedTipRAS(tipPredictions[0], startTime)] + [self.getTipRAS(tipPrediction) for tipPrediction in tipPredictions[1:]]
+    roiSize = self.getPredictedROISize(roiSize, geometry, startTime)
+    # Run tracking pipeline (shared phase difference)
+    results = self.engine.trackNeedles(numpy_first, numpy_second, geometry, tipRASList, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+    for result in results:
+      result.degradations = degradations
     if debugFlag:
-      sitk_img_unwraped_p = self.numpyToitk(numpy_img_unwraped_p, self.sitk_base_p)
-      self.pushitkToSlicer(sitk_img_unwraped_p, 'debug_img_unwraped_p', debugFlag)
-      
+      self.debugWriter.endFrame(self.count)
+    self.maintainBaseline(numpy_first, numpy_second, geometry, results, inputMode)
+    self.updateTipPredictor(results[0], startTime)
+    self.publishNeedles(results, tipPredictions)
+    self.recordTimings(results, pullTime, startTime, self.count)
+    return results
+
+  # Keep the base phase current after a tracking cycle (called in the thread that tracks the frame)
+  # Runs a requested rebuild, otherwise blends the frame into the rolling baseline when every needle was found
+  # (the tips found are excluded from the blend). Not available with multi-plane tracking or worker processes.
+  # Durations go to the timings of the first result, recorded with the cycle in the main thread (recordTimings).
+  def maintainBaseline(self, numpy_first, numpy_second, geometry, results, inputMode):
+    if self.isBaselineRebuildRequested:
+      results[0].timings['Baseline Rebuild'] = self.rebuildEngineBaseline()
+      return
+    if not self.useRollingBaseline or not all(results):
+      return
+    startTime = time.perf_counter()
+    self.baselineDrift = self.engine.updateRollingBaseline(numpy_first, numpy_second, geometry, [result.tipRAS for result in results], inputMode, self.rollingBaselineRate)
+    results[0].timings['Rolling Baseline'] = 1000*(time.perf_counter() - startTime)
 
-    ######################################
-    ##                                  ##
-    ## Step 2: Get phase difference     ##
-    ##                                  ##
-    ######################################
+  # Warn when the baseline drift crosses the threshold (main thread)
+  def checkBaselineDrift(self):
+    drift = self.baselineDrift
+    if (drift > self.baselineDriftThreshold) and (self.reportedBaselineDrift <= self.baselineDriftThreshold):
+      print('WARNING: Baseline drift %.2f rad, rebuild the baseline' % drift)
+    self.reportedBaselineDrift = drift
 
-    # Get phase difference
-    numpy_diff_p = numpy_img_unwraped_p - self.numpy_base_unwraped_p
+  # Unwrap the rolling base phase again (full rebuild) and reset the drift (main thread)
+  def rebuildBaseline(self):
+    self.latencyStatistics.add({'Baseline Rebuild': self.rebuildEngineBaseline()})
+    self.checkBaselineDrift()
 
-    # Set background to mean phase value
-    numpy_diff_p = numpy_diff_p.filled(numpy_diff_p.mean())
-    sitk_diff_p = self.numpyToitk(numpy_diff_p, sitk_img_p)
-    sitk_diff_p = self.phaseRescaleFilter.Execute(sitk_diff_p)
+  # Rebuild the engine baseline, returns the duration (ms)
+  def rebuildEngineBaseline(self):
+    self.isBaselineRebuildRequested = False
+    startTime = time.perf_counter()
+    self.engine.rebuildBaseline()
+    self.baselineDrift = 0.0
+    return 1000*(time.perf_counter() - startTime)
 
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_diff_p, 'debug_phase_diff', debugFlag)
-    
-    ######################################
-    ##                                  ##
-    ## Step 3: Select ROI               ##
-    ##                                  ##
-    ######################################
-    
-    # Get tip predicted coordinates: 3D Slicer (RAS)
+  # Rebuild the baseline in the worker thread before its next frame (background tracking)
+  def requestBaselineRebuild(self):
+    self.isBaselineRebuildRequested = True
+
+  # Push the tips found to the tracked tip node of each needle
+  def publishNeedles(self, results, tipPredictions):
+    for (needleIndex, (result, tipPrediction)) in enumerate(zip(results, tipPredictions)):
+      if result:
+        self.publishTip(result.tipRAS, tipPrediction, needleIndex)
+
+  # Add stage durations of a tracking cycle to the latency statistics and the attempts to the tracking history and outcome counters
+  # Pull: volume ingest, Total: tracking pipeline, Cycle: from ingest to published tip (also updates the frame budget level)
+  # results: result of each needle (the longest duration of each stage goes to the latency statistics)
+  def recordTimings(self, results, pullTime, startTime, frameCount=None):
+    timings = {'Pull': pullTime}
+    for result in results:
+      for (stage, duration) in result.timings.items():
+        timings[stage] = max(timings.get(stage, 0.0), duration)
+    timings['Cycle'] = 1000*(time.perf_counter() - startTime)
+    self.frameBudget.addCycle(timings['Cycle'])
+    timestamp = time.time()
+    self.latencyStatistics.add(timings, timestamp)
+    self.checkBaselineDrift()
+    for (needleIndex, result) in enumerate(results):
+      self.history.add(result, timestamp, frameCount, dict(result.timings, Pull=pullTime, Cycle=timings['Cycle']), needleIndex)
+      self.outcomeStatistics.add(result, timestamp)
+
+  # Add a frame skipped for the frame budget to the tracking history and outcome counters (not an attempt)
+  # Returns the result of each needle (REASON_SKIPPED)
+  def recordSkippedFrame(self, numberOfNeedles=1):
+    results = []
+    timestamp = time.time()
+    for needleIndex in range(numberOfNeedles):
+      result = SimpleNeedleTrackingLib.TrackingResult(message='Frame skipped (frame budget)', reason=SimpleNeedleTrackingLib.REASON_SKIPPED)
+      result.degradations = self.frameBudget.getDegradations()
+      self.history.add(result, timestamp, None, {}, needleIndex)
+      self.outcomeStatistics.add(result, timestamp, attempt=False)
+      results.append(result)
+    return results
+
+  # Get table node showing latency statistics
+  def getLatencyTableNode(self):
+    if self.latencyTableNode is None or self.latencyTableNode.GetScene() is None:
+      self.latencyTableNode = slicer.util.getFirstNodeByName('NeedleTrackingLatency')
+      if self.latencyTableNode is None or self.latencyTableNode.GetClassName() != 'vtkMRMLTableNode':
+        self.latencyTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'NeedleTrackingLatency')
+    return self.latencyTableNode
+
+  # Show rolling latency statistics (ms) in the table node
+  def updateLatencyTable(self):
+    tableNode = self.getLatencyTableNode()
+    statistics = self.latencyStatistics.getStatistics()
+    wasModified = tableNode.StartModify()
+    table = tableNode.GetTable()
+    table.Initialize()
+    columns = [vtk.vtkStringArray()] + [vtk.vtkDoubleArray() for _ in range(5)]
+    for (column, name) in zip(columns, ('Stage', 'Count', 'Mean (ms)', 'P50 (ms)', 'P95 (ms)', 'Max (ms)')):
+      column.SetName(name)
+      table.AddColumn(column)
+    table.SetNumberOfRows(len(statistics))
+    for (row, values) in enumerate(statistics):
+      columns[0].SetValue(row, values[0])
+      for col in range(1, 6):
+        columns[col].SetValue(row, values[col])
+    table.Modified()
+    tableNode.EndModify(wasModified)
+
+  # Clear latency statistics of the session
+  def resetLatencyStatistics(self):
+    self.latencyStatistics.reset()
+    self.updateLatencyTable()
+
+  # Get table node showing the tracking outcome counters
+  def getOutcomeTableNode(self):
+    if self.outcomeTableNode is None or self.outcomeTableNode.GetScene() is None:
+      self.outcomeTableNode = slicer.util.getFirstNodeByName('NeedleTrackingOutcomes')
+      if self.outcomeTableNode is None or self.outcomeTableNode.GetClassName() != 'vtkMRMLTableNode':
+        self.outcomeTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'NeedleTrackingOutcomes')
+    return self.outcomeTableNode
+
+  # Show the attempts per reason in the table node, and the rolling success rate, attempt rate and last outcome
+  # as node attributes (NeedleTracking.Attempts, .SuccessRate, .AttemptRate, .LastReason, .LastMessage), with the frame budget
+  # degradation level and the attempts degraded by each step (.DegradationLevel, .Degradation.<step>), the consecutive failures
+  # and the successful re-acquisitions (.ConsecutiveFailures, .Reacquisitions)
+  def updateOutcomeTable(self):
+    tableNode = self.getOutcomeTableNode()
+    counts = self.outcomeStatistics.getCounts()
+    wasModified = tableNode.StartModify()
+    table = tableNode.GetTable()
+    table.Initialize()
+    columns = [vtk.vtkStringArray(), vtk.vtkIntArray(), vtk.vtkIntArray(), vtk.vtkDoubleArray()]
+    for (column, name) in zip(columns, ('Reason', 'Code', 'Count', 'Fraction')):
+      column.SetName(name)
+      table.AddColumn(column)
+    table.SetNumberOfRows(len(counts))
+    for (row, (reason, count, fraction)) in enumerate(counts):
+      columns[0].SetValue(row, SimpleNeedleTrackingLib.REASON_NAMES.get(reason, 'Unknown'))
+      columns[1].SetValue(row, reason)
+      columns[2].SetValue(row, count)
+      columns[3].SetValue(row, fraction)
+    table.Modified()
+    successRate = self.outcomeStatistics.getSuccessRate()
+    attemptRate = self.outcomeStatistics.getAttemptRate()
+    lastResult = self.outcomeStatistics.lastResult
+    tableNode.SetAttribute('NeedleTracking.Attempts', str(self.outcomeStatistics.getTotalCount()))
+    tableNode.SetAttribute('NeedleTracking.SuccessRate', '' if successRate is None else '%.3f' % successRate)
+    tableNode.SetAttribute('NeedleTracking.AttemptRate', '' if attemptRate is None else '%.2f' % attemptRate)
+    tableNode.SetAttribute('NeedleTracking.LastReason', '' if lastResult is None else SimpleNeedleTrackingLib.REASON_NAMES.get(lastResult.reason, 'Unknown'))
+    tableNode.SetAttribute('NeedleTracking.LastMessage', '' if lastResult is None else lastResult.message)
+    tableNode.SetAttribute('NeedleTracking.DegradationLevel', str(self.frameBudget.level))
+    for (name, count) in self.frameBudget.getCounts():
+      tableNode.SetAttribute('NeedleTracking.Degradation.' + name, str(count))
+    tableNode.SetAttribute('NeedleTracking.ConsecutiveFailures', str(self.failureCount))
+    tableNode.SetAttribute('NeedleTracking.Reacquisitions', str(self.reacquisitionCount))
+    tableNode.EndModify(wasModified)
+
+  # Clear the tracking outcome counters
+  def resetOutcomeStatistics(self):
+    self.outcomeStatistics.reset()
+    self.frameBudget.resetCounts()
+    self.reacquisitionCount = 0
+    self.updateOutcomeTable()
+
+  # Export per-cycle stage durations of the session to CSV
+  def exportLatencyStatistics(self, path):
+    self.latencyStatistics.exportCSV(path)
+
+  # Export the tracking history to CSV, or HDF5 (*.h5, *.hdf5)
+  def exportHistory(self, path):
+    if os.path.splitext(path)[1].lower() in ('.h5', '.hdf5'):
+      self.history.exportHDF5(path)
+    else:
+      self.history.exportCSV(path)
+
+  # Copy the tips of the successful attempts of a needle in the tracking history into a transform sequence (index: time in s)
+  # The sequence is replayed with a sequence browser
+  def exportHistoryToSequence(self, name='TrackedTipSequence', needleIndex=0):
+    (entries, _) = self.history.getEntries()
+    entries = entries[entries['success'] & (entries['needle'] == needleIndex)]
+    sequenceNode = slicer.util.getFirstNodeByName(name)
+    if sequenceNode is None or sequenceNode.GetClassName() != 'vtkMRMLSequenceNode':
+      sequenceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSequenceNode', name)
+    sequenceNode.RemoveAllDataNodes()
+    sequenceNode.SetIndexName('time')
+    sequenceNode.SetIndexUnit('s')
+    sequenceNode.SetIndexType(sequenceNode.NumericIndex)
+    transformNode = slicer.vtkMRMLLinearTransformNode()
     transformMatrix = vtk.vtkMatrix4x4()
-    tipPrediction.GetMatrixTransformToWorld(transformMatrix)
-    tipHorizontal = transformMatrix.GetElement(0,3) # Right-Left
-    tipSlice = transformMatrix.GetElement(1,3)      # Anterior-Posteriot
-    tipVertical = transformMatrix.GetElement(2,3)   # Inferior-Superior
-    tipRAS = (tipHorizontal, tipSlice, tipVertical)
-
-    # Convert to pixel coordinates in ITK (LPS)
-    tipIndex = sitk_img_p.TransformPhysicalPointToIndex((-tipHorizontal, -tipSlice, tipVertical))
-    sliceDepth = sitk_img_p.GetDepth()
-    
-    # Define ROI filter size/index (pixels)
-    self.roiFilter.SetSize((roiSize,roiSize,sliceDepth))
-    roiIndex = (round(tipIndex[0]-0.5*roiSize), round(tipIndex[1]-0.5*roiSize), 0)
-    self.roiFilter.SetIndex(roiIndex)
+    startTime = entries['timestamp'][0] if len(entries) else 0.0
+    for entry in entries:
+      for i in range(3):
+        transformMatrix.SetElement(i, 3, float(entry['tipRAS'][i]))
+      transformNode.SetMatrixTransformToParent(transformMatrix)
+      sequenceNode.SetDataNodeAtValue(transformNode, '%.3f' % (entry['timestamp'] - startTime))
+    browserNode = slicer.util.getFirstNodeByName(name + 'Browser')
+    if browserNode is None or browserNode.GetClassName() != 'vtkMRMLSequenceBrowserNode':
+      browserNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSequenceBrowserNode', name + 'Browser')
+      browserNode.AddSynchronizedSequenceNode(sequenceNode)
+    return sequenceNode
 
-    try:
-      sitk_roi = self.roiFilter.Execute(sitk_diff_p)
-    except:
-      print('Invalid ROI')
-      return False
-    sitk_roi = self.phaseRescaleFilter.Execute(sitk_roi)
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_roi, 'debug_roi', debugFlag)    
-    
-    ####################################
-    ##                                ##
-    ## Step 4: Image gradient         ##
-    ##                                ##
-    ####################################
-    
-    # 3D Gradient Filter only works with >=4 slices
-    # Perform 2D gradient instead
-    gradientFilter = sitk.GradientMagnitudeRecursiveGaussianImageFilter()
-    sitk_phaseGradient = gradientFilter.Execute(sitk_roi[:,:,sliceIndex])
-    sitk_phaseGradient = self.phaseRescaleFilter.Execute(sitk_phaseGradient)
-    
-    # Plot
-    if debugFlag:
-      # Put slice in the volume
-      sitk_phaseGradientVolume = self.createBlankItk(sitk_roi, type=sitk.sitkFloat32)
-      sitk_phaseGradientVolume[:,:,sliceIndex] = sitk_phaseGradient
-      self.pushitkToSlicer(sitk_phaseGradientVolume, 'debug_phase_gradient', debugFlag)    
+  # Reprocess recorded first/second sequence nodes against the saved baseline with new settings, in worker processes
+  # Writes <name>_trajectory.csv and <name>_diagnostics.json to outputDirectory (see SimpleNeedleTrackingLib.Batch)
+  # tipPrediction: transform node of the tip prediction used for every frame
+  # Other keyword arguments are passed to NeedleTrackingEngine.track (roiSize, blobThreshold, errorThreshold, unwrapMode, ...)
+  # Returns (results, diagnostics)
+  def reprocessSequences(self, firstSequenceNode, secondSequenceNode, tipPrediction, outputDirectory, numberOfWorkers=None, **trackArguments):
+    if self.baselineFrame is None:
+      raise ValueError('Mag/Phase base images were not initialized')
+    (base_first, base_second, base_geometry, base_mask, inputMode) = self.baselineFrame
+    frames = []
+    for index in range(min(firstSequenceNode.GetNumberOfDataNodes(), secondSequenceNode.GetNumberOfDataNodes())):
+      firstVolume = firstSequenceNode.GetNthDataNode(index)
+      secondVolume = secondSequenceNode.GetNthDataNode(index)
+      frames.append((slicer.util.arrayFromVolume(firstVolume), slicer.util.arrayFromVolume(secondVolume), self.getVolumeGeometry(firstVolume)))
+    recording = SimpleNeedleTrackingLib.Recording((base_first, base_second, base_geometry), frames, base_mask, self.getTipRAS(tipPrediction), name=firstSequenceNode.GetName())
+    (results, diagnostics) = SimpleNeedleTrackingLib.reprocessRecording(recording, numberOfWorkers=numberOfWorkers, inputMode=inputMode, **trackArguments)
+    os.makedirs(outputDirectory, exist_ok=True)
+    SimpleNeedleTrackingLib.writeTrajectory(os.path.join(outputDirectory, '%s_trajectory.csv' % recording.name), results)
+    with open(os.path.join(outputDirectory, '%s_diagnostics.json' % recording.name), 'w') as diagnosticsFile:
+      json.dump(diagnostics, diagnosticsFile, indent=2)
+    return (results, diagnostics)
 
-    ####################################
-    ##                                ##
-    ## Step 5: Blob detection         ##
-    ##                                ##
-    ####################################
+  # Set tracked tip node position (RAS) of a needle, keeping orientation from the reference transform node
+  def publishTip(self, tipRAS, referenceNode=None, needleIndex=0):
+    transformMatrix = vtk.vtkMatrix4x4()
+    if referenceNode is not None:
+      referenceNode.GetMatrixTransformToWorld(transformMatrix)
+    transformMatrix.SetElement(0,3, tipRAS[0])
+    transformMatrix.SetElement(1,3, tipRAS[1])
+    transformMatrix.SetElement(2,3, tipRAS[2])
+    self.getTrackedTipNode(needleIndex).SetMatrixTransformToParent(transformMatrix)
 
-    # Threshold roi to create blobs
-    sitk_blobs = (sitk_phaseGradient > blobThreshold)
-    # Put slice in the volume
-    sitk_blobsVolume = self.createBlankItk(sitk_roi, sitk_blobs.GetPixelID())
-    sitk_blobsVolume[:,:,sliceIndex] = sitk_blobs
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_blobsVolume, 'debug_blobs', debugFlag)  
-          
-    # Label blobs
-    stats = sitk.LabelShapeStatisticsImageFilter()
-    stats.Execute(sitk.ConnectedComponent(sitk_blobsVolume))
-
-    # Get blobs sizes and centroid physical coordinates
-    labels_size = []
-    labels_centroid = []
-    labels_depth = []
-    for l in stats.GetLabels():
-        if debugFlag:
-            print('Label %s: -> Size: %s, Center: %s, Flatness: %s, Elongation: %s' %(l, stats.GetNumberOfPixels(l), stats.GetCentroid(l), stats.GetFlatness(l), stats.GetElongation(l)))
-        if (stats.GetElongation(l) < 4): 
-            labels_size.append(stats.GetNumberOfPixels(l))
-            labels_centroid.append(stats.GetCentroid(l))    
-            labels_depth.append(stats.GetCentroid(l)[2])
+  ####################################
+  ##                                ##
+  ## Background tracking            ##
+  ##                                ##
+  ####################################
 
-    ####################################
-    ##                                ##
-    ## Step 6: Get tip physical point ##
-    ##                                ##
-    ####################################
-    # Check number of centroids found
-    if len(labels_size)>15:
-      print('Too many centroids, probably noise')
+  # Start background tracking
+  # execution: 'Thread' (worker thread) or 'Process' (pool of worker processes, debug images and rolling baseline are not available)
+  # multiPlane: worker processes also track the planes of multi-plane tracking
+  def startScheduler(self, execution='Thread', multiPlane=False):
+    self.stopScheduler()
+    if execution == 'Process':
+      planeBaselines = self.planeBaselineFrames if multiPlane else None
+      self.scheduler = SimpleNeedleTrackingLib.TrackingProcessPool(self.baselineFrame, warmUpArguments=self.warmUpArguments, planeBaselines=planeBaselines)
+    else:
+      self.scheduler = SimpleNeedleTrackingLib.LatestFrameScheduler(self.processScheduledFrame)
+    self.scheduler.start()
+
+  # Stop background tracking
+  def stopScheduler(self):
+    if self.scheduler is not None:
+      self.scheduler.stop()
+
+  # Snapshot the current frame and queue it for background tracking (main thread)
+  # Same parameters as getNeedle. A frame still waiting in the queue is dropped
+  def submitNeedle(self, firstVolume, secondVolume, sliceIndex, tipPrediction, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipDetector='Blobs'):
+    if not self.engine.isInitialized():
+      print('ERROR: Mag/Phase base images were not initialized')    
       return False
-    # Reasonable number of centroids: get the largest one
-    try:
-      sorted_by_size = np.argsort(labels_size) 
-      first_largest = sorted_by_size[-1]
-      # second_largest = sorted_by_size[-2]
-    except:
-      print('No centroids found')
+    # Skip the frame when the cycles are late even with degraded settings (frame budget)
+    if self.frameBudget.skipFrame():
+      self.recordSkippedFrame()
       return False
-    
-    # Check centroid size with respect to ROI size
-    if (labels_size[first_largest] > 0.5*roiSize*0.5*roiSize):
-      print('Centroid too big, probably noise')
+    # Increment sequence counter
+    self.count += 1
+    startTime = time.perf_counter()
+    # Debug output only on sampled frames
+    debugFlag = debugFlag and self.debugWriter.isSampled(self.count)
+    # Degrade the settings when the cycles are late (frame budget)
+    (debugFlag, roiSize, unwrapMode, degradations) = self.frameBudget.apply(debugFlag, roiSize, unwrapMode)
+    # Get images from MRML volume nodes
+    # Worker processes receive a copy in shared memory: pass node voxel views
+    # Worker thread: snapshots (the node voxels may change while the frame is waiting)
+    snapshot = not isinstance(self.scheduler, SimpleNeedleTrackingLib.TrackingProcessPool)
+    (numpy_first, geometry) = self.getFrameFromVolume(firstVolume, snapshot)
+    (numpy_second, _) = self.getFrameFromVolume(secondVolume, snapshot)
+    frame = {
+      'count': self.count,
+      'tipPrediction': tipPrediction,
+      'startTime': startTime,
+      'pullTime': 1000*(time.perf_counter() - startTime),
+      'debug': debugFlag,
+      'degradations': degradations,
+      'reacquire': self.isTrackLost(),
+      'first': numpy_first,
+      'second': numpy_second,
+      'geometry': geometry,
+      'args': (self.getPredictedTipRAS(tipPrediction, startTime), sliceIndex, self.getPredictedROISize(roiSize, geometry, startTime), blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+      }
+    self.scheduler.submit(frame)
+    return True
+
+  # Snapshot the current frame and queue it for multi-needle background tracking (main thread)
+  # Same parameters as getNeedles
+  def submitNeedles(self, firstVolume, secondVolume, sliceIndex, tipPredictions, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipDetector='Blobs'):
+    if not self.engine.isInitialized():
+      print('ERROR: Mag/Phase base images were not initialized')    
       return False
-    
-    # # Get significantly bigger centroid
-    # if (labels_size[first_largest] > 3.5*labels_size[second_largest]):
-    #   label_index = first_largest
-    # else: # Get centroid further inserted
-    #   label_index = labels_depth.index(max(labels_depth))
-
-    # Get selected centroid center
-    # center = labels_centroid[label_index]
-    center = labels_centroid[first_largest]
-    # Convert to 3D Slicer coordinates (RAS)
-    centerRAS = (-center[0], -center[1], center[2])
-
-    # Plot
-    if debugFlag:
-      # print('Chosen label: %i' %(label_index+1))
-      print('Chosen label: %i' %(first_largest+1))
-      print(centerRAS)
-
-    # Calculate prediction error
-    predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
-    # Check error threshold
-    if(predError>errorThreshold):
-      print('Tip too far from prediction: Err = %f' %predError)
+    # Skip the frame when the cycles are late even with degraded settings (frame budget)
+    if self.frameBudget.skipFrame():
+      self.recordSkippedFrame(len(tipPredictions))
       return False
-    
-    # Push coordinates to tip Node
-    transformMatrix.SetElement(0,3, centerRAS[0])
-    transformMatrix.SetElement(1,3, centerRAS[1])
-    transformMatrix.SetElement(2,3, centerRAS[2])
-    self.tipTrackedNode.SetMatrixTransformToParent(transformMatrix)
+    # Increment sequence counter
+    self.count += 1
+    startTime = time.perf_counter()
+    # Debug output only on sampled frames
+    debugFlag = debugFlag and self.debugWriter.isSampled(self.count)
+    # Degrade the settings when the cycles are late (frame budget)
+    (debugFlag, roiSize, unwrapMode, degradations) = self.frameBudget.apply(debugFlag, roiSize, unwrapMode)
+    # Get images from MRML volume nodes (worker thread: snapshots, see submitNeedle)
+    snapshot = not isinstance(self.scheduler, SimpleNeedleTrackingLib.TrackingProcessPool)
+    (numpy_first, geometry) = self.getFrameFromVolume(firstVolume, snapshot)
+    (numpy_second, _) = self.getFrameFromVolume(secondVolume, snapshot)
+    tipRASList = [self.getPredictedTipRAS(tipPredictions[0], startTime)] + [self.getTipRAS(tipPrediction) for tipPrediction in tipPredictions[1:]]
+    frame = {
+      'count': self.count,
+      'tipPredictions': tipPredictions,
+      'startTime': startTime,
+      'pullTime': 1000*(time.perf_counter() - startTime),
+      'debug': debugFlag,
+      'degradations': degradations,
+      'first': numpy_first,
+      'second': numpy_second,
+      'geometry': geometry,
+      'args': (tipRASList, sliceIndex, self.getPredictedROISize(roiSize, geometry, startTime), blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+      }
+    self.scheduler.submit(frame)
+    return True
 
+  # Snapshot the current frames of all planes and queue them for background tracking (main thread)
+  # Same parameters as getNeedleMultiPlane
+  def submitNeedleMultiPlane(self, planeVolumes, tipPrediction, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend='Reliability', tipDetector='Blobs'):
+    if not self.multiPlaneTracker.isInitialized():
+      print('ERROR: Mag/Phase base images were not initialized')    
+      return False
+    # Skip the frame when the cycles are late even with degraded settings (frame budget)
+    if self.frameBudget.skipFrame():
+      self.recordSkippedFrame()
+      return False
+    # Increment sequence counter
+    self.count += 1
+    startTime = time.perf_counter()
+    # Debug output only on sampled frames
+    debugFlag = debugFlag and self.debugWriter.isSampled(self.count)
+    # Degrade the settings when the cycles are late (frame budget)
+    (debugFlag, roiSize, unwrapMode, degradations) = self.frameBudget.apply(debugFlag, roiSize, unwrapMode)
+    # Get images from MRML volume nodes (worker thread: snapshots, see submitNeedle)
+    snapshot = not isinstance(self.scheduler, SimpleNeedleTrackingLib.TrackingProcessPool)
+    planes = {}
+    for (planeName, firstVolume, secondVolume) in planeVolumes:
+      (numpy_first, geometry) = self.getFrameFromVolume(firstVolume, snapshot)
+      (numpy_second, _) = self.getFrameFromVolume(secondVolume, snapshot)
+      planes[planeName] = (numpy_first, numpy_second, geometry)
+    frame = {
+      'count': self.count,
+      'tipPrediction': tipPrediction,
+      'startTime': startTime,
+      'pullTime': 1000*(time.perf_counter() - startTime),
+      'debug': debugFlag,
+      'degradations': degradations,
+      'planes': planes,
+      'args': (self.getPredictedTipRAS(tipPrediction, startTime), self.getPredictedROISize(roiSize, planes[planeVolumes[0][0]][2], startTime), blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+      }
+    self.scheduler.submit(frame)
     return True
+
+  # Run tracking pipeline on a queued frame (worker thread)
+  def processScheduledFrame(self, frame):
+    self.debugFrameIndex = frame['count']
+    if 'planes' in frame:
+      result = self.multiPlaneTracker.track(frame['planes'], *frame['args'])
+    elif 'tipPredictions' in frame:
+      result = self.engine.trackNeedles(frame['first'], frame['second'], frame['geometry'], *frame['args'])
+      self.maintainBaseline(frame['first'], frame['second'], frame['geometry'], result, frame['args'][5])
+    else:
+      track = self.engine.reacquire if frame['reacquire'] else self.engine.track
+      result = track(frame['first'], frame['second'], frame['geometry'], *frame['args'])
+      self.maintainBaseline(frame['first'], frame['second'], frame['geometry'], [result], frame['args'][5])
+    if frame['debug']:
+      self.debugWriter.endFrame(frame['count'])
+    return result
+
+  # Publish results finished by the worker thread/processes (main thread)
+  # Returns the list of new tracking results
+  def publishScheduledResults(self):
+    while self.pendingDebugImages:
+      (sitkImage, name) = self.pendingDebugImages.popleft()
+      self.pushitkToSlicer(sitkImage, name)
+    if self.scheduler is None:
+      return []
+    results = []
+    for (frame, result) in self.scheduler.popResults():
+      # Multi-needle frames have one result per needle
+      if 'tipPredictions' in frame:
+        for needleResult in result:
+          needleResult.degradations = frame['degradations']
+        self.updateTipPredictor(result[0], frame['startTime'])
+        self.publishNeedles(result, frame['tipPredictions'])
+        self.recordTimings(result, frame['pullTime'], frame['startTime'], frame['count'])
+        results.extend(result)
+        continue
+      result.degradations = frame['degradations']
+      self.updateTipPredictor(result, frame['startTime'])
+      self.updateReacquisition(result, frame['tipPrediction'])
+      if result:
+        self.publishTip(result.tipRAS, frame['tipPrediction'])
+      self.recordTimings([result], frame['pullTime'], frame['startTime'], frame['count'])
+      results.append(result)
+    return results
+
+  # Get number of processed and dropped frames (frames skipped for the frame budget are dropped)
+  def getFrameCounters(self, background=False):
+    if background and (self.scheduler is not None):
+      return (self.scheduler.processedCount, self.scheduler.droppedCount + self.frameBudget.skippedCount)
+    return (self.count or 0, self.frameBudget.skippedCount)
+
+  # Start writing synthetic frames into the real-time volumes at rate (fps), for load testing
+  # Frames are built on the baseline volumes (geometry and background) with a needle tip moving along the control points
+  # of pathNode at speed (mm/s). The second volume is written last, so each frame triggers one tracking cycle.
+  # The true tip is published to the 'SyntheticTipTransform' node.
+  def startSyntheticFrames(self, firstBaselineVolume, secondBaselineVolume, firstVolume, secondVolume, pathNode, rate, speed, phaseNoise=0.05):
+    self.stopSyntheticFrames()
+    path = [pathNode.GetNthControlPointPositionWorld(i) for i in range(pathNode.GetNumberOfControlPoints())]
+    if not path:
+      print('Synthetic frames: the tip path has no control points')
+      return False
+    (numpy_first, geometry) = self.getFrameFromVolume(firstBaselineVolume)
+    (numpy_second, _) = self.getFrameFromVolume(secondBaselineVolume)
+    self.syntheticGenerator = SimpleNeedleTrackingLib.SyntheticFrameGenerator(geometry, np.shape(numpy_second), path, speed, numpy_first, numpy_second, phaseNoise=phaseNoise)
+    # Real-time volumes take the baseline geometry
+    for (volume, baselineVolume) in ((firstVolume, firstBaselineVolume), (secondVolume, secondBaselineVolume)):
+      volume.CopyOrientation(baselineVolume)
+    self.syntheticVolumes = (firstVolume, secondVolume)
+    self.syntheticTipNode = slicer.util.getFirstNodeByName('SyntheticTipTransform')
+    if self.syntheticTipNode is None:
+      self.syntheticTipNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'SyntheticTipTransform')
+    self.syntheticFrameCount = 0
+    self.syntheticStartTime = time.perf_counter()
+    self.syntheticTimer.setInterval(max(1, int(round(1000.0/rate))))
+    self.syntheticTimer.start()
+    return True
+
+  def stopSyntheticFrames(self):
+    self.syntheticTimer.stop()
+
+  def isSyntheticFramesRunning(self):
+    return self.syntheticTimer.isActive()
+
+  # Write the synthetic frame of the current time into the real-time volumes
+  def writeSyntheticFrame(self):
+    if self.syntheticGenerator is None:
+      return
+    (numpy_first, numpy_second, tipRAS) = self.syntheticGenerator.generate(time.perf_counter() - self.syntheticStartTime)
+    transformMatrix = vtk.vtkMatrix4x4()
+    for i in range(3):
+      transformMatrix.SetElement(i, 3, tipRAS[i])
+    self.syntheticTipNode.SetMatrixTransformToParent(transformMatrix)
+    (firstVolume, secondVolume) = self.syntheticVolumes
+    slicer.util.updateVolumeFromArray(firstVolume, numpy_first)
+    slicer.util.updateVolumeFromArray(secondVolume, numpy_second)
+    self.syntheticFrameCount += 1
+
+  # Get synthetic frames written and achieved frame rate (fps)
+  def getSyntheticFrameCounters(self):
+    if self.syntheticStartTime is None:
+      return (0, 0.0)
+    elapsed = time.perf_counter() - self.syntheticStartTime
+    return (self.syntheticFrameCount, self.syntheticFrameCount/elapsed if elapsed > 0 else 0.0)
@@ -0,0 +1,209 @@
+import argparse
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from .Benchmark import Recording, loadRecording
+from .Detection import TIP_DETECTORS
+from .History import TrackingHistory
+from .Profiling import LatencyStatistics, OutcomeStatistics
+from .TrackingEngine import NeedleTrackingEngine, FrameGeometry, REASON_NAMES
+
+
+################################################################################################################################################
+# Sequences
+################################################################################################################################################
+
+# Read a sequence file (Slicer .seq.nrrd or 4D image)
+# Slicer writes the frame axis as a 'list' axis, read as vector components; a 4D image has the frames along the last axis
+# Returns (list of frame arrays (slice, row, column), geometry)
+def readSequenceFile(path):
+  sitkSequence = sitk.ReadImage(path)
+  if sitkSequence.GetDimension() == 4:
+    array = sitk.GetArrayFromImage(sitkSequence)
+    size = sitkSequence.GetSize()
+    direction = np.array(sitkSequence.GetDirection()).reshape(4, 4)[:3, :3]
+    geometry = FrameGeometry(sitkSequence.GetOrigin()[:3], sitkSequence.GetSpacing()[:3], direction.flatten())
+    return ([array[index] for index in range(size[3])], geometry)
+  array = sitk.GetArrayFromImage(sitkSequence)
+  if sitkSequence.GetNumberOfComponentsPerPixel() == 1:
+    array = array[..., None]
+  if sitkSequence.GetDimension() == 2:
+    array = array[None]
+  return ([array[..., index] for index in range(array.shape[-1])], FrameGeometry.fromImage(sitkSequence))
+
+# Load first/second sequence files as a recording
+# baselineIndex: frame used as baseline (the other frames are tracked)
+# maskPath: optional mask image (e.g. Segmentation.seg.nrrd)
+def loadSequenceRecording(firstPath, secondPath, baselineIndex=0, maskPath=None, predictionRAS=None):
+  (firstFrames, geometry) = readSequenceFile(firstPath)
+  (secondFrames, _) = readSequenceFile(secondPath)
+  if len(firstFrames) != len(secondFrames):
+    raise ValueError('Sequences have different numbers of frames: %d and %d' % (len(firstFrames), len(secondFrames)))
+  if not (0 <= baselineIndex < len(firstFrames)) or len(firstFrames) < 2:
+    raise ValueError('No baseline or image frames found in %s' % firstPath)
+  frames = [(first, second, geometry) for (index, (first, second)) in enumerate(zip(firstFrames, secondFrames)) if index != baselineIndex]
+  mask = sitk.GetArrayFromImage(sitk.ReadImage(maskPath)).astype(np.uint8) if maskPath else None
+  name = os.path.basename(firstPath).split('.')[0]
+  return Recording((firstFrames[baselineIndex], secondFrames[baselineIndex], geometry), frames, mask, predictionRAS, name=name)
+
+# Read per-frame tip predictions (RAS) from a CSV file: predictionRAS_R/A/S columns (tracking history export) or R, A, S columns
+# Rows of other needles (needle column) are skipped
+def readPredictions(path):
+  predictions = []
+  with open(path, newline='') as csvFile:
+    for row in csv.DictReader(csvFile):
+      if int(row.get('needle') or 0) != 0:
+        continue
+      keys = ('predictionRAS_R', 'predictionRAS_A', 'predictionRAS_S') if 'predictionRAS_R' in row else ('R', 'A', 'S')
+      predictions.append(tuple(float(row[key]) for key in keys))
+  return predictions
+
+
+################################################################################################################################################
+# Worker process side
+################################################################################################################################################
+
+# Tracking engine and track() settings of the worker process
+_batchEngine = None
+_batchSettings = None
+
+# Create worker engine with the baseline: (first, second, geometry, mask, inputMode)
+def _initializeBatchWorker(baseline, settings):
+  global _batchEngine, _batchSettings
+  _batchEngine = NeedleTrackingEngine()
+  _batchEngine.setBaseline(*baseline)
+  _batchSettings = dict(settings)
+
+# Track one frame: (index, first, second, geometry, predictionRAS, sliceIndex) -> (index, result)
+# sliceIndex None: slice containing the prediction
+def _trackBatchFrame(job):
+  (index, first, second, geometry, predictionRAS, sliceIndex) = job
+  if sliceIndex is None:
+    sliceIndex = int(np.clip(round(geometry.getIndexFromRAS(predictionRAS)[2]), 0, np.shape(second)[0]-1))
+  return (index, _batchEngine.track(first, second, geometry, predictionRAS, sliceIndex, **_batchSettings))
+
+
+################################################################################################################################################
+# Batch reprocessing
+################################################################################################################################################
+
+# Track every frame of a recording with the given settings, in parallel across worker processes
+# predictions: tip prediction (RAS) of each frame (default: recording prediction for all frames)
+# sliceIndex: None to use the slice containing the prediction of each frame
+# numberOfWorkers: worker processes (default: one per core), 1 to track in this process
+# Other keyword arguments are passed to NeedleTrackingEngine.track (roiSize, blobThreshold, errorThreshold, unwrapMode, ...)
+# Frames are independent (each one against the baseline), so they are distributed in chunks of frames.
+# Returns (results in frame order, diagnostics dict (JSON-serializable))
+def reprocessRecording(recording, predictions=None, sliceIndex=None, numberOfWorkers=None, inputMode='MagPhase', chunkSize=None, **trackArguments):
+  settings = {'roiSize': 30, 'blobThreshold': 2.0, 'errorThreshold': 15.0}
+  settings.update(trackArguments)
+  settings['inputMode'] = inputMode
+  if predictions is None:
+    predictions = [tuple(recording.predictionRAS or (0.0, 0.0, 0.0))]*len(recording.frames)
+  if len(predictions) < len(recording.frames):
+    raise ValueError('%d tip predictions for %d frames' % (len(predictions), len(recording.frames)))
+  numberOfWorkers = max(1, min(numberOfWorkers or os.cpu_count() or 1, len(recording.frames)))
+  chunkSize = chunkSize or max(1, len(recording.frames)//(4*numberOfWorkers))
+  baseline = tuple(recording.baseline) + (recording.mask, inputMode)
+  jobs = [(index, first, second, geometry, tuple(predictions[index]), sliceIndex) for (index, (first, second, geometry)) in enumerate(recording.frames)]
+
+  start = time.perf_counter()
+  if numberOfWorkers == 1:
+    _initializeBatchWorker(baseline, settings)
+    indexedResults = [_trackBatchFrame(job) for job in jobs]
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfWorkers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_initializeBatchWorker, initargs=(baseline, settings)) as executor:
+      indexedResults = list(executor.map(_trackBatchFrame, jobs, chunksize=chunkSize))
+  elapsed = time.perf_counter() - start
+  results = [result for (_, result) in sorted(indexedResults, key=lambda item: item[0])]
+
+  # Diagnostics: outcome counts and stage latency over the frames
+  statistics = LatencyStatistics(windowSize=max(1, len(results)))
+  for result in results:
+    statistics.add(result.timings)
+  outcomes = OutcomeStatistics(windowSize=max(1, len(results)))
+  for result in results:
+    outcomes.add(result)
+  diagnostics = {
+    'recording': recording.name,
+    'settings': dict(settings, sliceIndex=sliceIndex),
+    'frames': len(results),
+    'workers': numberOfWorkers,
+    'elapsed': elapsed,
+    'fps': len(results)/elapsed if elapsed > 0 else None,
+    'successRate': outcomes.getSuccessRate(),
+    'reasons': {REASON_NAMES.get(reason, 'Unknown'): count for (reason, count, _) in outcomes.getCounts()},
+    'latency': {stage: {'count': count, 'mean': mean, 'p50': p50, 'p95': p95, 'max': maximum}
+                for (stage, count, mean, p50, p95, maximum) in statistics.getStatistics()},
+  }
+  return (results, diagnostics)
+
+# Write the trajectory (one row per frame, tracking history CSV format; frame is the index in the recording)
+def writeTrajectory(path, results):
+  history = TrackingHistory(capacity=max(1, len(results)))
+  for (index, result) in enumerate(results):
+    history.add(result, 0.0, index)
+  if os.path.splitext(path)[1].lower() in ('.h5', '.hdf5'):
+    history.exportHDF5(path)
+  else:
+    history.exportCSV(path)
+
+
+# Command line batch reprocessing:
+#   python -m SimpleNeedleTrackingLib.Batch ../2023_07_21_Insertion --output-dir reprocessed --roi-size 40
+#   python -m SimpleNeedleTrackingLib.Batch --sequences M.seq.nrrd P.seq.nrrd --prediction -7.6 -15.2 34 --output-dir reprocessed
+# Writes <name>_trajectory.csv and <name>_diagnostics.json for every recording
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Reprocess recorded insertions with new tracking settings, in parallel across cores')
+  parser.add_argument('recordings', nargs='*', help='Recording directories (SRC Baseline/Image M/P <n>.nrrd frame pairs)')
+  parser.add_argument('--sequences', nargs=2, metavar=('FIRST', 'SECOND'), help='First/second sequence files (.seq.nrrd) instead of a directory')
+  parser.add_argument('--baseline-index', type=int, default=0, help='Sequence frame used as baseline (default 0)')
+  parser.add_argument('--mask', help='Mask image for sequences')
+  parser.add_argument('--prediction', type=float, nargs=3, metavar=('R', 'A', 'S'), help='Tip prediction (RAS) for all frames (default: Pred.mrk.json of the recording)')
+  parser.add_argument('--predictions', help='CSV file with one tip prediction per frame (tracking history export or R, A, S columns)')
+  parser.add_argument('--output-dir', default='.', help='Output directory')
+  parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per core)')
+  parser.add_argument('--input-mode', choices=('MagPhase', 'RealImag'), default='MagPhase')
+  parser.add_argument('--slice', type=int, default=None, help='Slice index (default: slice of the tip prediction)')
+  parser.add_argument('--roi-size', type=int, default=30)
+  parser.add_argument('--blob-threshold', type=float, default=2.0)
+  parser.add_argument('--error-threshold', type=float, default=15.0)
+  parser.add_argument('--unwrap-mode', choices=('Full', 'ROI'), default='Full')
+  parser.add_argument('--difference-mode', choices=('Unwrapped', 'Complex'), default='Unwrapped')
+  parser.add_argument('--unwrap-backend', default='Reliability')
+  parser.add_argument('--tip-detector', choices=TIP_DETECTORS, default='Blobs')
+  args = parser.parse_args(argv)
+  if not args.recordings and not args.sequences:
+    parser.error('Give recording directories or --sequences')
+
+  recordings = [loadRecording(directory) for directory in args.recordings]
+  if args.sequences:
+    recordings.append(loadSequenceRecording(args.sequences[0], args.sequences[1], args.baseline_index, args.mask))
+  predictions = readPredictions(args.predictions) if args.predictions else None
+  os.makedirs(args.output_dir, exist_ok=True)
+  for recording in recordings:
+    if args.prediction:
+      recording.predictionRAS = tuple(args.prediction)
+    (results, diagnostics) = reprocessRecording(recording, predictions, args.slice, args.workers, args.input_mode, roiSize=args.roi_size, blobThreshold=args.blob_threshold,
+                                                errorThreshold=args.error_threshold, unwrapMode=args.unwrap_mode, differenceMode=args.difference_mode, unwrapBackend=args.unwrap_backend,
+                                                tipDetector=args.tip_detector)
+    trajectoryPath = os.path.join(args.output_dir, '%s_trajectory.csv' % recording.name)
+    diagnosticsPath = os.path.join(args.output_dir, '%s_diagnostics.json' % recording.name)
+    writeTrajectory(trajectoryPath, results)
+    diagnostics['trajectory'] = trajectoryPath
+    with open(diagnosticsPath, 'w') as diagnosticsFile:
+      json.dump(diagnostics, diagnosticsFile, indent=2)
+    print('%s: %d frames in %.2f s (%.1f fps, %d workers), success %.0f%%, trajectory %s' % (
+      recording.name, diagnostics['frames'], diagnostics['elapsed'], diagnostics['fps'] or 0, diagnostics['workers'], 100*(diagnostics['successRate'] or 0), trajectoryPath))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,267 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import SimpleITK as sitk
+
+from math import sqrt, pow
+
+from .Detection import TIP_DETECTORS
+from .Profiling import LatencyStatistics
+from .TrackingEngine import NeedleTrackingEngine, readFramePair
+
+try:
+  import resource
+except ImportError:  # Not available on Windows
+  resource = None
+
+
+################################################################################################################################################
+# Recordings
+################################################################################################################################################
+
+# Recorded insertion: baseline frame pair, image frame pairs, optional mask and markups (see loadRecording)
+class Recording:
+
+  def __init__(self, baseline, frames, mask=None, predictionRAS=None, referenceRAS=None, name=''):
+    self.baseline = baseline            # (first, second, geometry)
+    self.frames = frames                # [(first, second, geometry)]
+    self.mask = mask                    # Array with non-zero values inside the tracking region (None: whole image)
+    self.predictionRAS = predictionRAS  # Tip prediction used to center the ROI (RAS)
+    self.referenceRAS = referenceRAS    # Reference tip position to measure the tip error (RAS)
+    self.name = name
+
+
+# Get parent transform file of each markups file from the scene file: {markups file name: transform file name}
+def readMarkupsTransforms(scenePath):
+  nodes = {}
+  for element in ElementTree.parse(scenePath).getroot():
+    nodes[element.get('id')] = element
+  def getReference(element, role):
+    match = re.search(r'(?:^|;)%s:([^;]+)' % role, element.get('references') or '')
+    return nodes.get(match.group(1)) if match else None
+  transforms = {}
+  for element in nodes.values():
+    markupsStorage = getReference(element, 'storage')
+    transform = getReference(element, 'transform')
+    if (markupsStorage is None) or (transform is None) or not element.tag.startswith('Markups'):
+      continue
+    transformStorage = getReference(transform, 'storage')
+    if transformStorage is not None:
+      transforms[markupsStorage.get('fileName')] = transformStorage.get('fileName')
+  return transforms
+
+# Read first control point of a markups file (RAS), moved by the parent transform file (ITK convention) if given
+def readMarkupsPosition(markupsPath, transformPath=None):
+  with open(markupsPath) as markupsFile:
+    markups = json.load(markupsFile)['markups'][0]
+  position = markups['controlPoints'][0]['position']
+  if markups.get('coordinateSystem', 'LPS') == 'RAS':
+    position = (-position[0], -position[1], position[2])
+  if transformPath is not None:
+    # ITK transform files store the transform from the parent: move the point to the parent with the inverse
+    position = sitk.ReadTransform(transformPath).GetInverse().TransformPoint(tuple(float(v) for v in position))
+  return (-position[0], -position[1], position[2])
+
+# Check if a transform file (ITK convention) does not move any point
+def isIdentityTransform(transformPath):
+  transform = sitk.ReadTransform(transformPath)
+  points = ((0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0))
+  return all(np.allclose(transform.TransformPoint(point), point) for point in points)
+
+# Get the reason why a reference tip markups cannot be used as ground truth (None: usable)
+# Recorded scenes save the tracked tip as a point at the origin under the tracked tip transform: that is the last output
+# of the tracker itself (not a ground truth), and it is meaningless when the transform was saved as identity.
+def getReferenceProblem(markupsPath, transformPath=None):
+  if transformPath is not None:
+    if os.path.splitext(os.path.basename(transformPath))[0] == 'CurrentTrackedTipTransform':
+      return 'its parent is the tracked tip transform (tracker output)'
+    if isIdentityTransform(transformPath):
+      return 'its parent transform is identity'
+  if np.allclose(readMarkupsPosition(markupsPath), 0.0):
+    return 'its point is at the origin'
+  return None
+
+# Load a recording directory:
+#   SRC Baseline M <n>.nrrd / SRC Baseline P <n>.nrrd: baseline pair (first one)
+#   SRC Image M <n>.nrrd / SRC Image P <n>.nrrd: image pairs, in frame number order
+#   Segmentation.seg.nrrd (optional): mask
+#   Pred.mrk.json / Tip.mrk.json (optional): tip prediction and reference tip, moved by their parent transforms of the scene (*.mrml)
+#   The reference tip is skipped with a warning when it is not a ground truth (see getReferenceProblem)
+def loadRecording(directory):
+  def findPairs(kind):
+    pairs = []
+    for firstPath in glob.glob(os.path.join(directory, 'SRC %s M *.nrrd' % kind)):
+      number = re.search(r' M (\d+)\.nrrd$', firstPath)
+      if number is None:
+        continue
+      secondPath = os.path.join(directory, 'SRC %s P %s.nrrd' % (kind, number.group(1)))
+      if os.path.exists(secondPath):
+        pairs.append((int(number.group(1)), firstPath, secondPath))
+    return [readFramePair(firstPath, secondPath) for (_, firstPath, secondPath) in sorted(pairs)]
+  baselines = findPairs('Baseline')
+  frames = findPairs('Image')
+  if not baselines or not frames:
+    raise ValueError('No baseline or image frames found in %s' % directory)
+
+  maskPath = os.path.join(directory, 'Segmentation.seg.nrrd')
+  mask = sitk.GetArrayFromImage(sitk.ReadImage(maskPath)).astype(np.uint8) if os.path.exists(maskPath) else None
+
+  transforms = {}
+  for scenePath in glob.glob(os.path.join(directory, '*.mrml')):
+    transforms.update(readMarkupsTransforms(scenePath))
+  def readMarkups(fileName, reference=False):
+    path = os.path.join(directory, fileName)
+    if not os.path.exists(path):
+      return None
+    transformPath = os.path.join(directory, transforms[fileName]) if fileName in transforms else None
+    problem = getReferenceProblem(path, transformPath) if reference else None
+    if problem is not None:
+      logging.warning('%s not used as reference tip: %s' % (path, problem))
+      return None
+    return readMarkupsPosition(path, transformPath)
+
+  return Recording(baselines[0], frames, mask, readMarkups('Pred.mrk.json'), readMarkups('Tip.mrk.json', reference=True), os.path.basename(os.path.normpath(directory)))
+
+
+################################################################################################################################################
+# Benchmark
+################################################################################################################################################
+
+# Get process memory peak (MB) from the OS (None if not available)
+def getProcessMemoryPeak():
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak/(1024*1024) if sys.platform == 'darwin' else peak/1024  # bytes on macOS, kB on Linux
+
+# Replay a recording through the tracking engine
+# repeats: number of passes over the frames (timings of all passes are collected)
+# sliceIndex: None to use the slice containing the tip prediction
+# Other keyword arguments are passed to NeedleTrackingEngine.track (roiSize, blobThreshold, errorThreshold, unwrapMode, ...)
+# Returns a JSON-serializable dict
+def runBenchmark(recording, repeats=3, sliceIndex=None, predictionRAS=None, **trackArguments):
+  settings = {'roiSize': 30, 'blobThreshold': 2.0, 'errorThreshold': 15.0}
+  settings.update(trackArguments)
+  predictionRAS = tuple(predictionRAS or recording.predictionRAS or (0.0, 0.0, 0.0))
+  (base_first, base_second, geometry) = recording.baseline
+  if sliceIndex is None:
+    sliceIndex = int(np.clip(round(geometry.getIndexFromRAS(predictionRAS)[2]), 0, np.shape(base_second)[0]-1))
+
+  # Baseline (with memory tracing: allocations of the pipeline)
+  engine = NeedleTrackingEngine()
+  tracemalloc.start()
+  engine.setBaseline(base_first, base_second, geometry, recording.mask)
+  results = [engine.track(first, second, frameGeometry, predictionRAS, sliceIndex, **settings) for (first, second, frameGeometry) in recording.frames]
+  (_, tracedPeak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  # Timed passes
+  statistics = LatencyStatistics(windowSize=repeats*len(recording.frames))
+  start = time.perf_counter()
+  for repeat in range(repeats):
+    for (first, second, frameGeometry) in recording.frames:
+      statistics.add(engine.track(first, second, frameGeometry, predictionRAS, sliceIndex, **settings).timings)
+  elapsed = time.perf_counter() - start
+
+  # Tip error against the reference tip
+  tipErrors = []
+  if recording.referenceRAS is not None:
+    for result in results:
+      if result.tipRAS is not None:
+        tipErrors.append(sqrt(sum(pow(result.tipRAS[i] - recording.referenceRAS[i], 2) for i in range(3))))
+
+  return {
+    'recording': recording.name,
+    'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version(),
+                'numpy': np.__version__, 'simpleitk': sitk.Version.VersionString(), 'cpus': os.cpu_count()},
+    'settings': dict(settings, sliceIndex=sliceIndex, predictionRAS=predictionRAS, repeats=repeats),
+    'frames': len(recording.frames),
+    'fps': repeats*len(recording.frames)/elapsed if elapsed > 0 else None,
+    'latency': {stage: {'count': count, 'mean': mean, 'p50': p50, 'p95': p95, 'max': maximum}
+                for (stage, count, mean, p50, p95, maximum) in statistics.getStatistics()},
+    'memory': {'tracedPeakMB': tracedPeak/(1024*1024), 'processPeakMB': getProcessMemoryPeak()},
+    'tracking': {
+      'successRate': float(np.mean([bool(result) for result in results])),
+      'messages': [result.message for result in results],
+      'tips': [result.tipRAS for result in results],
+      'referenceRAS': recording.referenceRAS,
+      'tipErrorMean': float(np.mean(tipErrors)) if tipErrors else None,
+      'tipErrorMax': float(np.max(tipErrors)) if tipErrors else None,
+    },
+  }
+
+# Compare a benchmark result with a previous one
+# Returns list of regression messages: frame rate lower or total latency (p95) higher than the tolerance (fraction)
+def compareBenchmarks(current, previous, tolerance=0.2):
+  regressions = []
+  if current['fps'] and previous['fps'] and (current['fps'] < (1 - tolerance)*previous['fps']):
+    regressions.append('Frame rate dropped from %.1f to %.1f fps' % (previous['fps'], current['fps']))
+  (currentTotal, previousTotal) = (current['latency'].get('Total'), previous['latency'].get('Total'))
+  if currentTotal and previousTotal and (currentTotal['p95'] > (1 + tolerance)*previousTotal['p95']):
+    regressions.append('Total latency (p95) rose from %.1f to %.1f ms' % (previousTotal['p95'], currentTotal['p95']))
+  return regressions
+
+
+# Command line benchmark on recording directories:
+#   python -m SimpleNeedleTrackingLib.Benchmark ../2023_07_21_Insertion --output benchmark.json [--compare previous.json]
+#   python -m SimpleNeedleTrackingLib.Benchmark ../2023_07_21_Insertion --reference -6.3 -15.2 37.4
+# Exits with status 1 when a regression is found against the compared results
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Replay recorded insertions through the tracking engine and report frame rate, latency, memory and tip error')
+  parser.add_argument('recordings', nargs='+', help='Recording directories')
+  parser.add_argument('--output', help='Write results to this JSON file')
+  parser.add_argument('--compare', help='Previous JSON results to check for regressions')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown (default 0.2)')
+  parser.add_argument('--repeats', type=int, default=3)
+  parser.add_argument('--reference', type=float, nargs=3, metavar=('R', 'A', 'S'), help='Ground truth tip (RAS) for the tip error (default: Tip.mrk.json of the recording, if it is a ground truth)')
+  parser.add_argument('--slice', type=int, default=None, help='Slice index (default: slice of the tip prediction)')
+  parser.add_argument('--roi-size', type=int, default=30)
+  parser.add_argument('--blob-threshold', type=float, default=2.0)
+  parser.add_argument('--error-threshold', type=float, default=15.0)
+  parser.add_argument('--unwrap-mode', choices=('Full', 'ROI'), default='Full')
+  parser.add_argument('--difference-mode', choices=('Unwrapped', 'Complex'), default='Unwrapped')
+  parser.add_argument('--unwrap-backend', default='Reliability')
+  parser.add_argument('--tip-detector', choices=TIP_DETECTORS, default='Blobs')
+  args = parser.parse_args(argv)
+
+  benchmarks = []
+  for directory in args.recordings:
+    recording = loadRecording(directory)
+    if args.reference:
+      recording.referenceRAS = tuple(args.reference)
+    benchmark = runBenchmark(recording, args.repeats, args.slice, roiSize=args.roi_size, blobThreshold=args.blob_threshold,
+                             errorThreshold=args.error_threshold, unwrapMode=args.unwrap_mode, differenceMode=args.difference_mode, unwrapBackend=args.unwrap_backend,
+                             tipDetector=args.tip_detector)
+    benchmarks.append(benchmark)
+    print('%s: %d frames, %.1f fps, total p95 %.1f ms, traced memory peak %.1f MB, success %.0f%%, tip error %s' % (
+      benchmark['recording'], benchmark['frames'], benchmark['fps'], benchmark['latency']['Total']['p95'], benchmark['memory']['tracedPeakMB'],
+      100*benchmark['tracking']['successRate'], ('%.2f mm' % benchmark['tracking']['tipErrorMean']) if benchmark['tracking']['tipErrorMean'] is not None else 'n/a'))
+  if args.output:
+    with open(args.output, 'w') as outputFile:
+      json.dump(benchmarks, outputFile, indent=2)
+
+  if args.compare:
+    with open(args.compare) as compareFile:
+      previousBenchmarks = {benchmark['recording']: benchmark for benchmark in json.load(compareFile)}
+    regressions = []
+    for benchmark in benchmarks:
+      if benchmark['recording'] in previousBenchmarks:
+        regressions += ['%s: %s' % (benchmark['recording'], message) for message in compareBenchmarks(benchmark, previousBenchmarks[benchmark['recording']], args.tolerance)]
+    for message in regressions:
+      print('REGRESSION ' + message)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,159 @@
+import collections
+import math
+import time
+
+
+################################################################################################################################################
+# Frame budget
+################################################################################################################################################
+
+# Degradation steps, applied in this order while the tracking cycles are late (bit mask of the steps applied to an attempt)
+DEGRADATION_SKIP_DEBUG = 1    # No debug images
+DEGRADATION_LOCAL_UNWRAP = 2  # Unwrap only a window around the ROI ('ROI' unwrap mode)
+DEGRADATION_SHRINK_ROI = 4    # Smaller ROI
+DEGRADATION_SKIP_FRAMES = 8   # Track only one frame out of n (skipped frames have no attempt, see REASON_SKIPPED)
+DEGRADATION_NAMES = collections.OrderedDict([
+  (DEGRADATION_SKIP_DEBUG, 'SkipDebug'),
+  (DEGRADATION_LOCAL_UNWRAP, 'LocalUnwrap'),
+  (DEGRADATION_SHRINK_ROI, 'ShrinkROI'),
+  (DEGRADATION_SKIP_FRAMES, 'SkipFrames'),
+])
+
+# Get the names of the steps in a degradation bit mask
+def getDegradationNames(degradations):
+  return [name for (step, name) in DEGRADATION_NAMES.items() if degradations & step]
+
+
+# Keeps tracking cycles within a per-frame time budget (ms) by degrading the tracking settings in a fixed order.
+# The cycle durations (from volume ingest to published tip) are smoothed (exponential average); when the average is
+# over the budget the degradation level goes up by one step, when it is below recoverRatio*budget it goes down by one.
+# After each change the level is held for holdCycles cycles, so the effect of the change is measured first.
+# Level n applies the first n steps of DEGRADATION_NAMES.
+# At the last level (frame skipping) one frame out of skipInterval is tracked. Skipping does not shorten the cycles,
+# so this level is driven by throughput instead: skipInterval starts at ceil(average/budget), goes up while the cycles
+# are longer than the time between tracked frames (backlog) and down while tracking one more frame would still take
+# less than recoverRatio of that time. With skipInterval back to 1, the level goes down as the other levels do.
+# budget: None or 0 to disable
+class FrameBudgetController:
+
+  def __init__(self, budget=None, smoothing=0.3, recoverRatio=0.7, holdCycles=3, roiScale=0.7, minimumROISize=15):
+    self.budget = budget
+    self.smoothing = smoothing
+    self.recoverRatio = recoverRatio
+    self.holdCycles = holdCycles
+    self.roiScale = roiScale
+    self.minimumROISize = minimumROISize
+    self.reset()
+
+  # Clear level and counters
+  def reset(self):
+    self.level = 0
+    self.averageDuration = None
+    self.heldCycles = 0
+    self.frameIndex = 0
+    self.skipInterval = 1
+    self.lastTrackedTime = None
+    self.averageTrackedInterval = None  # Time between tracked frames (ms, smoothed), at the last level
+    self.resetCounts()
+
+  # Clear counters (the level is kept)
+  def resetCounts(self):
+    self.skippedCount = 0
+    self.counts = collections.OrderedDict((step, 0) for step in DEGRADATION_NAMES)  # Attempts (or skipped frames) per step
+
+  # Set the budget (ms, None or 0 to disable); the level is kept
+  def setBudget(self, budget):
+    self.budget = budget
+    if not budget:
+      self.level = 0
+
+  # Add the duration (ms) of a finished cycle and update the degradation level
+  def addCycle(self, duration):
+    if self.averageDuration is None:
+      self.averageDuration = duration
+    else:
+      self.averageDuration += self.smoothing*(duration - self.averageDuration)
+    if not self.budget:
+      return
+    self.heldCycles += 1
+    if self.heldCycles < self.holdCycles:
+      return
+    if (self.level == len(DEGRADATION_NAMES)) and (self.averageTrackedInterval is not None):
+      # Frame skipping: throughput
+      if self.averageDuration > self.averageTrackedInterval:
+        self.setSkipInterval(self.skipInterval + 1)
+        return
+      if (self.skipInterval > 1) and (self.averageDuration < self.recoverRatio*self.averageTrackedInterval*(self.skipInterval - 1)/self.skipInterval):
+        self.setSkipInterval(self.skipInterval - 1)
+        return
+      if self.skipInterval > 1:
+        return
+    if (self.averageDuration > self.budget) and (self.level < len(DEGRADATION_NAMES)):
+      self.level += 1
+      self.heldCycles = 0
+      if self.level == len(DEGRADATION_NAMES):
+        self.skipInterval = max(1, math.ceil(self.averageDuration/self.budget))
+        self.lastTrackedTime = None
+        self.averageTrackedInterval = None
+    elif (self.averageDuration < self.recoverRatio*self.budget) and (self.level > 0):
+      self.level -= 1
+      self.heldCycles = 0
+
+  # Change the number of frames per tracked frame (last level); the measured time between tracked frames is scaled to match
+  def setSkipInterval(self, skipInterval):
+    self.averageTrackedInterval *= skipInterval/self.skipInterval
+    self.skipInterval = skipInterval
+    self.heldCycles = 0
+
+  # Check if an incoming frame has to be skipped (last level only): one frame out of skipInterval is tracked
+  # timestamp: arrival time of the frame (s, time.perf_counter() by default), to measure the time between tracked frames
+  def skipFrame(self, timestamp=None):
+    if not self.budget or (self.level < len(DEGRADATION_NAMES)):
+      self.frameIndex = 0
+      return False
+    skip = (self.frameIndex % self.skipInterval) != 0
+    self.frameIndex += 1
+    if skip:
+      self.skippedCount += 1
+      self.counts[DEGRADATION_SKIP_FRAMES] += 1
+      return True
+    if timestamp is None:
+      timestamp = time.perf_counter()
+    if self.lastTrackedTime is not None:
+      interval = 1000*(timestamp - self.lastTrackedTime)
+      if self.averageTrackedInterval is None:
+        self.averageTrackedInterval = interval
+      else:
+        self.averageTrackedInterval += self.smoothing*(interval - self.averageTrackedInterval)
+    self.lastTrackedTime = timestamp
+    return False
+
+  # Degrade the settings of an attempt for the current level
+  # Returns (debugFlag, roiSize, unwrapMode, degradations (bit mask of the steps that changed a setting))
+  def apply(self, debugFlag, roiSize, unwrapMode):
+    degradations = 0
+    if self.budget:
+      if (self.level >= 1) and debugFlag:
+        debugFlag = False
+        degradations |= DEGRADATION_SKIP_DEBUG
+      if (self.level >= 2) and (unwrapMode != 'ROI'):
+        unwrapMode = 'ROI'
+        degradations |= DEGRADATION_LOCAL_UNWRAP
+      if (self.level >= 3) and (roiSize > self.minimumROISize):
+        roiSize = max(self.minimumROISize, int(round(self.roiScale*roiSize)))
+        degradations |= DEGRADATION_SHRINK_ROI
+    for step in DEGRADATION_NAMES:
+      if degradations & step:
+        self.counts[step] += 1
+    # Frames skipped before this one (counted by skipFrame)
+    if self.budget and (self.level >= len(DEGRADATION_NAMES)):
+      degradations |= DEGRADATION_SKIP_FRAMES
+    return (debugFlag, roiSize, unwrapMode, degradations)
+
+  # Get the steps of the current level (bit mask)
+  def getDegradations(self):
+    return sum(list(DEGRADATION_NAMES)[:self.level]) if self.budget else 0
+
+  # Get counters: list of (step name, attempts degraded by the step or frames skipped)
+  def getCounts(self):
+    return [(DEGRADATION_NAMES[step], count) for (step, count) in self.counts.items()]
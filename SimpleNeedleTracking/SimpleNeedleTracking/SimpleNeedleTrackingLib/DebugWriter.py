@@ -0,0 +1,93 @@
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+import SimpleITK as sitk
+
+
+################################################################################################################################################
+# Debug image writer
+################################################################################################################################################
+
+# Writes the intermediate images of a frame into one compressed NumPy archive (debug_<frame>.npz) in a background thread.
+# Each image is stored as <name> (array) with <name>_origin, <name>_spacing and <name>_direction (LPS).
+# Frames are queued in a bounded queue: when the writer falls behind, new frames are dropped instead of blocking tracking.
+# With sampling N only every Nth frame is captured.
+class DebugImageWriter:
+
+  def __init__(self, path, sampling=1, maxQueueSize=8):
+    self.path = path
+    self.sampling = max(1, int(sampling))
+    self.queue = queue.Queue(maxsize=maxQueueSize)
+    self.lock = threading.Lock()
+    self.frames = {}  # frame index -> [(name, sitkImage)]
+    self.thread = None
+    # Frame counters
+    self.writtenCount = 0
+    self.droppedCount = 0
+
+  # Check if frame should be captured
+  def isSampled(self, frameIndex):
+    if not isinstance(frameIndex, int):
+      return True
+    return (frameIndex % self.sampling) == 0
+
+  # Add intermediate image to a frame
+  def add(self, frameIndex, name, sitkImage):
+    with self.lock:
+      self.frames.setdefault(frameIndex, []).append((name, sitkImage))
+
+  # Queue all images of a frame for writing
+  def endFrame(self, frameIndex):
+    with self.lock:
+      images = self.frames.pop(frameIndex, None)
+    if not images:
+      return
+    self.start()
+    try:
+      self.queue.put_nowait((frameIndex, images))
+    except queue.Full:
+      self.droppedCount += 1
+      logging.warning('Debug writer queue full, frame %s dropped' % str(frameIndex))
+
+  # Start writer thread
+  def start(self):
+    if (self.thread is not None) and self.thread.is_alive():
+      return
+    self.thread = threading.Thread(target=self.run, name='NeedleTrackingDebugWriter', daemon=True)
+    self.thread.start()
+
+  # Write queued frames and stop writer thread
+  def stop(self):
+    if (self.thread is None) or not self.thread.is_alive():
+      return
+    self.queue.put(None)
+    self.thread.join()
+    self.thread = None
+
+  # Writer loop
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      (frameIndex, images) = item
+      try:
+        self.writeFrame(frameIndex, images)
+        self.writtenCount += 1
+      except Exception:
+        logging.exception('Could not write debug images of frame %s' % str(frameIndex))
+
+  # Write images of one frame into a compressed archive
+  def writeFrame(self, frameIndex, images):
+    os.makedirs(self.path, exist_ok=True)
+    arrays = {}
+    for (name, sitkImage) in images:
+      arrays[name] = sitk.GetArrayFromImage(sitkImage)
+      arrays[name + '_origin'] = np.array(sitkImage.GetOrigin())
+      arrays[name + '_spacing'] = np.array(sitkImage.GetSpacing())
+      arrays[name + '_direction'] = np.array(sitkImage.GetDirection())
+    fileName = ('debug_%06d.npz' % frameIndex) if isinstance(frameIndex, int) else ('debug_%s.npz' % frameIndex)
+    np.savez_compressed(os.path.join(self.path, fileName), **arrays)
@@ -0,0 +1,137 @@
+import numpy as np
+
+
+################################################################################################################################################
+# Tip detectors
+################################################################################################################################################
+
+# Tip detectors of NeedleTrackingEngine.detectTip:
+#   'Blobs': gradient magnitude, threshold and connected components, largest round blob (steps 4-6)
+#   'Template': FFT cross-correlation with a bank of oriented needle tip templates (TemplateMatchingDetector)
+TIP_DETECTORS = ('Blobs', 'Template')
+
+
+# Finds the needle tip in a 2D ROI of the phase difference by cross-correlation with a bank of tip templates.
+# Two phase patterns are used around the tip for each radius R of dipoleRadii (mm), zero inside R (signal void) and cut
+# at extent*R:
+#   even: (R/r)^3 * (3*cos(theta)^2 - 1), the in-plane pattern of a susceptibility dipole (as in SyntheticFrameGenerator)
+#   odd:  (R/r)^2 * cos(theta), one positive and one negative lobe (seen in recorded insertions)
+# with the axis rotated to numberOfOrientations angles over 180 degrees (the field direction projected on the
+# image plane is not known). Each template is made zero-mean and unit-norm over its support.
+# The ROI is correlated with all templates at once: one rfft2 of the ROI and one batched irfft2 of its products with the
+# cached template spectra, so the cost only depends on the ROI size. The score is the correlation in units of the ROI
+# standard deviation (matched filter: strong needle lobes score higher than smooth background of the same shape).
+# The tip is the peak of |score| over positions and templates (sign-agnostic, refined to sub-pixel by a parabola fit).
+# Peaks below the minimum score are rejected. The minimum score is minimumScore when given, otherwise backgroundRatio
+# times the background score: the highest score over background ROIs of the tracked anatomy (see calibrate; the
+# engine uses tiles of its base phase inside the mask), so that smooth background structures are rejected whatever
+# the images. Background outside the calibrated region (air, image border) is left to the prediction error check.
+class TemplateMatchingDetector:
+
+  def __init__(self, dipoleRadii=(1.5, 3.0), extent=3.0, numberOfOrientations=8, minimumScore=None, backgroundRatio=1.15):
+    self.dipoleRadii = tuple(sorted(dipoleRadii))
+    self.extent = extent
+    self.numberOfOrientations = numberOfOrientations
+    self.minimumScore = minimumScore  # Fixed minimum score, None to derive it from the background score
+    self.backgroundRatio = backgroundRatio
+    self.backgroundScore = None  # Highest score over the background ROIs (None before calibrate)
+    # Template spectra of the last ROI size/spacing: ((roiSize, spacing), bank)
+    self.bankCache = None
+
+  # Get template half size (px) along x and y for the pixel spacing (mm), limited to the ROI
+  def getHalfSize(self, roiSize, spacing):
+    return tuple(int(min(max(1, np.ceil(self.extent*max(self.dipoleRadii)/spacing[axis])), roiSize//2)) for axis in range(2))
+
+  # Oriented templates (for each radius, ascending, and angle: even then odd pattern) on a (2*hy+1, 2*hx+1) grid centered
+  # on the tip, and the support mask of the largest radius
+  def createTemplates(self, halfSize, spacing):
+    (hx, hy) = halfSize
+    (y, x) = np.meshgrid(np.arange(-hy, hy+1)*spacing[1], np.arange(-hx, hx+1)*spacing[0], indexing='ij')
+    r2 = np.maximum(x*x + y*y, 1e-12)
+    templates = []
+    for radius in self.dipoleRadii:
+      support = (r2 >= radius**2) & (r2 <= (self.extent*radius)**2)
+      for angle in np.arange(self.numberOfOrientations)*np.pi/self.numberOfOrientations:
+        cos = (x*np.cos(angle) + y*np.sin(angle))/np.sqrt(r2)
+        for pattern in ((radius**2/r2)**1.5*(3*cos*cos - 1), (radius**2/r2)*cos):
+          template = np.where(support, pattern, 0.0)
+          template[support] -= template[support].mean()
+          template /= np.linalg.norm(template)
+          templates.append(template)
+    radius = max(self.dipoleRadii)
+    support = (r2 >= radius**2) & (r2 <= (self.extent*radius)**2)
+    return (np.array(templates), support)
+
+  # Get template spectra for the ROI size and pixel spacing (built again only when they change)
+  # The FFT size leaves room for the template half size around the ROI, so that the correlation does not wrap.
+  # Returns dict: fftShape, halfSize, spectra (conjugate spectra of the templates), counts (support pixels inside the ROI
+  # at each position), supportSize
+  def getBank(self, roiSize, spacing):
+    key = (roiSize, tuple(spacing[:2]))
+    if (self.bankCache is not None) and (self.bankCache[0] == key):
+      return self.bankCache[1]
+    halfSize = self.getHalfSize(roiSize, spacing)
+    (templates, support) = self.createTemplates(halfSize, spacing)
+    fftShape = (roiSize + 2*halfSize[1], roiSize + 2*halfSize[0])
+    # Kernels centered on the origin of the FFT grid: the correlation at index p is the match of a tip at pixel p
+    kernels = np.zeros((len(templates)+1,) + fftShape)
+    kernels[:-1, :2*halfSize[1]+1, :2*halfSize[0]+1] = templates
+    kernels[-1, :2*halfSize[1]+1, :2*halfSize[0]+1] = support
+    kernels = np.roll(kernels, (-halfSize[1], -halfSize[0]), axis=(1, 2))
+    spectra = np.conj(np.fft.rfft2(kernels))
+    counts = np.fft.irfft2(np.fft.rfft2(np.ones((roiSize, roiSize)), fftShape) * spectra[-1], fftShape)[:roiSize, :roiSize]
+    bank = {'fftShape': fftShape, 'halfSize': halfSize, 'spectra': spectra[:-1], 'counts': np.round(counts), 'supportSize': int(support.sum())}
+    self.bankCache = (key, bank)
+    return bank
+
+  # Get the scores of every template at every position of a 2D ROI (row, column) with pixel spacing (mm)
+  # Returns array (template, row, column)
+  def getScores(self, array_roi, spacing):
+    array_roi = np.asarray(array_roi, dtype=float)
+    roiSize = array_roi.shape[0]
+    bank = self.getBank(roiSize, spacing)
+    fftShape = bank['fftShape']
+    array_roi = array_roi - array_roi.mean()
+    # ROI spectrum, then the correlations with all templates (one batched call)
+    correlations = np.fft.irfft2(np.fft.rfft2(array_roi, fftShape) * bank['spectra'], fftShape)[:, :roiSize, :roiSize]
+    scores = np.abs(correlations) / max(float(array_roi.std()), 1e-12)
+    # Positions with the template mostly outside the ROI are not scored
+    scores[:, bank['counts'] < 0.5*bank['supportSize']] = 0
+    return scores
+
+  # Set the background score from 2D background ROIs (same size) with pixel spacing (mm); None without ROIs
+  def calibrate(self, rois, spacing):
+    self.backgroundScore = max((float(self.getScores(array_roi, spacing).max()) for array_roi in rois), default=None)
+
+  # Check if the minimum score is derived from a background score not measured yet
+  def needsCalibration(self):
+    return (self.minimumScore is None) and (self.backgroundScore is None)
+
+  # Get the minimum score of a tip (0 when neither fixed nor calibrated)
+  def getMinimumScore(self):
+    if self.minimumScore is not None:
+      return self.minimumScore
+    return 0.0 if self.backgroundScore is None else self.backgroundRatio*self.backgroundScore
+
+  # Match the templates in a 2D ROI (row, column) with pixel spacing (mm)
+  # Returns (tip pixel (x, y, continuous), score of the peak, template index (see createTemplates), score map of the
+  # best template (row, column)). The tip is None when no position scores the minimum score.
+  def match(self, array_roi, spacing):
+    scores = self.getScores(array_roi, spacing)
+    (template, row, column) = np.unravel_index(np.argmax(scores), scores.shape)
+    scoreMap = scores[template]
+    score = float(scoreMap[row, column])
+    if score < self.getMinimumScore():
+      return (None, score, int(template), scoreMap)
+    tipIndex = (float(column) + self.refinePeak(scoreMap[row, :], column), float(row) + self.refinePeak(scoreMap[:, column], row))
+    return (tipIndex, score, int(template), scoreMap)
+
+  # Sub-pixel offset of a peak from the parabola through the peak and its neighbors (0 at the border)
+  def refinePeak(self, values, index):
+    if (index == 0) or (index == len(values) - 1):
+      return 0.0
+    (left, center, right) = values[index-1:index+2]
+    curvature = left - 2*center + right
+    if curvature >= 0:
+      return 0.0
+    return float(np.clip(0.5*(left - right)/curvature, -0.5, 0.5))
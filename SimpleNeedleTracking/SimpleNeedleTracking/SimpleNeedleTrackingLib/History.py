@@ -0,0 +1,131 @@
+import csv
+import threading
+
+import numpy as np
+
+from .TrackingEngine import REASON_NAMES
+
+try:
+  import h5py
+except ImportError:  # HDF5 export is optional
+  h5py = None
+
+
+################################################################################################################################################
+# Tracking history
+################################################################################################################################################
+
+# Fixed-capacity ring buffer of the tracking attempts, backed by one NumPy structured array.
+# Adding an attempt only writes one row (no allocation); when full, the oldest attempts are overwritten.
+# Stage durations (ms) are stored in one column per stage, registered on first use (up to maximumStages, NaN when absent).
+# Missing positions are NaN, missing blob sizes -1, missing reason codes -1.
+class TrackingHistory:
+
+  def __init__(self, capacity=10000, maximumStages=24):
+    self.capacity = capacity
+    self.maximumStages = maximumStages
+    self.dtype = np.dtype([
+      ('timestamp', np.float64),         # Time of the attempt (s, epoch)
+      ('frame', np.int64),               # Frame counter
+      ('needle', np.int8),               # Needle index (multi-needle tracking)
+      ('success', np.bool_),
+      ('reason', np.int8),               # Reason code (REASON_*)
+      ('predictionRAS', np.float32, 3),  # Predicted tip (RAS)
+      ('tipRAS', np.float32, 3),         # Detected tip (RAS)
+      ('predError', np.float32),         # Distance between prediction and detection (mm)
+      ('blobSize', np.int32),            # Size of the chosen blob (px)
+      ('degradations', np.uint8),        # Settings degraded to keep up with the frame budget (DEGRADATION_* bit mask)
+      ('timings', np.float32, maximumStages),
+    ])
+    self.entries = np.zeros(capacity, dtype=self.dtype)
+    self.lock = threading.Lock()
+    self.reset()
+
+  # Remove all attempts
+  def reset(self):
+    with self.lock:
+      self.stages = []      # Stage name of each timings column
+      self.stageIndex = {}  # Stage name -> timings column
+      self.count = 0        # Attempts added since the reset (the buffer holds the last 'capacity' ones)
+
+  def __len__(self):
+    return min(self.count, self.capacity)
+
+  # Add one tracking attempt (TrackingResult) with its stage durations (default: result.timings)
+  def add(self, result, timestamp, frame, timings=None, needle=0):
+    if timings is None:
+      timings = result.timings
+    with self.lock:
+      entry = self.entries[self.count % self.capacity]
+      entry['timestamp'] = timestamp
+      entry['frame'] = -1 if frame is None else frame
+      entry['needle'] = needle
+      entry['success'] = bool(result)
+      entry['reason'] = -1 if result.reason is None else result.reason
+      entry['predictionRAS'] = np.nan if result.predictionRAS is None else result.predictionRAS
+      entry['tipRAS'] = np.nan if result.tipRAS is None else result.tipRAS
+      entry['predError'] = np.nan if result.predError is None else result.predError
+      entry['blobSize'] = -1 if result.blobSize is None else result.blobSize
+      entry['degradations'] = result.degradations
+      row = entry['timings']
+      row[:] = np.nan
+      for (stage, duration) in timings.items():
+        column = self.stageIndex.get(stage)
+        if column is None:
+          if len(self.stages) >= self.maximumStages:
+            continue
+          column = len(self.stages)
+          self.stages.append(stage)
+          self.stageIndex[stage] = column
+        row[column] = duration
+      self.count += 1
+
+  # Get a copy of the stored attempts, oldest first, and the stage names of the timings columns
+  def getEntries(self):
+    with self.lock:
+      if self.count <= self.capacity:
+        entries = self.entries[:self.count].copy()
+      else:
+        start = self.count % self.capacity
+        entries = np.concatenate((self.entries[start:], self.entries[:start]))
+      return (entries, list(self.stages))
+
+  # Get the stored attempts as columns: {name: array}, one 'Timing <stage>' column per stage
+  def getColumns(self):
+    (entries, stages) = self.getEntries()
+    columns = {}
+    for name in ('timestamp', 'frame', 'needle', 'success', 'reason'):
+      columns[name] = entries[name]
+    for name in ('predictionRAS', 'tipRAS'):
+      for (axis, axisName) in enumerate('RAS'):
+        columns['%s_%s' % (name, axisName)] = entries[name][:, axis]
+    for name in ('predError', 'blobSize', 'degradations'):
+      columns[name] = entries[name]
+    for (column, stage) in enumerate(stages):
+      columns['Timing %s' % stage] = entries['timings'][:, column]
+    return columns
+
+  # Write the stored attempts to CSV (one row per attempt, reason codes also written by name)
+  def exportCSV(self, path):
+    columns = self.getColumns()
+    names = list(columns.keys())
+    with open(path, 'w', newline='') as csvFile:
+      writer = csv.writer(csvFile)
+      writer.writerow(names[:5] + ['reasonName'] + names[5:])
+      for row in range(len(columns['timestamp'])):
+        values = [columns[name][row] for name in names]
+        reasonName = REASON_NAMES.get(int(columns['reason'][row]), '')
+        writer.writerow(['%.6f' % values[0]] + [int(value) for value in values[1:5]] + [reasonName] +
+                        [('%g' % value) if np.isfinite(value) else '' for value in values[5:]])
+
+  # Write the stored attempts to HDF5 (requires h5py): dataset 'history' (structured array),
+  # stage names of the timings columns and reason code names as attributes
+  def exportHDF5(self, path):
+    if h5py is None:
+      raise ImportError('h5py is required to export the tracking history to HDF5')
+    (entries, stages) = self.getEntries()
+    with h5py.File(path, 'w') as h5File:
+      dataset = h5File.create_dataset('history', data=entries, compression='gzip')
+      dataset.attrs['stages'] = stages
+      dataset.attrs['reasonCodes'] = list(REASON_NAMES.keys())
+      dataset.attrs['reasonNames'] = list(REASON_NAMES.values())
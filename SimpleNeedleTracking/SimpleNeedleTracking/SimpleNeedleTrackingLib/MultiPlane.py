@@ -0,0 +1,175 @@
+import collections
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+
+from math import sqrt, pow
+
+from .Profiling import StageTimer
+from .TrackingEngine import NeedleTrackingEngine, TrackingResult, REASON_SUCCESS, REASON_NOT_INITIALIZED, REASON_TOO_FAR, REASON_NO_TIP
+
+
+################################################################################################################################################
+# Plane fusion
+################################################################################################################################################
+
+# Plane normal (RAS) from frame geometry (LPS direction, slice axis)
+def getPlaneNormalRAS(geometry):
+  direction = geometry.direction
+  return np.array((-direction[2], -direction[5], direction[8]))
+
+# Plane normal (RAS) of a frame, None for multi-slice frames (they constrain all 3 coordinates)
+# shape: frame array shape (slice, row, column)
+def getFramePlaneNormalRAS(geometry, shape):
+  return getPlaneNormalRAS(geometry) if (shape[0] == 1) else None
+
+# Fuse tips detected in several planes into one 3D point (RAS)
+# Each single-slice plane only constrains the tip in its own plane: the fused tip is the point whose
+# projection on every plane is closest (least squares) to the plane tip.
+# Multi-slice planes constrain all 3 coordinates.
+# Directions not constrained by any plane keep the prediction.
+# planeTips: list of (tipRAS, normalRAS or None for multi-slice planes)
+def fusePlaneTips(planeTips, predictionRAS, regularization=1e-6):
+  system = regularization*np.eye(3)
+  rhs = regularization*np.asarray(predictionRAS, dtype=float)
+  for (tipRAS, normalRAS) in planeTips:
+    if normalRAS is None:
+      projection = np.eye(3)
+    else:
+      normal = np.asarray(normalRAS, dtype=float)
+      normal = normal / np.linalg.norm(normal)
+      projection = np.eye(3) - np.outer(normal, normal)
+    system += projection
+    rhs += projection @ np.asarray(tipRAS, dtype=float)
+  return tuple(float(v) for v in np.linalg.solve(system, rhs))
+
+# Fuse the results of the planes into result: tip (see fusePlaneTips), blob size, prediction error check, message and reason
+# planeResults: {plane name: TrackingResult}, planeNormals: {plane name: plane normal (RAS) or None (multi-slice plane)}
+# Used by MultiPlaneTracker and by the process pool (planes tracked as separate tasks, fused on the main thread)
+def fusePlaneResults(result, planeResults, planeNormals, tipRAS, errorThreshold):
+  result.planeResults = planeResults
+  planeTips = [(planeResult.tipRAS, planeNormals[planeName]) for (planeName, planeResult) in planeResults.items() if planeResult]
+  if not planeTips:
+    result.message = 'No tip found in any plane (%s)' % '; '.join('%s: %s' % (planeName, planeResult.message) for (planeName, planeResult) in planeResults.items())
+    result.reason = REASON_NO_TIP
+    return result
+  centerRAS = fusePlaneTips(planeTips, tipRAS)
+  result.tipRAS = centerRAS
+  result.blobSize = sum(planeResult.blobSize for planeResult in planeResults.values() if planeResult)
+
+  # Calculate prediction error
+  predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
+  result.predError = predError
+  # Check error threshold
+  if(predError>errorThreshold):
+    result.message = 'Tip too far from prediction: Err = %f' %predError
+    result.reason = REASON_TOO_FAR
+    return result
+
+  result.success = True
+  result.message = 'Tracking successful (%i of %i planes)' % (len(planeTips), len(planeResults))
+  result.reason = REASON_SUCCESS
+  return result
+
+
+################################################################################################################################################
+# Multi-plane tracker
+################################################################################################################################################
+
+# Tracks the tip in several planes (e.g. interleaved axial, sagittal and coronal acquisitions) at once.
+# Each plane has its own engine and baseline. Planes are tracked concurrently in a thread pool and
+# the plane tips are fused into one 3D tip (see fusePlaneTips).
+class MultiPlaneTracker:
+
+  def __init__(self):
+    self.engines = collections.OrderedDict()  # plane name -> NeedleTrackingEngine
+    self.executor = None
+    # Called with (sitkImage, name) for each intermediate image when debugFlag is set (name ends with the plane name)
+    self.debugCallback = None
+    self.debugImages = []
+    self.stageTimer = None
+    self.baselineTimings = {}
+
+  # Remove all planes
+  def clear(self):
+    self.engines.clear()
+
+  # Update the base images of a plane (the plane is added if needed)
+  def setBaseline(self, planeName, first, second, geometry, mask=None, inputMode='MagPhase', debugFlag=False):
+    if planeName not in self.engines:
+      self.engines[planeName] = NeedleTrackingEngine()
+    engine = self.engines[planeName]
+    engine.debugCallback = (lambda sitkImage, name: self.debugImages.append((sitkImage, '%s_%s' % (name, planeName.replace(' ', '')))))
+    engine.setBaseline(first, second, geometry, mask, inputMode, debugFlag)
+    self.baselineTimings = engine.baselineTimings
+    self.pushDebugImages()
+
+  # Check if base images were set for every plane
+  def isInitialized(self):
+    return (len(self.engines) > 0) and all(engine.isInitialized() for engine in self.engines.values())
+
+  # Send intermediate images collected from the planes to the debug callback (calling thread)
+  def pushDebugImages(self):
+    while self.debugImages:
+      (sitkImage, name) = self.debugImages.pop(0)
+      if self.debugCallback is not None:
+        self.debugCallback(sitkImage, name)
+
+  # Run one tracking cycle on dummy frames of every plane (e.g. the baseline frames) and discard the result, so that every
+  # plane engine (and the slice engines of multi-slice planes) is warm for the first frame (see NeedleTrackingEngine.warmUp)
+  # tipRAS: tip prediction of the first frames (None: center of the first plane). The duration is added to baselineTimings ('Warm-up')
+  def warmUp(self, frames, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipRAS=None, tipDetector=None):
+    if not self.isInitialized():
+      return None
+    startTime = time.perf_counter()
+    if tipRAS is None:
+      engine = next(iter(self.engines.values()))
+      (columns, rows, slices) = engine.sitk_base_p.GetSize()
+      tipRAS = engine.geometry.getRASFromIndex((0.5*columns, 0.5*rows, slices//2))
+    result = self.track(frames, tipRAS, roiSize, blobThreshold, errorThreshold, inputMode, False, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+    self.baselineTimings = dict(self.baselineTimings)
+    self.baselineTimings['Warm-up'] = 1000*(time.perf_counter() - startTime)
+    return result
+
+  # Track the tip in all planes concurrently and fuse the plane tips
+  # frames: {plane name: (first, second, geometry)}, planes without frame are skipped
+  # Single-slice planes are tracked in their slice, multi-slice planes in all slices.
+  # Stage durations are the longest of the planes, 'Planes' is the wall time of the parallel part.
+  def track(self, frames, tipRAS, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipDetector=None):
+    result = TrackingResult(predictionRAS=tuple(tipRAS))
+    if not self.isInitialized():
+      result.message = 'ERROR: Mag/Phase base images were not initialized'
+      result.reason = REASON_NOT_INITIALIZED
+      return result
+    self.stageTimer = StageTimer()
+    if self.executor is None:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(self.engines), os.cpu_count() or 1), thread_name_prefix='NeedleTrackingPlane')
+    planeNames = [planeName for planeName in self.engines if planeName in frames]
+    futures = []
+    for planeName in planeNames:
+      (first, second, geometry) = frames[planeName]
+      futures.append(self.executor.submit(self.engines[planeName].track, first, second, geometry, tipRAS, None,
+                                          roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector))
+    planeResults = collections.OrderedDict((planeName, future.result()) for (planeName, future) in zip(planeNames, futures))
+    self.stageTimer.mark('Planes')
+    for planeResult in planeResults.values():
+      self.stageTimer.merge(planeResult.timings)
+    with self.stageTimer.exclude('Debug'):
+      self.pushDebugImages()
+
+    # Fuse plane tips
+    planeNormals = {}
+    for planeName in planeNames:
+      (_, second, geometry) = frames[planeName]
+      planeNormals[planeName] = getFramePlaneNormalRAS(geometry or self.engines[planeName].geometry, np.shape(second))
+    fusePlaneResults(result, planeResults, planeNormals, tipRAS, errorThreshold)
+    return self.finishResult(result)
+
+  # Record the fusion and the total time of the cycle into the result
+  def finishResult(self, result):
+    self.stageTimer.mark('Fuse')
+    result.timings = self.stageTimer.total()
+    self.stageTimer = None
+    return result
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+################################################################################################################################################
+# Tip predictor
+################################################################################################################################################
+
+# Constant-velocity Kalman filter on the accepted tip positions (RAS, mm; timestamps in s)
+# The three axes share the same motion model, so they share one 2x2 (position, velocity) covariance.
+# processNoise: spectral density of the random acceleration ((mm/s^2)^2 s)
+# measurementNoise: standard deviation of the detected tip position (mm)
+# The track is dropped when no tip was accepted for longer than timeout (s).
+class TipPredictor:
+
+  def __init__(self, processNoise=50.0, measurementNoise=1.0, initialVelocity=10.0, timeout=2.0):
+    self.processNoise = processNoise
+    self.measurementNoise = measurementNoise
+    self.initialVelocity = initialVelocity
+    self.timeout = timeout
+    self.reset()
+
+  # Drop the track
+  def reset(self):
+    self.state = None       # (3, 2): position and velocity of each axis
+    self.covariance = None  # (2, 2)
+    self.timestamp = None   # Time of the last accepted tip
+    self.updateCount = 0
+
+  # Check if the predictor has a track (at least two accepted tips, not timed out)
+  def isInitialized(self, timestamp=None):
+    if (self.state is None) or (self.updateCount < 2):
+      return False
+    if (timestamp is not None) and (timestamp - self.timestamp > self.timeout):
+      return False
+    return True
+
+  # State transition and process noise over dt
+  def getTransition(self, dt):
+    transition = np.array(((1.0, dt), (0.0, 1.0)))
+    noise = self.processNoise*np.array(((dt**3/3, dt**2/2), (dt**2/2, dt)))
+    return (transition, noise)
+
+  # Add an accepted tip
+  def update(self, tipRAS, timestamp):
+    measurement = np.asarray(tipRAS, dtype=float)
+    if (self.state is None) or (timestamp - self.timestamp > self.timeout):
+      self.state = np.stack((measurement, np.zeros(3)), axis=1)
+      self.covariance = np.diag((self.measurementNoise**2, self.initialVelocity**2))
+      self.timestamp = timestamp
+      self.updateCount = 1
+      return
+    # Predict
+    (transition, noise) = self.getTransition(max(timestamp - self.timestamp, 0.0))
+    state = self.state @ transition.T
+    covariance = transition @ self.covariance @ transition.T + noise
+    # Correct (position measurement)
+    gain = covariance[:, 0] / (covariance[0, 0] + self.measurementNoise**2)
+    innovation = measurement - state[:, 0]
+    self.state = state + np.outer(innovation, gain)
+    self.covariance = covariance - np.outer(gain, covariance[0, :])
+    self.timestamp = timestamp
+    self.updateCount += 1
+
+  # Predicted tip position (RAS) at timestamp
+  def predict(self, timestamp):
+    dt = max(timestamp - self.timestamp, 0.0)
+    return tuple(float(v) for v in self.state[:, 0] + dt*self.state[:, 1])
+
+  # Standard deviation (mm) of the predicted position of each axis at timestamp
+  def getUncertainty(self, timestamp):
+    (transition, noise) = self.getTransition(max(timestamp - self.timestamp, 0.0))
+    covariance = transition @ self.covariance @ transition.T + noise
+    return float(np.sqrt(covariance[0, 0]))
+
+  # ROI size (px) covering the prediction uncertainty
+  # Shrinks from maximumSize towards minimumSize while the track is stable; grows back when tips are missed
+  # spacing: in-plane pixel spacing (mm), numberOfSigmas: half ROI width in standard deviations
+  def getROISize(self, timestamp, maximumSize, spacing, minimumSize=15, numberOfSigmas=3.0):
+    if not self.isInitialized(timestamp):
+      return maximumSize
+    size = minimumSize + 2*numberOfSigmas*self.getUncertainty(timestamp)/spacing
+    return int(min(max(round(size), minimumSize), maximumSize))
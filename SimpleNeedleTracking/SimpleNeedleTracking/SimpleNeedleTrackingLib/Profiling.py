@@ -0,0 +1,148 @@
+import collections
+import contextlib
+import csv
+import time
+
+import numpy as np
+
+
+################################################################################################################################################
+# Stage timer
+################################################################################################################################################
+
+# Collects the duration (ms) of the stages of one tracking cycle
+class StageTimer:
+
+  def __init__(self):
+    self.timings = {}
+    self.start = time.perf_counter()
+    self.last = self.start
+    self.excluded = 0.0
+
+  # Record time since the previous mark under the stage name
+  def mark(self, name):
+    now = time.perf_counter()
+    self.timings[name] = self.timings.get(name, 0.0) + 1000*(now - self.last - self.excluded)
+    self.last = now
+    self.excluded = 0.0
+
+  # Measure a block under its own name and exclude it from the enclosing stage (e.g. debug output)
+  @contextlib.contextmanager
+  def exclude(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      self.timings[name] = self.timings.get(name, 0.0) + 1000*elapsed
+      self.excluded += elapsed
+
+  # Add stage durations measured elsewhere (e.g. in parallel workers), keeping the longest of each stage
+  def merge(self, timings):
+    for (name, duration) in timings.items():
+      if name != 'Total':
+        self.timings[name] = max(self.timings.get(name, 0.0), duration)
+
+  # Record total time since the timer was created
+  def total(self, name='Total'):
+    self.timings[name] = 1000*(time.perf_counter() - self.start)
+    return self.timings
+
+
+################################################################################################################################################
+# Latency statistics
+################################################################################################################################################
+
+# Rolling per-stage latency statistics, plus the per-cycle timings of the last historySize cycles for export
+# (about an hour at 20 frames/s by default; older cycles are discarded, like the tracking history ring buffer)
+class LatencyStatistics:
+
+  def __init__(self, windowSize=200, historySize=72000):
+    self.windowSize = windowSize
+    self.historySize = historySize
+    self.reset()
+
+  # Clear statistics and history
+  def reset(self):
+    self.samples = collections.OrderedDict()                    # stage -> recent durations (ms)
+    self.history = collections.deque(maxlen=self.historySize)  # (timestamp, {stage: duration}) for each of the last cycles
+
+  # Add stage durations (ms) of one cycle
+  def add(self, timings, timestamp=None):
+    if not timings:
+      return
+    for (stage, duration) in timings.items():
+      if stage not in self.samples:
+        self.samples[stage] = collections.deque(maxlen=self.windowSize)
+      self.samples[stage].append(duration)
+    self.history.append((time.time() if timestamp is None else timestamp, dict(timings)))
+
+  # Get rolling statistics: list of (stage, count, mean, p50, p95, max) in ms
+  def getStatistics(self):
+    statistics = []
+    for (stage, durations) in self.samples.items():
+      values = np.fromiter(durations, dtype=float)
+      (p50, p95) = np.percentile(values, (50, 95))
+      statistics.append((stage, len(values), float(values.mean()), float(p50), float(p95), float(values.max())))
+    return statistics
+
+  # Write the timings of the cycles in the history (one row per cycle, one column per stage)
+  def exportCSV(self, path):
+    stages = list(self.samples.keys())
+    with open(path, 'w', newline='') as csvFile:
+      writer = csv.writer(csvFile)
+      writer.writerow(['Timestamp'] + stages)
+      for (timestamp, timings) in self.history:
+        writer.writerow(['%.6f' % timestamp] + [('%.3f' % timings[stage]) if stage in timings else '' for stage in stages])
+
+
+################################################################################################################################################
+# Outcome statistics
+################################################################################################################################################
+
+# Cumulative count of the tracking outcomes per reason code (TrackingResult.reason, -1 when missing),
+# plus the rolling success rate and attempt rate over the last windowSize attempts
+# (outcomes that are not attempts, e.g. skipped frames, are only counted)
+class OutcomeStatistics:
+
+  def __init__(self, windowSize=100):
+    self.windowSize = windowSize
+    self.reset()
+
+  # Clear counters
+  def reset(self):
+    self.counts = collections.OrderedDict()                  # reason code -> attempts since the reset
+    self.recent = collections.deque(maxlen=self.windowSize)  # (timestamp, success) of the recent attempts
+    self.lastResult = None
+
+  # Add the outcome of one attempt (TrackingResult)
+  # attempt=False: count the outcome only (not in the rates nor the last result)
+  def add(self, result, timestamp=None, attempt=True):
+    reason = -1 if result.reason is None else result.reason
+    self.counts[reason] = self.counts.get(reason, 0) + 1
+    if not attempt:
+      return
+    self.recent.append((time.time() if timestamp is None else timestamp, bool(result)))
+    self.lastResult = result
+
+  # Number of attempts since the reset
+  def getTotalCount(self):
+    return sum(self.counts.values())
+
+  # Fraction of successful attempts in the window (None before the first attempt)
+  def getSuccessRate(self):
+    if not self.recent:
+      return None
+    return sum(success for (_, success) in self.recent)/len(self.recent)
+
+  # Attempts per second in the window (None with less than two attempts)
+  def getAttemptRate(self):
+    if len(self.recent) < 2:
+      return None
+    elapsed = self.recent[-1][0] - self.recent[0][0]
+    return (len(self.recent) - 1)/elapsed if elapsed > 0 else None
+
+  # Get counters: list of (reason code, count, fraction of all attempts), in order of first occurrence
+  def getCounts(self):
+    total = self.getTotalCount()
+    return [(reason, count, count/total) for (reason, count) in self.counts.items()]
@@ -0,0 +1,119 @@
+import numpy as np
+
+from .Unwrapping import wrapPhase
+
+
+################################################################################################################################################
+# Synthetic frames
+################################################################################################################################################
+
+# Synthesizes magnitude/phase frame pairs (MagPhase input mode) with a needle tip moving along a path, for load testing
+# without scanner time.
+# The needle tip is modeled as a susceptibility dipole (main field along S): the phase shift around the tip is
+#   dipoleStrength * (dipoleRadius/r)^3 * (3*cos(theta)^2 - 1)
+# (zero inside dipoleRadius, where the needle also voids the magnitude). Phase shifts larger than pi wrap.
+# Frames are built on the geometry of a baseline: the baseline magnitude/phase arrays (e.g. from 'SRC Baseline M/P 0.nrrd')
+# are used as background when given, otherwise a phantom with a smooth phase ramp of baselineWraps cycles is synthesized.
+# Phase arrays are in raw scanner units: [0 to phaseRange) maps to [-pi to pi).
+# geometry: FrameGeometry of the frames, shape: (slice, row, column)
+# path: tip positions (RAS) joined by straight segments, run at speed (mm/s), back and forth when loop is set
+class SyntheticFrameGenerator:
+
+  def __init__(self, geometry, shape, path, speed=5.0, baseMagnitude=None, basePhase=None, dipoleStrength=4.0, dipoleRadius=1.5,
+               phaseNoise=0.05, magnitudeNoise=0.02, baselineWraps=2.0, phaseRange=4096, loop=True, seed=None):
+    self.geometry = geometry
+    self.shape = tuple(shape)
+    self.path = np.array(path, dtype=float).reshape(-1, 3)
+    self.speed = speed
+    self.dipoleStrength = dipoleStrength
+    self.dipoleRadius = dipoleRadius
+    self.phaseNoise = phaseNoise
+    self.magnitudeNoise = magnitudeNoise
+    self.phaseRange = phaseRange
+    self.loop = loop
+    self.random = np.random.default_rng(seed)
+
+    # Cumulative length (mm) of the path at each point
+    self.pathLengths = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(self.path, axis=0), axis=1))))
+
+    # Voxel positions (RAS), (slice, row, column, 3)
+    (k, j, i) = np.meshgrid(*(np.arange(size, dtype=float) for size in self.shape), indexing='ij')
+    direction = np.array(geometry.direction).reshape(3, 3)*np.array(geometry.spacing)
+    positions = np.array(geometry.origin) + np.stack((i, j, k), axis=-1) @ direction.T
+    positions[..., :2] *= -1  # LPS to RAS
+    self.voxelRAS = positions.astype(np.float32)
+
+    # Background
+    if baseMagnitude is None:
+      baseMagnitude = self.createPhantomMagnitude()
+    if basePhase is None:
+      basePhase = self.createPhantomPhase(baselineWraps)
+    self.dtype = np.asarray(basePhase).dtype
+    self.baseMagnitude = np.asarray(baseMagnitude, dtype=np.float32).reshape(self.shape)
+    self.basePhase = self.toRadians(np.asarray(basePhase, dtype=np.float32).reshape(self.shape))
+
+  # Ellipse (cylinder through the slices) of uniform magnitude filling most of the field of view
+  def createPhantomMagnitude(self):
+    (_, rows, columns) = self.shape
+    (y, x) = np.meshgrid(np.linspace(-1, 1, rows), np.linspace(-1, 1, columns), indexing='ij')
+    phantom = 1000.0*(x**2/0.8**2 + y**2/0.9**2 < 1)
+    return np.broadcast_to(phantom, self.shape).astype(np.uint16)
+
+  # Smooth phase ramp across the field of view with the given number of wraps, in raw units
+  def createPhantomPhase(self, wraps):
+    (_, rows, columns) = self.shape
+    (y, x) = np.meshgrid(np.linspace(0, 1, rows), np.linspace(0, 1, columns), indexing='ij')
+    phase = wrapPhase(2*np.pi*wraps*(0.7*x + 0.3*y**2))
+    return np.broadcast_to(self.toRaw(phase), self.shape).astype(np.uint16)
+
+  # Raw scanner phase units to radians [-pi to pi)
+  def toRadians(self, array_raw):
+    return array_raw*(2*np.pi/self.phaseRange) - np.pi
+
+  # Radians (wrapped) to raw scanner phase units
+  def toRaw(self, array_p):
+    return np.clip(np.round((wrapPhase(array_p) + np.pi)*(self.phaseRange/(2*np.pi))), 0, self.phaseRange - 1)
+
+  # Needle-free magnitude/phase frame pair (arrays of the baseline type)
+  def getBaseline(self):
+    return (self.baseMagnitude.astype(self.dtype), self.toRaw(self.basePhase).astype(self.dtype))
+
+  # Tip position (RAS) on the path at timestamp (s, from the start of the path)
+  def getTipRAS(self, timestamp):
+    totalLength = self.pathLengths[-1]
+    distance = max(self.speed*timestamp, 0.0)
+    if totalLength == 0:
+      return tuple(float(v) for v in self.path[0])
+    if self.loop:
+      distance = distance % (2*totalLength)
+      if distance > totalLength:
+        distance = 2*totalLength - distance
+    else:
+      distance = min(distance, totalLength)
+    return tuple(float(np.interp(distance, self.pathLengths, self.path[:, axis])) for axis in range(3))
+
+  # Phase shift (radians) and magnitude attenuation of the needle tip at tipRAS
+  def getDipole(self, tipRAS):
+    offset = self.voxelRAS - np.array(tipRAS, dtype=np.float32)
+    r2 = np.maximum(np.sum(offset*offset, axis=-1), 1e-6)
+    inside = (r2 < self.dipoleRadius**2)
+    cos2 = offset[..., 2]**2/r2
+    phase = self.dipoleStrength*(self.dipoleRadius**2/r2)**1.5*(3*cos2 - 1)
+    phase[inside] = 0.0
+    attenuation = np.where(inside, 0.1, 1.0).astype(np.float32)
+    return (phase, attenuation)
+
+  # Frame pair with the tip at its path position at timestamp (s)
+  # Returns (magnitude, phase, tipRAS)
+  def generate(self, timestamp):
+    tipRAS = self.getTipRAS(timestamp)
+    (dipole, attenuation) = self.getDipole(tipRAS)
+    phase = self.basePhase + dipole  # New arrays: noise is added in place
+    magnitude = self.baseMagnitude*attenuation
+    if self.phaseNoise > 0:
+      phase += self.phaseNoise*self.random.standard_normal(self.shape, dtype=np.float32)
+    if self.magnitudeNoise > 0:
+      magnitude *= 1.0 + self.magnitudeNoise*self.random.standard_normal(self.shape, dtype=np.float32)
+    maximum = np.iinfo(self.dtype).max if np.issubdtype(self.dtype, np.integer) else None
+    magnitude = np.clip(np.round(magnitude) if maximum else magnitude, 0, maximum)
+    return (magnitude.astype(self.dtype), self.toRaw(phase).astype(self.dtype), tipRAS)
@@ -0,0 +1,1017 @@
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from math import sqrt, pow
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .Detection import TIP_DETECTORS, TemplateMatchingDetector
+from .Profiling import StageTimer
+from .Unwrapping import ReliabilityUnwrapper, createUnwrapper, hasPhaseWraps, wrapPhase
+
+
+################################################################################################################################################
+# Frame geometry
+################################################################################################################################################
+
+# Image geometry in ITK convention (LPS), shared by the frames of a sequence
+class FrameGeometry:
+
+  def __init__(self, origin, spacing, direction):
+    self.origin = tuple(float(v) for v in origin)
+    self.spacing = tuple(float(v) for v in spacing)
+    self.direction = tuple(float(v) for v in direction)
+
+  # Get geometry from a SimpleITK image
+  @classmethod
+  def fromImage(cls, sitkImage):
+    return cls(sitkImage.GetOrigin(), sitkImage.GetSpacing(), sitkImage.GetDirection())
+
+  # Set geometry of a SimpleITK image
+  def applyTo(self, sitkImage):
+    sitkImage.SetOrigin(self.origin)
+    sitkImage.SetSpacing(self.spacing)
+    sitkImage.SetDirection(self.direction)
+    return sitkImage
+
+  # Convert point from RAS to continuous voxel index (column, row, slice)
+  def getIndexFromRAS(self, pointRAS):
+    pointLPS = np.array((-pointRAS[0], -pointRAS[1], pointRAS[2])) - np.array(self.origin)
+    direction = np.array(self.direction).reshape(3, 3)
+    return tuple(float(v) for v in np.linalg.solve(direction*np.array(self.spacing), pointLPS))
+
+  # Convert continuous voxel index (column, row, slice) to point in RAS
+  def getRASFromIndex(self, index):
+    direction = np.array(self.direction).reshape(3, 3)
+    pointLPS = np.array(self.origin) + (direction*np.array(self.spacing)) @ np.asarray(index, dtype=float)
+    return (float(-pointLPS[0]), float(-pointLPS[1]), float(pointLPS[2]))
+
+  # Get geometry of one slice of the volume
+  def getSlice(self, sliceIndex):
+    offset = sliceIndex*self.spacing[2]
+    origin = tuple(self.origin[i] + self.direction[3*i+2]*offset for i in range(3))
+    return FrameGeometry(origin, self.spacing, self.direction)
+
+
+# Read a first/second (magnitude/phase or real/imaginary) image pair from files
+# Returns numpy arrays (slice, row, column) and their geometry
+def readFramePair(firstPath, secondPath):
+  sitk_first = sitk.ReadImage(firstPath)
+  sitk_second = sitk.ReadImage(secondPath)
+  return (sitk.GetArrayFromImage(sitk_first), sitk.GetArrayFromImage(sitk_second), FrameGeometry.fromImage(sitk_first))
+
+
+################################################################################################################################################
+# Tracking result
+################################################################################################################################################
+
+# Reason codes of the tracking outcome (compact, for the tracking history)
+REASON_SUCCESS = 0
+REASON_NOT_INITIALIZED = 1  # No base images
+REASON_INVALID_ROI = 2      # ROI outside the image
+REASON_TOO_MANY_BLOBS = 3   # Too many round blobs in the ROI, probably noise
+REASON_NO_BLOB = 4          # No round blob in the ROI
+REASON_BLOB_TOO_BIG = 5     # Largest blob too big for the ROI, probably noise
+REASON_TOO_FAR = 6          # Tip farther from the prediction than the error threshold
+REASON_NO_TIP = 7           # No tip in any slice/plane (see the slice/plane results)
+REASON_NO_MATCH = 8         # No template match scoring the minimum in the ROI ('Template' detector)
+REASON_SKIPPED = 9          # Frame skipped to keep up with the frame budget (no attempt)
+REASON_NAMES = {
+  REASON_SUCCESS: 'Success',
+  REASON_NOT_INITIALIZED: 'NotInitialized',
+  REASON_INVALID_ROI: 'InvalidROI',
+  REASON_TOO_MANY_BLOBS: 'TooManyBlobs',
+  REASON_NO_BLOB: 'NoBlob',
+  REASON_BLOB_TOO_BIG: 'BlobTooBig',
+  REASON_TOO_FAR: 'TooFarFromPrediction',
+  REASON_NO_TIP: 'NoTip',
+  REASON_NO_MATCH: 'NoMatch',
+  REASON_SKIPPED: 'Skipped',
+}
+
+# Outcome of one tracking attempt. Evaluates to True when the tip was found
+class TrackingResult:
+
+  def __init__(self, success=False, message='', tipRAS=None, predictionRAS=None, predError=None, blobSize=None, reason=None):
+    self.success = success
+    self.message = message
+    self.reason = reason                # Reason code of the outcome (REASON_*)
+    self.tipRAS = tipRAS                # Detected tip (RAS)
+    self.predictionRAS = predictionRAS  # Predicted tip used to center the ROI (RAS)
+    self.predError = predError          # Distance between prediction and detection (mm)
+    self.blobSize = blobSize            # Size of the chosen blob (px)
+    self.matchScore = None              # Score of the matched tip template ('Template' detector)
+    self.reacquired = False             # Tip searched over the whole field of view after the track was lost (see reacquire)
+    self.degradations = 0               # Settings degraded to keep up with the frame budget (bit mask of DEGRADATION_*)
+    self.timings = {}                   # Duration of each pipeline stage (ms)
+    self.sliceResults = []              # Result of each slice (multi-slice tracking)
+    self.planeResults = {}              # Result of each plane (multi-plane tracking)
+
+  def __bool__(self):
+    return self.success
+
+
+################################################################################################################################################
+# Tracking engine
+################################################################################################################################################
+
+# Needle tip tracking pipeline on NumPy/SimpleITK data (no dependency on 3D Slicer)
+class NeedleTrackingEngine:
+
+  def __init__(self):
+    # Phase rescaling filter
+    self.phaseRescaleFilter = sitk.RescaleIntensityImageFilter()
+    self.phaseRescaleFilter.SetOutputMaximum(2*np.pi)
+    self.phaseRescaleFilter.SetOutputMinimum(0)
+
+    # ROI filter
+    self.roiFilter = sitk.RegionOfInterestImageFilter()
+
+    # Gradient filter
+    self.gradientFilter = sitk.GradientMagnitudeRecursiveGaussianImageFilter()
+
+    # Called with (sitkImage, name) for each intermediate image when debugFlag is set
+    self.debugCallback = None
+
+    # Phase unwrapping backend
+    self.unwrapper = ReliabilityUnwrapper()
+
+    # Tip detector ('Blobs' or 'Template', see TIP_DETECTORS) and template bank of the 'Template' detector
+    self.tipDetector = 'Blobs'
+    self.templateDetector = TemplateMatchingDetector()
+
+    # Margin (px) added around the ROI for ROI-first unwrapping
+    self.unwrapPadding = 10
+
+    # Re-acquisition: downsampling factor of the coarse search, number of candidates refined at full resolution, and
+    # minimum candidate score relative to the median block score (background) and to the best candidate
+    self.reacquireDownsample = 4
+    self.reacquireCandidates = 3
+    self.reacquireContrast = 4.0
+    self.reacquireRelativeScore = 0.5
+
+    # Stage timer of the running cycle and stage durations of the last baseline update (ms)
+    self.stageTimer = None
+    self.baselineTimings = {}
+
+    # Base images
+    self.geometry = None
+    self.sitk_base_m = None
+    self.sitk_base_p = None
+    self.sitk_mask = None
+    self.numpy_mask = None
+    self.numpy_base_unwraped_p = None
+    self.numpy_base_c = None     # Unit complex base phase (used by the 'Complex' difference mode)
+    self.baseWindowCache = None  # (window, unwrapped base phase in window)
+    self.numpy_base_drift = None # Change of the base phase since the last full rebuild (rolling baseline)
+
+    # Multi-slice tracking: one engine per slice, run in a thread pool
+    self.sliceEngines = None
+    self.sliceExecutor = None
+    self.sliceDebugImages = []
+
+    # Float32 magnitude/phase buffers of the preprocessing stage, reused across frames of the same shape
+    self.magnitudeBuffer = None
+    self.phaseBuffer = None
+    # Complex64 buffer of the 'Complex' difference mode (unwrapping window), reused across frames of the same shape
+    self.differenceBuffer = None
+
+  # Check if base images were set
+  def isInitialized(self):
+    return (self.sitk_base_m is not None) and (self.sitk_base_p is not None)
+
+  # Send intermediate image to the debug callback (timed as a separate 'Debug' stage)
+  def pushDebug(self, sitkImage, name):
+    if self.debugCallback is None:
+      return
+    if self.stageTimer is None:
+      self.debugCallback(sitkImage, name)
+      return
+    with self.stageTimer.exclude('Debug'):
+      self.debugCallback(sitkImage, name)
+
+  # Record the last stage and the total time of the cycle into the result
+  def finishResult(self, result, stage=None):
+    if stage is not None:
+      self.stageTimer.mark(stage)
+    result.timings = self.stageTimer.total()
+    self.stageTimer = None
+    return result
+
+  # Return sitk Image from numpy array
+  def numpyToitk(self, array, sitkReference, type=None):
+    image = sitk.GetImageFromArray(array, isVector=False)
+    if (type is None):
+      image = sitk.Cast(image, sitkReference.GetPixelID())
+    else:
+      image = sitk.Cast(image, type)
+    image.CopyInformation(sitkReference)
+    return image
+
+  # Return blank itk Image with same information from reference volume
+  def createBlankItk(self, sitkReference, type=None, pixelValue=0):
+    image = sitk.Image(sitkReference.GetSize(), sitk.sitkUInt8)
+    image.CopyInformation(sitkReference)
+    if pixelValue != 0:
+      image = sitk.Not(image)
+    if (type is None):
+      image = sitk.Cast(image, sitkReference.GetPixelID())
+    else:
+      image = sitk.Cast(image, type)
+    if pixelValue != 0:
+      image = pixelValue*image
+    return image
+
+  # Unwrap phase images with the selected backend
+  # Arrays without phase jumps inside the mask are returned as they are (masked)
+  def unwrap_phase_array(self, array_p, array_mask):
+    if not self.hasPhaseWraps(array_p, array_mask):
+      return np.ma.array(array_p, mask=np.logical_not(array_mask))
+    return self.unwrapper.unwrap(array_p, array_mask)
+
+  # Check for phase jumps larger than pi between neighbor pixels inside mask
+  def hasPhaseWraps(self, array_p, array_mask):
+    return hasPhaseWraps(array_p, array_mask)
+
+  # Select phase unwrapping backend ('Reliability' or 'LeastSquares')
+  # The unwrapped base phase is computed again with the new backend
+  def setUnwrapBackend(self, name):
+    if name == self.unwrapper.name:
+      return
+    self.unwrapper = createUnwrapper(name)
+    if self.isInitialized():
+      self.numpy_base_unwraped_p = self.unwrap_phase_array(sitk.GetArrayViewFromImage(self.sitk_base_p), self.numpy_mask)
+      self.baseWindowCache = None
+
+  # Select tip detector ('Blobs' or 'Template')
+  def setTipDetector(self, name):
+    if name not in TIP_DETECTORS:
+      raise ValueError('Unknown tip detector: %s' % name)
+    self.tipDetector = name
+
+  # Get padded unwrapping window around the ROI: (x0, y0, x1, y1) in pixels
+  # Returns None if the window does not fit in the image
+  def getUnwrapWindow(self, roiIndex, roiSize, imageSize):
+    x0 = roiIndex[0] - self.unwrapPadding
+    y0 = roiIndex[1] - self.unwrapPadding
+    x1 = roiIndex[0] + roiSize + self.unwrapPadding
+    y1 = roiIndex[1] + roiSize + self.unwrapPadding
+    if (x0 < 0) or (y0 < 0) or (x1 > imageSize[0]) or (y1 > imageSize[1]):
+      return None
+    return (x0, y0, x1, y1)
+
+  # Unwrapped base phase inside window (cached while the window does not move)
+  def getBaseUnwrapedWindow(self, window):
+    if (self.baseWindowCache is None) or (self.baseWindowCache[0] != window):
+      (x0, y0, x1, y1) = window
+      numpy_base_p = sitk.GetArrayViewFromImage(self.sitk_base_p)[:, y0:y1, x0:x1]
+      numpy_base_unwraped_p = self.unwrap_phase_array(numpy_base_p, self.numpy_mask[:, y0:y1, x0:x1])
+      self.baseWindowCache = (window, numpy_base_unwraped_p)
+    return self.baseWindowCache[1]
+
+  # Get size (px), centroid (continuous pixel index x, y) and elongation of every label of a 2D label array (row, column)
+  # Elongation is sqrt(largest/smallest principal moment) in physical units, 0 when the smallest moment is 0
+  # (single pixels and straight lines), as in LabelShapeStatisticsImageFilter up to rounding errors
+  def getBlobStatistics(self, array_labels, spacing):
+    (rows, columns) = np.nonzero(array_labels)
+    labels = array_labels[rows, columns]
+    numberOfLabels = int(labels.max()) if labels.size else 0
+    sizes = np.bincount(labels, minlength=numberOfLabels+1)[1:]
+    if numberOfLabels == 0:
+      return (sizes, np.zeros((0, 2)), np.zeros(0))
+    # First and second moments in physical units
+    x = columns*spacing[0]
+    y = rows*spacing[1]
+    mean_x = np.bincount(labels, x, numberOfLabels+1)[1:] / sizes
+    mean_y = np.bincount(labels, y, numberOfLabels+1)[1:] / sizes
+    var_xx = np.bincount(labels, x*x, numberOfLabels+1)[1:] / sizes - mean_x*mean_x
+    var_yy = np.bincount(labels, y*y, numberOfLabels+1)[1:] / sizes - mean_y*mean_y
+    var_xy = np.bincount(labels, x*y, numberOfLabels+1)[1:] / sizes - mean_x*mean_y
+    # Principal moments (eigenvalues of the 2x2 covariance)
+    half_trace = 0.5*(var_xx + var_yy)
+    discriminant = np.sqrt(np.maximum(0.25*(var_xx - var_yy)**2 + var_xy*var_xy, 0))
+    moment_max = half_trace + discriminant
+    moment_min = np.maximum(half_trace - discriminant, 0)
+    flat = (moment_min <= 1e-9*moment_max)
+    elongations = np.where(flat, 0.0, np.sqrt(moment_max / np.where(flat, 1.0, moment_min)))
+    centroids = np.stack((mean_x/spacing[0], mean_y/spacing[1]), axis=1)
+    return (sizes, centroids, elongations)
+
+  # Get preprocessing buffers for the frame shape (allocated again only when the shape changes)
+  def getPreprocessBuffers(self, shape):
+    shape = tuple(shape)
+    if (self.phaseBuffer is None) or (self.phaseBuffer.shape != shape):
+      self.magnitudeBuffer = np.empty(shape, dtype=np.float32)
+      self.phaseBuffer = np.empty(shape, dtype=np.float32)
+    return (self.magnitudeBuffer, self.phaseBuffer)
+
+  # Get complex64 buffer for the complex phase difference, reused across calls with the same shape
+  def getDifferenceBuffer(self, shape):
+    shape = tuple(shape)
+    if (self.differenceBuffer is None) or (self.differenceBuffer.shape != shape):
+      self.differenceBuffer = np.empty(shape, dtype=np.complex64)
+    return self.differenceBuffer
+
+  # Convert real/imaginary arrays to float32 magnitude/phase arrays (-pi to pi)
+  # Results are written into numpy_magn/numpy_phase when given
+  def realImagToMagPhase(self, numpy_real, numpy_imag, numpy_magn=None, numpy_phase=None):
+    numpy_magn = np.hypot(numpy_real, numpy_imag, out=numpy_magn, dtype=np.float32, casting='unsafe')
+    numpy_phase = np.arctan2(numpy_imag, numpy_real, out=numpy_phase, dtype=np.float32, casting='unsafe')
+    return (numpy_magn, numpy_phase)
+
+  # Linearly rescale array in place to [0 to 2*pi] (same mapping as phaseRescaleFilter)
+  def rescalePhaseArray(self, array_p):
+    minimum = float(array_p.min())
+    maximum = float(array_p.max())
+    if (maximum != minimum):
+      scale = 2*np.pi/(maximum - minimum)
+    elif (maximum != 0):
+      scale = 2*np.pi/maximum
+    else:
+      scale = 0.0
+    np.multiply(array_p, scale, out=array_p, casting='unsafe')
+    np.subtract(array_p, minimum*scale, out=array_p, casting='unsafe')
+    return array_p
+
+  # Get Float32 magnitude and phase arrays from input arrays in the preprocessing buffers
+  # This is the only float32 conversion of a frame: inputs can be views of the source voxels (any dtype), they are not modified
+  # Phase is scaled to angle interval [0 to 2*pi]
+  # The returned arrays are overwritten by the next call: copy them to keep them
+  def getMagPhaseArrays(self, first, second, inputMode):
+    (numpy_m, numpy_p) = self.getPreprocessBuffers(np.shape(first))
+    if (inputMode == 'RealImag'): # Convert to magnitude/phase
+      self.realImagToMagPhase(first, second, numpy_m, numpy_p)
+    else:
+      np.copyto(numpy_m, first, casting='unsafe')
+      np.copyto(numpy_p, second, casting='unsafe')
+    self.rescalePhaseArray(numpy_p)
+    return (numpy_m, numpy_p)
+
+  # Get Float32 magnitude and phase itk images from input arrays
+  # Phase is scaled to angle interval [0 to 2*pi]
+  def getMagPhaseImages(self, first, second, geometry, inputMode):
+    (numpy_m, numpy_p) = self.getMagPhaseArrays(first, second, inputMode)
+    sitk_m = geometry.applyTo(sitk.GetImageFromArray(numpy_m))
+    sitk_p = geometry.applyTo(sitk.GetImageFromArray(numpy_p))
+    return (sitk_m, sitk_p)
+
+  # Update the stored base images
+  # mask: array with non-zero values inside the tracking region (None to use the whole image)
+  def setBaseline(self, first, second, geometry, mask=None, inputMode='MagPhase', debugFlag=False):
+    self.stageTimer = StageTimer()
+    self.geometry = geometry
+    (self.sitk_base_m, self.sitk_base_p) = self.getMagPhaseImages(first, second, geometry, inputMode)
+    # Get base mask
+    if mask is None:
+      self.numpy_mask = np.ones(np.shape(first), dtype=np.uint8)
+    else:
+      self.numpy_mask = np.asarray(mask, dtype=np.uint8)
+    self.sitk_mask = geometry.applyTo(sitk.GetImageFromArray(self.numpy_mask))
+    # Unwrapped base phase
+    numpy_base_p = sitk.GetArrayFromImage(self.sitk_base_p)
+    self.stageTimer.mark('Preprocess')
+    self.numpy_base_unwraped_p = self.unwrap_phase_array(numpy_base_p, self.numpy_mask)
+    self.baseWindowCache = None
+    self.sliceEngines = None
+    self.templateDetector.backgroundScore = None
+    self.numpy_base_drift = np.zeros(np.shape(numpy_base_p), dtype=np.float32)
+    self.stageTimer.mark('Unwrap')
+    # Complex base phase
+    self.numpy_base_c = np.exp(1j*numpy_base_p).astype(np.complex64)
+    self.stageTimer.mark('Difference')
+    # Push debug images
+    if debugFlag:
+      self.pushDebug(self.sitk_base_m, 'debug_base_m')
+      self.pushDebug(self.sitk_base_p, 'debug_base_p')
+      self.pushDebug(self.sitk_mask, 'debug_mask')
+      sitk_base_unwraped_p = self.numpyToitk(self.numpy_base_unwraped_p, self.sitk_base_p)
+      self.pushDebug(sitk_base_unwraped_p, 'debug_base_unwraped_p')
+    self.baselineTimings = self.stageTimer.total()
+    self.stageTimer = None
+
+  ################################################################################################################################################
+  # Rolling baseline
+  ################################################################################################################################################
+
+  # Blend a frame into the base phase away from the needle (exponential moving average of the unit complex phase)
+  # tipRASList: needle tips (RAS), pixels closer than exclusionRadius (mm, in-plane, all slices) keep their base phase
+  # rate: weight of the frame (0 to 1)
+  # Returns the baseline drift (see getBaselineDrift)
+  def updateRollingBaseline(self, first, second, geometry, tipRASList, inputMode='MagPhase', rate=0.05, exclusionRadius=15.0):
+    if not self.isInitialized():
+      return None
+    if geometry is None:
+      geometry = self.geometry
+    (_, numpy_img_p) = self.getMagPhaseArrays(first, second, inputMode)
+    # Weight of the frame: rate inside the mask and away from the needle tips
+    numpy_weight = np.where(self.numpy_mask != 0, np.float32(rate), np.float32(0))
+    (rows, columns) = np.shape(numpy_img_p)[1:]
+    for tipRAS in tipRASList:
+      tipIndex = geometry.getIndexFromRAS(tipRAS)
+      distance_y = (np.arange(rows) - tipIndex[1])*geometry.spacing[1]
+      distance_x = (np.arange(columns) - tipIndex[0])*geometry.spacing[0]
+      numpy_weight[:, (distance_y[:, None]**2 + distance_x[None, :]**2) < exclusionRadius**2] = 0
+    self.blendBaseline(numpy_img_p, numpy_weight)
+    # Slice engines (multi-slice tracking) follow the same frame, each with its own phase scaling: their base phase was
+    # rescaled with the min/max of their slice (setBaseline), so they rescale the raw slice the same way
+    if self.sliceEngines is not None:
+      for (index, engine) in enumerate(self.sliceEngines):
+        (_, numpy_slice_p) = engine.getMagPhaseArrays(first[index:index+1], second[index:index+1], inputMode)
+        engine.blendBaseline(numpy_slice_p, numpy_weight[index:index+1])
+    return self.getBaselineDrift()
+
+  # Blend a scaled phase array (0 to 2*pi) into the base phase with per-pixel weights
+  # The unwrapped base phase (and the cached window) are moved by the wrapped change of the base phase,
+  # without new unwrapping. This holds while each change stays well below pi; the accumulated change
+  # is tracked by getBaselineDrift to tell when rebuildBaseline is needed.
+  def blendBaseline(self, numpy_img_p, numpy_weight):
+    # Unit complex frame phase in single precision (np.exp(1j*phase) would go through complex128)
+    numpy_base_c = np.empty(np.shape(numpy_img_p), dtype=np.complex64)
+    np.cos(numpy_img_p, out=numpy_base_c.real)
+    np.sin(numpy_img_p, out=numpy_base_c.imag)
+    numpy_base_c -= self.numpy_base_c
+    numpy_base_c *= numpy_weight
+    numpy_base_c += self.numpy_base_c
+    numpy_base_c /= np.maximum(np.abs(numpy_base_c), np.float32(1e-6))
+    numpy_base_p = np.angle(numpy_base_c)
+    numpy_base_p[numpy_base_p < 0] += np.float32(2*np.pi)
+    numpy_delta = wrapPhase(numpy_base_p - sitk.GetArrayViewFromImage(self.sitk_base_p))
+    self.numpy_base_c = numpy_base_c
+    self.sitk_base_p = self.numpyToitk(numpy_base_p, self.sitk_base_p)
+    self.numpy_base_unwraped_p = self.numpy_base_unwraped_p + numpy_delta
+    self.numpy_base_drift += numpy_delta
+    if self.baseWindowCache is not None:
+      (window, numpy_base_unwraped_p) = self.baseWindowCache
+      (x0, y0, x1, y1) = window
+      self.baseWindowCache = (window, numpy_base_unwraped_p + numpy_delta[:, y0:y1, x0:x1])
+
+  # Baseline drift (rad): spread (RMS around the mean, inside the mask) of the base phase change since the last full rebuild
+  # A uniform offset does not affect tracking and is not counted. A large drift means that the incremental
+  # unwrapped base phase may have drifted from a proper unwrapping (e.g. steps around the excluded needle regions).
+  def getBaselineDrift(self):
+    if self.numpy_base_drift is None:
+      return 0.0
+    drift = self.numpy_base_drift[self.numpy_mask != 0]
+    if drift.size == 0:
+      return 0.0
+    return float(np.sqrt(np.mean(np.square(drift - drift.mean()))))
+
+  # Unwrap the current (rolling) base phase again and reset the drift
+  def rebuildBaseline(self):
+    if not self.isInitialized():
+      return
+    self.numpy_base_unwraped_p = self.unwrap_phase_array(sitk.GetArrayFromImage(self.sitk_base_p), self.numpy_mask)
+    self.baseWindowCache = None
+    self.sliceEngines = None
+    self.numpy_base_drift[:] = 0
+
+  # Run one tracking cycle on a dummy frame (e.g. the baseline frame) and discard the result, so that the first
+  # tracked frame does not pay for lazy imports, first use of the filters, thread pools and buffer allocations
+  # tipRAS: tip prediction of the first frames (None: center of the image, in sliceIndex or the middle slice)
+  # sliceIndex None also warms the slice engines (trackAllSlices).
+  # Other parameters as track. The duration is added to baselineTimings ('Warm-up')
+  def warmUp(self, first, second, geometry, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipRAS=None, tipDetector=None):
+    if not self.isInitialized():
+      return None
+    startTime = time.perf_counter()
+    if tipRAS is None:
+      (columns, rows, slices) = self.sitk_base_p.GetSize()
+      tipRAS = (geometry or self.geometry).getRASFromIndex((0.5*columns, 0.5*rows, slices//2 if sliceIndex is None else sliceIndex))
+    result = self.track(first, second, geometry, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode, False, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+    self.baselineTimings['Warm-up'] = 1000*(time.perf_counter() - startTime)
+    return result
+
+  # Run one tracking cycle on a frame
+  # first/second: magnitude/phase (or real/imaginary) arrays (slice, row, column)
+  # geometry: frame geometry (None to use the baseline geometry)
+  # tipRAS: predicted tip position (RAS)
+  # unwrapMode: 'Full' unwraps the whole frame, 'ROI' only a padded window around the ROI
+  #             (falls back to 'Full' when the window reaches the image border)
+  # differenceMode: 'Unwrapped' subtracts the unwrapped frame and base phases,
+  #                 'Complex' takes the difference as frame * conj(base) and unwraps it only if it wraps.
+  #                 It implies the 'ROI' unwrap mode: over the full frame the masked background noise always wraps,
+  #                 so the difference would be unwrapped anyway (slower than 'Unwrapped' with the cached base)
+  # unwrapBackend: phase unwrapping backend (None to keep the current one)
+  # tipDetector: 'Blobs' or 'Template' (None to keep the current one, see detectTip)
+  # sliceIndex: slice where the tip is searched, None to search every slice in parallel (see trackAllSlices)
+  # Stage durations are returned in result.timings
+  def track(self, first, second, geometry, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipDetector=None):
+    result = TrackingResult(predictionRAS=tuple(tipRAS))
+    if not self.isInitialized():
+      result.message = 'ERROR: Mag/Phase base images were not initialized'
+      result.reason = REASON_NOT_INITIALIZED
+      return result
+    if unwrapBackend is not None:
+      self.setUnwrapBackend(unwrapBackend)
+    if tipDetector is not None:
+      self.setTipDetector(tipDetector)
+    if sliceIndex is None:
+      if self.sitk_base_p.GetDepth() > 1:
+        return self.trackAllSlices(first, second, geometry, tipRAS, roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, tipDetector)
+      sliceIndex = 0
+    self.stageTimer = StageTimer()
+    (numpy_img_p, sitk_img_p) = self.preprocessFrame(first, second, geometry, inputMode, debugFlag)
+
+    # Get unwrapping window (None: full frame)
+    window = None
+    if (unwrapMode == 'ROI') or (differenceMode == 'Complex'):
+      window = self.getUnwrapWindow(self.getROIIndex(sitk_img_p, tipRAS, roiSize), roiSize, sitk_img_p.GetSize())
+
+    sitk_diff_p = self.getPhaseDifference(numpy_img_p, sitk_img_p, window, debugFlag, differenceMode)
+    return self.detectTip(result, sitk_diff_p, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, debugFlag)
+
+  # Get float32 phase array and phase image (scaled to [0 to 2*pi]) of a frame (stage 'Preprocess')
+  def preprocessFrame(self, first, second, geometry, inputMode, debugFlag=False):
+    if geometry is None:
+      geometry = self.geometry
+    (numpy_img_m, numpy_img_p) = self.getMagPhaseArrays(first, second, inputMode)
+    sitk_img_p = geometry.applyTo(sitk.GetImageFromArray(numpy_img_p))
+    # Push debug images
+    if debugFlag:
+      self.pushDebug(geometry.applyTo(sitk.GetImageFromArray(numpy_img_m)), 'debug_img_m')
+      self.pushDebug(sitk_img_p, 'debug_img_p')
+    self.stageTimer.mark('Preprocess')
+    return (numpy_img_p, sitk_img_p)
+
+  # Get ROI index (pixels, LPS) of a ROI of roiSize centered on the tip prediction (RAS)
+  def getROIIndex(self, sitkImage, tipRAS, roiSize):
+    tipIndex = sitkImage.TransformPhysicalPointToIndex((-tipRAS[0], -tipRAS[1], tipRAS[2]))
+    return (round(tipIndex[0]-0.5*roiSize), round(tipIndex[1]-0.5*roiSize), 0)
+
+  # Steps 1-2: get the phase difference image of a frame, rescaled to [0 to 2*pi] (stages 'Unwrap' and 'Difference')
+  # window: (x0, y0, x1, y1) to unwrap only a window of the frame, None for the full frame
+  # The image of a window keeps its physical position
+  def getPhaseDifference(self, numpy_img_p, sitk_img_p, window, debugFlag=False, differenceMode='Unwrapped'):
+    # Crop window
+    crop = (slice(None), slice(None), slice(None))
+    if window is not None:
+      (x0, y0, x1, y1) = window
+      crop = (slice(None), slice(y0, y1), slice(x0, x1))
+      sitk_img_p = sitk_img_p[x0:x1, y0:y1, :]
+    numpy_img_p = numpy_img_p[crop]
+    numpy_mask = self.numpy_mask[crop]
+
+    if (differenceMode == 'Complex'):
+
+      ######################################
+      ##                                  ##
+      ## Step 1-2: Complex difference     ##
+      ##                                  ##
+      ######################################
+
+      # Wrapped phase difference (-pi to pi) from frame * conj(base), in single precision
+      # (np.exp(1j*phase) would go through complex128)
+      numpy_diff_c = self.getDifferenceBuffer(np.shape(numpy_img_p))
+      np.cos(numpy_img_p, out=numpy_diff_c.real)
+      np.sin(numpy_img_p, out=numpy_diff_c.imag)
+      numpy_diff_c *= np.conj(self.numpy_base_c[crop])
+      numpy_diff_p = np.angle(numpy_diff_c)
+      self.stageTimer.mark('Difference')
+      # Unwrap difference (only if it has phase jumps inside the window)
+      numpy_diff_p = self.unwrap_phase_array(numpy_diff_p, numpy_mask)
+      self.stageTimer.mark('Unwrap')
+
+    else:
+
+      ######################################
+      ##                                  ##
+      ## Step 1: Unwrap phase image       ##
+      ##                                  ##
+      ######################################
+
+      # Unwrapped img phase
+      numpy_img_unwraped_p = self.unwrap_phase_array(numpy_img_p, numpy_mask)
+      if window is None:
+        numpy_base_unwraped_p = self.numpy_base_unwraped_p
+      else:
+        numpy_base_unwraped_p = self.getBaseUnwrapedWindow(window)
+      self.stageTimer.mark('Unwrap')
+
+      # Plot
+      if debugFlag:
+        sitk_img_unwraped_p = self.numpyToitk(numpy_img_unwraped_p, sitk_img_p)
+        self.pushDebug(sitk_img_unwraped_p, 'debug_img_unwraped_p')
+
+      ######################################
+      ##                                  ##
+      ## Step 2: Get phase difference     ##
+      ##                                  ##
+      ######################################
+
+      # Get phase difference
+      numpy_diff_p = numpy_img_unwraped_p - numpy_base_unwraped_p
+
+    # Set background to mean phase value
+    numpy_diff_p = numpy_diff_p.filled(numpy_diff_p.mean())
+    sitk_diff_p = self.numpyToitk(numpy_diff_p, sitk_img_p)
+    sitk_diff_p = self.phaseRescaleFilter.Execute(sitk_diff_p)
+
+    # Plot
+    if debugFlag:
+      self.pushDebug(sitk_diff_p, 'debug_phase_diff')
+    self.stageTimer.mark('Difference')
+    return sitk_diff_p
+
+  # Steps 3-6: find the tip in the ROI of the phase difference image centered on the tip prediction (RAS)
+  # The outcome is written into result (stages 'ROI', 'Gradient', 'Blobs' and 'Tip', then the total time)
+  # With the 'Template' tip detector, steps 4-6 are replaced by template matching (see matchTip)
+  # debugSuffix: added to the names of the intermediate images (e.g. one set per needle)
+  def detectTip(self, result, sitk_diff_p, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, debugFlag=False, debugSuffix=''):
+
+    ######################################
+    ##                                  ##
+    ## Step 3: Select ROI               ##
+    ##                                  ##
+    ######################################
+
+    # Convert tip prediction to pixel coordinates in ITK (LPS), relative to the (window of the) difference image
+    roiIndex = self.getROIIndex(sitk_diff_p, tipRAS, roiSize)
+    sliceDepth = sitk_diff_p.GetDepth()
+
+    # Define ROI filter size/index (pixels)
+    self.roiFilter.SetSize((roiSize,roiSize,sliceDepth))
+    self.roiFilter.SetIndex(roiIndex)
+
+    try:
+      sitk_roi = self.roiFilter.Execute(sitk_diff_p)
+    except:
+      result.message = 'Invalid ROI'
+      result.reason = REASON_INVALID_ROI
+      return self.finishResult(result, 'ROI')
+    sitk_roi = self.phaseRescaleFilter.Execute(sitk_roi)
+    # Plot
+    if debugFlag:
+      self.pushDebug(sitk_roi, 'debug_roi' + debugSuffix)
+    self.stageTimer.mark('ROI')
+
+    if self.tipDetector == 'Template':
+      return self.matchTip(result, sitk_roi, tipRAS, sliceIndex, errorThreshold, debugFlag, debugSuffix)
+
+    ####################################
+    ##                                ##
+    ## Step 4: Image gradient         ##
+    ##                                ##
+    ####################################
+
+    # 3D Gradient Filter only works with >=4 slices
+    # Perform 2D gradient instead
+    sitk_phaseGradient = self.gradientFilter.Execute(sitk_roi[:,:,sliceIndex])
+    sitk_phaseGradient = self.phaseRescaleFilter.Execute(sitk_phaseGradient)
+
+    # Plot
+    if debugFlag:
+      # Put slice in the volume
+      sitk_phaseGradientVolume = self.createBlankItk(sitk_roi, type=sitk.sitkFloat32)
+      sitk_phaseGradientVolume[:,:,sliceIndex] = sitk_phaseGradient
+      self.pushDebug(sitk_phaseGradientVolume, 'debug_phase_gradient' + debugSuffix)
+    self.stageTimer.mark('Gradient')
+
+    ####################################
+    ##                                ##
+    ## Step 5: Blob detection         ##
+    ##                                ##
+    ####################################
+
+    # Threshold roi to create blobs
+    sitk_blobs = (sitk_phaseGradient > blobThreshold)
+    # Plot
+    if debugFlag:
+      # Put slice in the volume
+      sitk_blobsVolume = self.createBlankItk(sitk_roi, sitk_blobs.GetPixelID())
+      sitk_blobsVolume[:,:,sliceIndex] = sitk_blobs
+      self.pushDebug(sitk_blobsVolume, 'debug_blobs' + debugSuffix)
+
+    # Label blobs in the ROI slice and get sizes, centroids (pixels) and elongations of all labels
+    sitk_labels = sitk.ConnectedComponent(sitk_blobs)
+    (sizes, centroids, elongations) = self.getBlobStatistics(sitk.GetArrayViewFromImage(sitk_labels), sitk_roi.GetSpacing())
+    if debugFlag:
+      for l in range(len(sizes)):
+        print('Label %s: -> Size: %s, Center: %s, Elongation: %s' %(l+1, sizes[l], tuple(centroids[l]), elongations[l]))
+
+    # Keep round blobs
+    keep = (elongations < 4)
+    labels_size = sizes[keep]
+    labels_centroid = centroids[keep]
+    self.stageTimer.mark('Blobs')
+
+    ####################################
+    ##                                ##
+    ## Step 6: Get tip physical point ##
+    ##                                ##
+    ####################################
+    # Check number of centroids found
+    if len(labels_size)>15:
+      result.message = 'Too many centroids, probably noise'
+      result.reason = REASON_TOO_MANY_BLOBS
+      return self.finishResult(result, 'Tip')
+    # Reasonable number of centroids: get the largest one
+    try:
+      sorted_by_size = np.argsort(labels_size)
+      first_largest = sorted_by_size[-1]
+    except:
+      result.message = 'No centroids found'
+      result.reason = REASON_NO_BLOB
+      return self.finishResult(result, 'Tip')
+    result.blobSize = int(labels_size[first_largest])
+
+    # Check centroid size with respect to ROI size
+    if (labels_size[first_largest] > 0.5*roiSize*0.5*roiSize):
+      result.message = 'Centroid too big, probably noise'
+      result.reason = REASON_BLOB_TOO_BIG
+      return self.finishResult(result, 'Tip')
+
+    # Get selected centroid center (physical coordinates)
+    center = sitk_roi.TransformContinuousIndexToPhysicalPoint((float(labels_centroid[first_largest][0]), float(labels_centroid[first_largest][1]), float(sliceIndex)))
+    # Convert to 3D Slicer coordinates (RAS)
+    centerRAS = (-center[0], -center[1], center[2])
+    result.tipRAS = centerRAS
+
+    # Plot
+    if debugFlag:
+      print('Chosen label: %i' %(first_largest+1))
+      print(centerRAS)
+
+    # Calculate prediction error
+    predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
+    result.predError = predError
+    # Check error threshold
+    if(predError>errorThreshold):
+      result.message = 'Tip too far from prediction: Err = %f' %predError
+      result.reason = REASON_TOO_FAR
+      return self.finishResult(result, 'Tip')
+
+    result.success = True
+    result.message = 'Tracking successful'
+    result.reason = REASON_SUCCESS
+    return self.finishResult(result, 'Tip')
+
+  # Set the background score of the template detector from tiles of the unwrapped base phase (roiSize px, half
+  # overlapping, at least 90% inside the mask) of every slice: the background structures the ROI of a frame can contain
+  def calibrateTemplateDetector(self, roiSize):
+    (depth, rows, columns) = np.shape(self.numpy_base_unwraped_p)
+    step = max(1, roiSize//2)
+    rois = []
+    for k in range(depth):
+      for j in range(0, rows - roiSize + 1, step):
+        for i in range(0, columns - roiSize + 1, step):
+          if self.numpy_mask[k, j:j+roiSize, i:i+roiSize].mean() >= 0.9:
+            rois.append(self.numpy_base_unwraped_p[k, j:j+roiSize, i:i+roiSize])
+    self.templateDetector.calibrate(rois, self.geometry.spacing)
+
+  # Steps 4-6 with the 'Template' tip detector: the tip is the best match of the oriented tip templates in the ROI slice
+  # (TemplateMatchingDetector, stages 'Match' and 'Tip'). blobSize is the number of ROI pixels scoring at least half the peak.
+  def matchTip(self, result, sitk_roi, tipRAS, sliceIndex, errorThreshold, debugFlag=False, debugSuffix=''):
+    if self.templateDetector.needsCalibration():
+      with self.stageTimer.exclude('Calibration'):
+        self.calibrateTemplateDetector(sitk_roi.GetSize()[0])
+    (tipIndex, score, template, scoreMap) = self.templateDetector.match(sitk.GetArrayViewFromImage(sitk_roi)[sliceIndex], sitk_roi.GetSpacing())
+    result.matchScore = score
+    # Plot
+    if debugFlag:
+      # Put slice in the volume
+      sitk_scoreVolume = self.createBlankItk(sitk_roi, type=sitk.sitkFloat32)
+      sitk_scoreVolume[:,:,sliceIndex] = self.numpyToitk(scoreMap.astype(np.float32), sitk_roi[:,:,sliceIndex], sitk.sitkFloat32)
+      self.pushDebug(sitk_scoreVolume, 'debug_template_match' + debugSuffix)
+      print('Template match: score %f, template %i, tip %s' % (score, template, tipIndex))
+    self.stageTimer.mark('Match')
+
+    if tipIndex is None:
+      result.message = 'No template match (score %f)' % score
+      result.reason = REASON_NO_MATCH
+      return self.finishResult(result, 'Tip')
+    result.blobSize = int(np.count_nonzero(scoreMap >= 0.5*score))
+
+    # Get tip center (physical coordinates)
+    center = sitk_roi.TransformContinuousIndexToPhysicalPoint((tipIndex[0], tipIndex[1], float(sliceIndex)))
+    # Convert to 3D Slicer coordinates (RAS)
+    centerRAS = (-center[0], -center[1], center[2])
+    result.tipRAS = centerRAS
+
+    # Calculate prediction error
+    predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
+    result.predError = predError
+    # Check error threshold
+    if(predError>errorThreshold):
+      result.message = 'Tip too far from prediction: Err = %f' %predError
+      result.reason = REASON_TOO_FAR
+      return self.finishResult(result, 'Tip')
+
+    result.success = True
+    result.message = 'Tracking successful (template match %.2f)' % score
+    result.reason = REASON_SUCCESS
+    return self.finishResult(result, 'Tip')
+
+  ################################################################################################################################################
+  # Re-acquisition
+  ################################################################################################################################################
+
+  # Get tip candidates over the whole field of view from a coarse phase difference (no unwrapping)
+  # The unit complex phase difference (frame * conj(base)) is weighted by the magnitude and averaged over blocks of
+  # reacquireDownsample x reacquireDownsample pixels. The score of a block is the distance between its normalized mean
+  # phasor and the mean phase of its 5x5 block neighborhood: high where the needle shifts or dephases the phase locally.
+  # Blocks outside the mask or with low signal are skipped. Candidates score at least reacquireContrast times the median
+  # block score and reacquireRelativeScore times the best score: blocks that do not stand out are background, and the
+  # fine search would find a blob near any of them.
+  # sliceIndex: slice to search, None for all slices
+  # Returns up to numberOfCandidates (RAS, score), best first, at least minimumDistance (px) apart in-plane (empty when
+  # no block stands out)
+  def getCoarseCandidates(self, first, second, geometry, sliceIndex, inputMode, numberOfCandidates, minimumDistance):
+    (numpy_m, numpy_p) = self.getMagPhaseArrays(first, second, inputMode)
+    factor = self.reacquireDownsample
+    firstSlice = 0 if sliceIndex is None else sliceIndex
+    (depth, rows, columns) = np.shape(numpy_p)
+    if sliceIndex is not None:
+      depth = 1
+    crop = (slice(firstSlice, firstSlice+depth), slice(0, rows//factor*factor), slice(0, columns//factor*factor))
+    blockShape = (depth, rows//factor, factor, columns//factor, factor)
+    numpy_m = numpy_m[crop]
+    numpy_z = (np.cos(numpy_p[crop]) + 1j*np.sin(numpy_p[crop])) * np.conj(self.numpy_base_c[crop]) * numpy_m
+    block_z = numpy_z.reshape(blockShape).mean(axis=(2, 4))
+    block_m = numpy_m.reshape(blockShape).mean(axis=(2, 4))
+    block_mask = self.numpy_mask[crop].reshape(blockShape).mean(axis=(2, 4))
+    # Mean phase of the 5x5 block neighborhood
+    padded = np.pad(block_z, ((0, 0), (2, 2), (2, 2)), mode='edge')
+    neighborhood = sliding_window_view(padded, (5, 5), axis=(1, 2)).mean(axis=(-2, -1))
+    scores = np.abs(block_z/np.maximum(block_m, 1e-12) - neighborhood/np.maximum(np.abs(neighborhood), 1e-12))
+    valid = (block_mask >= 0.5) & (block_m >= 0.2*np.percentile(block_m, 90))
+    if not np.any(valid):
+      return []
+    minimumScore = max(self.reacquireContrast*np.median(scores[valid]), self.reacquireRelativeScore*scores[valid].max())
+    scores[~valid] = 0
+    # Best blocks, apart from each other
+    candidates = []
+    for index in np.argsort(scores, axis=None)[::-1]:
+      (k, j, i) = np.unravel_index(index, scores.shape)
+      if (len(candidates) == numberOfCandidates) or (scores[k, j, i] < minimumScore):
+        break
+      position = ((i + 0.5)*factor - 0.5, (j + 0.5)*factor - 0.5)
+      if any(np.hypot(position[0] - other[0], position[1] - other[1]) < minimumDistance for (other, _, _) in candidates):
+        continue
+      candidates.append((position, firstSlice + k, float(scores[k, j, i])))
+    return [(tuple(float(v) for v in geometry.getRASFromIndex((x, y, k))), score) for ((x, y), k, score) in candidates]
+
+  # Search the tip over the whole field of view after the track was lost (coarse-to-fine re-acquisition)
+  # Coarse: tip candidates from the downsampled phase difference of the whole frame (getCoarseCandidates, stage 'Coarse Search')
+  # Fine: the frame is tracked at full resolution with the ROI centered on each candidate in turn (best first, up to
+  # reacquireCandidates, ROIs apart) until the tip is found, unwrapping only a window around the ROI ('ROI' unwrap mode).
+  # The error threshold applies to the distance from the candidate (result.predictionRAS).
+  # Same parameters as track (tipRAS: the prediction that lost the track, used when no candidate is found).
+  # Returns the result of the first candidate found (or of the best one), with reacquired set
+  def reacquire(self, first, second, geometry, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipDetector=None):
+    if not self.isInitialized():
+      return self.track(first, second, geometry, tipRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode)
+    startTime = time.perf_counter()
+    if geometry is None:
+      geometry = self.geometry
+    candidates = self.getCoarseCandidates(first, second, geometry, sliceIndex, inputMode, self.reacquireCandidates, 0.5*roiSize)
+    coarseTime = 1000*(time.perf_counter() - startTime)
+    results = []
+    for (candidateRAS, _) in candidates:
+      results.append(self.track(first, second, geometry, candidateRAS, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, 'ROI', differenceMode, unwrapBackend, tipDetector))
+      if results[-1]:
+        break
+    if not results:
+      result = TrackingResult(predictionRAS=tuple(tipRAS))
+      result.message = 'No tip candidate in the field of view'
+      result.reason = REASON_NO_TIP
+    else:
+      result = results[-1] if results[-1] else results[0]
+      result.message = 'Re-acquired (%i of %i candidates): %s' % (len(results), len(candidates), result.message)
+    result.reacquired = True
+    result.timings = dict(result.timings, **{'Coarse Search': coarseTime, 'Total': 1000*(time.perf_counter() - startTime)})
+    return result
+
+  ################################################################################################################################################
+  # Multi-needle tracking
+  ################################################################################################################################################
+
+  # Track several needles in one frame: the phase difference is computed once and the ROI, gradient,
+  # blob and tip stages run for each needle prediction
+  # tipRASList: predicted tip of each needle (RAS)
+  # sliceIndex: None to search each needle in the slice of its prediction
+  # With unwrapMode 'ROI' the unwrapping window covers the ROIs of all needles.
+  # Returns one result per needle. Each result has the shared stages and its own detection stages;
+  # 'Total' is the time of the whole frame.
+  def trackNeedles(self, first, second, geometry, tipRASList, sliceIndex, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipDetector=None):
+    results = [TrackingResult(predictionRAS=tuple(tipRAS)) for tipRAS in tipRASList]
+    if not self.isInitialized():
+      for result in results:
+        result.message = 'ERROR: Mag/Phase base images were not initialized'
+        result.reason = REASON_NOT_INITIALIZED
+      return results
+    if unwrapBackend is not None:
+      self.setUnwrapBackend(unwrapBackend)
+    if tipDetector is not None:
+      self.setTipDetector(tipDetector)
+    if geometry is None:
+      geometry = self.geometry
+    self.stageTimer = StageTimer()
+    (numpy_img_p, sitk_img_p) = self.preprocessFrame(first, second, geometry, inputMode, debugFlag)
+
+    # Get unwrapping window covering all ROIs (None: full frame)
+    window = None
+    if ((unwrapMode == 'ROI') or (differenceMode == 'Complex')) and tipRASList:
+      windows = [self.getUnwrapWindow(self.getROIIndex(sitk_img_p, tipRAS, roiSize), roiSize, sitk_img_p.GetSize()) for tipRAS in tipRASList]
+      if None not in windows:
+        window = (min(w[0] for w in windows), min(w[1] for w in windows), max(w[2] for w in windows), max(w[3] for w in windows))
+
+    sitk_diff_p = self.getPhaseDifference(numpy_img_p, sitk_img_p, window, debugFlag, differenceMode)
+    sharedTimer = self.stageTimer
+
+    # Detect each tip (ROI stages take a few ms: needles are processed one after the other)
+    depth = np.shape(numpy_img_p)[0]
+    for (needleIndex, (result, tipRAS)) in enumerate(zip(results, tipRASList)):
+      needleSlice = sliceIndex
+      if needleSlice is None:
+        needleSlice = int(np.clip(round(geometry.getIndexFromRAS(tipRAS)[2]), 0, depth-1))
+      self.stageTimer = StageTimer()
+      self.detectTip(result, sitk_diff_p, tipRAS, needleSlice, roiSize, blobThreshold, errorThreshold, debugFlag, '_needle%i' % (needleIndex+1) if needleIndex else '')
+      result.timings.pop('Total')
+    self.stageTimer = sharedTimer
+    timings = self.stageTimer.total()
+    self.stageTimer = None
+    for result in results:
+      result.timings = dict(timings, **result.timings)
+    return results
+
+  ################################################################################################################################################
+  # Multi-slice tracking
+  ################################################################################################################################################
+
+  # Get one single-slice engine per base slice (created on first use after each baseline update)
+  # Slice engines use the scaled base phase of the whole volume as their baseline
+  def getSliceEngines(self):
+    if self.sliceEngines is None:
+      numpy_base_m = sitk.GetArrayViewFromImage(self.sitk_base_m)
+      numpy_base_p = sitk.GetArrayViewFromImage(self.sitk_base_p)
+      self.sliceEngines = []
+      for index in range(self.sitk_base_p.GetDepth()):
+        engine = NeedleTrackingEngine()
+        engine.unwrapper = createUnwrapper(self.unwrapper.name)
+        engine.tipDetector = self.tipDetector
+        engine.unwrapPadding = self.unwrapPadding
+        engine.setBaseline(numpy_base_m[index:index+1], numpy_base_p[index:index+1], self.geometry.getSlice(index), self.numpy_mask[index:index+1])
+        engine.templateDetector.minimumScore = self.templateDetector.minimumScore
+        engine.templateDetector.backgroundRatio = self.templateDetector.backgroundRatio
+        engine.debugCallback = (lambda sitkImage, name, index=index: self.sliceDebugImages.append((sitkImage, '%s_slice%i' % (name, index))))
+        self.sliceEngines.append(engine)
+    if self.sliceExecutor is None:
+      self.sliceExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(self.sliceEngines), os.cpu_count() or 1), thread_name_prefix='NeedleTrackingSlice')
+    return self.sliceEngines
+
+  # Track the tip in every slice concurrently and fuse the slice detections into one 3D tip
+  # Each slice is unwrapped, differenced, filtered and labeled on its own (2D).
+  # The tip is the slice tip nearest the prediction: the other slices mostly see the shaft behind the tip, so their
+  # tips are only used to check that the slices agree (within errorThreshold of the chosen tip, see the message).
+  # Stage durations are the longest of the slices, 'Slices' is the wall time of the parallel part and 'Slices Serial'
+  # the sum of the slice durations (their ratio is the speedup of the slice threads).
+  def trackAllSlices(self, first, second, geometry, tipRAS, roiSize, blobThreshold, errorThreshold, inputMode='MagPhase', debugFlag=False, unwrapMode='Full', differenceMode='Unwrapped', unwrapBackend=None, tipDetector=None):
+    result = TrackingResult(predictionRAS=tuple(tipRAS))
+    self.stageTimer = StageTimer()
+    if geometry is None:
+      geometry = self.geometry
+    engines = self.getSliceEngines()
+    futures = []
+    for (index, engine) in enumerate(engines):
+      futures.append(self.sliceExecutor.submit(engine.track, first[index:index+1], second[index:index+1], geometry.getSlice(index), tipRAS, 0,
+                                               roiSize, blobThreshold, errorThreshold, inputMode, debugFlag, unwrapMode, differenceMode, unwrapBackend, self.tipDetector))
+    result.sliceResults = [future.result() for future in futures]
+    self.stageTimer.mark('Slices')
+    for sliceResult in result.sliceResults:
+      self.stageTimer.merge(sliceResult.timings)
+    self.stageTimer.timings['Slices Serial'] = sum(sliceResult.timings.get('Total', 0.0) for sliceResult in result.sliceResults)
+    # Push debug images of the slices from the calling thread
+    while self.sliceDebugImages:
+      self.pushDebug(*self.sliceDebugImages.pop(0))
+
+    # Fuse slice tips: slice tip nearest the prediction, the others check the consistency
+    candidates = [(index, sliceResult) for (index, sliceResult) in enumerate(result.sliceResults) if sliceResult.success]
+    if not candidates:
+      result.message = 'No tip found in any slice (%s)' % '; '.join('%i: %s' % (index, sliceResult.message) for (index, sliceResult) in enumerate(result.sliceResults))
+      result.reason = REASON_NO_TIP
+      return self.finishResult(result, 'Fuse')
+    tips = np.array([sliceResult.tipRAS for (_, sliceResult) in candidates])
+    nearest = int(np.argmin(np.linalg.norm(tips - np.asarray(tipRAS, dtype=float), axis=1)))
+    (tipSliceIndex, tipResult) = candidates[nearest]
+    centerRAS = tuple(float(v) for v in tipResult.tipRAS)
+    result.tipRAS = centerRAS
+    result.blobSize = tipResult.blobSize
+    result.matchScore = tipResult.matchScore
+    agreeingSlices = int(np.count_nonzero(np.linalg.norm(tips - tips[nearest], axis=1) <= errorThreshold))
+
+    # Calculate prediction error
+    predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
+    result.predError = predError
+    # Check error threshold
+    if(predError>errorThreshold):
+      result.message = 'Tip too far from prediction: Err = %f' %predError
+      result.reason = REASON_TOO_FAR
+      return self.finishResult(result, 'Fuse')
+
+    result.success = True
+    result.message = 'Tracking successful (slice %i, %i of %i slices agree)' % (tipSliceIndex, agreeingSlices, len(engines))
+    result.reason = REASON_SUCCESS
+    return self.finishResult(result, 'Fuse')
@@ -0,0 +1,286 @@
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .MultiPlane import fusePlaneResults, getFramePlaneNormalRAS
+from .Profiling import StageTimer
+from .TrackingEngine import NeedleTrackingEngine, TrackingResult
+
+
+################################################################################################################################################
+# Worker process side
+################################################################################################################################################
+
+# Tracking engines of the worker process: main plane, and one per plane of multi-plane tracking
+_workerEngine = None
+_planeEngines = {}
+
+# Create worker engine with the baseline: (first, second, geometry, mask, inputMode)
+# warmUpArguments: NeedleTrackingEngine.warmUp arguments after the frame, to run the pipeline once on the baseline frame
+# planeBaselines: {plane name: baseline} of multi-plane tracking (planes are tracked on all their slices)
+def _initializeWorker(baseline, warmUpArguments=None, planeBaselines=None):
+  global _workerEngine
+  _workerEngine = NeedleTrackingEngine()
+  _workerEngine.setBaseline(*baseline)
+  if warmUpArguments is not None:
+    _workerEngine.warmUp(baseline[0], baseline[1], baseline[2], *warmUpArguments)
+  _planeEngines.clear()
+  for (planeName, planeBaseline) in (planeBaselines or {}).items():
+    engine = NeedleTrackingEngine()
+    engine.setBaseline(*planeBaseline)
+    if warmUpArguments is not None:
+      engine.warmUp(planeBaseline[0], planeBaseline[1], planeBaseline[2], None, *warmUpArguments[1:])
+    _planeEngines[planeName] = engine
+
+# Attach to a shared memory block created by the parent process
+# (spawned workers share the parent resource tracker, which unlinks the block once)
+def _attachSharedMemory(name):
+  try:
+    return shared_memory.SharedMemory(name=name, track=False)  # Python >= 3.13
+  except TypeError:
+    return shared_memory.SharedMemory(name=name)
+
+# Track frame pair stored in shared memory
+# method: NeedleTrackingEngine method called with the frame pair and args ('track', 'reacquire' or 'trackNeedles')
+# planeName: track with the engine of this plane instead of the main engine
+def _trackSharedFrame(bufferName, shape, geometry, args, method='track', planeName=None):
+  sharedMemory = _attachSharedMemory(bufferName)
+  frames = np.ndarray((2,)+tuple(shape), dtype=np.float32, buffer=sharedMemory.buf)
+  try:
+    engine = _workerEngine if planeName is None else _planeEngines[planeName]
+    return getattr(engine, method)(frames[0], frames[1], geometry, *args)
+  finally:
+    del frames
+    sharedMemory.close()
+
+
+################################################################################################################################################
+# Shared frame buffer
+################################################################################################################################################
+
+# Float32 first/second frame pair in a shared memory block
+class SharedFrameBuffer:
+
+  def __init__(self, shape):
+    self.shape = tuple(shape)
+    self.sharedMemory = shared_memory.SharedMemory(create=True, size=2*int(np.prod(self.shape))*np.dtype(np.float32).itemsize)
+    self.name = self.sharedMemory.name
+    self.frames = np.ndarray((2,)+self.shape, dtype=np.float32, buffer=self.sharedMemory.buf)
+
+  # Copy frame pair into the buffer (converted to float32)
+  def write(self, first, second):
+    np.copyto(self.frames[0], first, casting='unsafe')
+    np.copyto(self.frames[1], second, casting='unsafe')
+
+  # Release shared memory block
+  def close(self):
+    del self.frames
+    self.sharedMemory.close()
+    self.sharedMemory.unlink()
+
+
+################################################################################################################################################
+# Process pool scheduler
+################################################################################################################################################
+
+# Runs the tracking engine in a pool of worker processes.
+# Same interface as LatestFrameScheduler: frames are dicts with 'first', 'second' (arrays), 'geometry' and
+# 'args' (remaining NeedleTrackingEngine.track arguments), optionally 'reacquire' (track with NeedleTrackingEngine.reacquire);
+# frames with 'tipPredictions' are tracked with NeedleTrackingEngine.trackNeedles (multi-needle).
+# Multi-plane frames have 'planes' ({plane name: (first, second, geometry)}) instead of the frame pair and
+# MultiPlaneTracker.track 'args': each plane is a separate task, and the plane results are fused on the main thread.
+# Other keys are returned with the result.
+# Frames are handed to the workers through shared memory buffers, so several frames (and planes) can be tracked at once.
+# When all buffers are in use the oldest frame not started yet is dropped; results older than an
+# already returned one are dropped as stale.
+# The rolling baseline and debug images are not available in worker processes.
+class TrackingProcessPool:
+
+  def __init__(self, baseline, numberOfWorkers=None, numberOfBuffers=None, warmUpArguments=None, planeBaselines=None):
+    self.baseline = baseline  # (first, second, geometry, mask, inputMode), sent once to each worker
+    self.warmUpArguments = warmUpArguments  # Pipeline warm-up of each worker (see NeedleTrackingEngine.warmUp)
+    self.planeBaselines = planeBaselines or collections.OrderedDict()  # {plane name: baseline} of multi-plane tracking
+    self.numberOfWorkers = numberOfWorkers or max(1, (os.cpu_count() or 2) - 1)
+    self.numberOfBuffers = numberOfBuffers or 2*self.numberOfWorkers*max(1, len(self.planeBaselines))
+    self.executor = None
+    self.freeBuffers = []
+    self.numberOfAllocatedBuffers = 0
+    self.jobs = []  # (sequence, frame info, buffers, futures) in submission order, one buffer and future per task
+    self.sequence = 0
+    self.lastResultSequence = 0
+    self.finishedResults = []
+    # Frame counters
+    self.processedCount = 0
+    self.droppedCount = 0
+    self.failedCount = 0
+
+  # Start worker processes
+  def start(self):
+    if self.executor is not None:
+      return
+    self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.numberOfWorkers, mp_context=multiprocessing.get_context('spawn'),
+                                                           initializer=_initializeWorker, initargs=(self.baseline, self.warmUpArguments, self.planeBaselines))
+
+  # Stop worker processes (frames not started yet are dropped) and release shared memory
+  # wait=False: frames still being tracked are dropped too. Their buffers are unlinked now; a worker still reading one
+  # keeps its own mapping until it detaches.
+  def stop(self, wait=True):
+    if self.executor is not None:
+      for job in self.jobs:
+        for future in job[3]:
+          future.cancel()
+      self.executor.shutdown(wait=wait)
+      self.executor = None
+    self.finishedResults.extend(self.collectResults())
+    for job in self.jobs:
+      self.droppedCount += 1
+      self.freeBuffers.extend(job[2])
+    self.jobs = []
+    for buffer in self.freeBuffers:
+      buffer.close()
+    self.freeBuffers = []
+    self.numberOfAllocatedBuffers = 0
+
+  # Reset frame counters
+  def resetCounters(self):
+    self.processedCount = 0
+    self.droppedCount = 0
+    self.failedCount = 0
+
+  # Get a free shared buffer for the frame shape (None if all buffers are in use)
+  # Free buffers of another shape (frame size changed, or planes of different sizes) are released to make room
+  def getFreeBuffer(self, shape):
+    shape = tuple(shape)
+    for buffer in self.freeBuffers:
+      if buffer.shape == shape:
+        self.freeBuffers.remove(buffer)
+        return buffer
+    if (self.numberOfAllocatedBuffers >= self.numberOfBuffers) and self.freeBuffers:
+      self.freeBuffers.pop(0).close()
+      self.numberOfAllocatedBuffers -= 1
+    if self.numberOfAllocatedBuffers < self.numberOfBuffers:
+      self.numberOfAllocatedBuffers += 1
+      return SharedFrameBuffer(shape)
+    return None
+
+  # Drop the oldest frame whose tasks were not started yet and release its buffers. Returns True if a frame was dropped
+  def dropWaitingFrame(self):
+    for job in self.jobs:
+      futures = job[3]
+      if any(future.running() or future.done() for future in futures):
+        continue
+      if all([future.cancel() for future in futures]):
+        self.jobs.remove(job)
+        self.droppedCount += 1
+        self.freeBuffers.extend(job[2])
+        return True
+      # A task started meanwhile: the frame is counted as dropped when collected
+    return False
+
+  # Get free shared buffers for the frame shapes, dropping waiting frames if all buffers are in use
+  # Returns None if not enough buffers are available
+  def getFreeBuffers(self, shapes):
+    buffers = []
+    for shape in shapes:
+      buffer = self.getFreeBuffer(shape)
+      while (buffer is None) and self.dropWaitingFrame():
+        buffer = self.getFreeBuffer(shape)
+      if buffer is None:
+        self.freeBuffers.extend(buffers)
+        return None
+      buffers.append(buffer)
+    return buffers
+
+  # Queue frame for processing
+  def submit(self, frame):
+    if self.executor is None:
+      return False
+    self.finishedResults.extend(self.collectResults())
+    args = frame['args']
+    if 'planes' in frame:
+      # One task per plane, tracked on all its slices: MultiPlaneTracker.track args -> NeedleTrackingEngine.track args
+      planeArgs = (args[0], None) + tuple(args[1:])
+      tasks = [(first, second, geometry, planeArgs, planeName) for (planeName, (first, second, geometry)) in frame['planes'].items()]
+    else:
+      tasks = [(frame['first'], frame['second'], frame['geometry'], args, None)]
+    buffers = self.getFreeBuffers([np.shape(task[0]) for task in tasks])
+    if buffers is None:
+      self.droppedCount += 1
+      return False
+    if 'tipPredictions' in frame:
+      method = 'trackNeedles'
+    elif frame.get('reacquire', False):
+      method = 'reacquire'
+    else:
+      method = 'track'
+    info = {key: value for (key, value) in frame.items() if key not in ('first', 'second', 'planes')}
+    if 'planes' in frame:
+      info['planeNormals'] = collections.OrderedDict((planeName, getFramePlaneNormalRAS(geometry or self.planeBaselines[planeName][2], np.shape(second)))
+                                                     for (planeName, (_, second, geometry)) in frame['planes'].items())
+    futures = []
+    for ((first, second, geometry, taskArgs, planeName), buffer) in zip(tasks, buffers):
+      buffer.write(first, second)
+      futures.append(self.executor.submit(_trackSharedFrame, buffer.name, buffer.shape, geometry, taskArgs, method, planeName))
+    self.sequence += 1
+    self.jobs.append((self.sequence, info, buffers, futures))
+    return True
+
+  # Fuse the plane results of a multi-plane frame (see MultiPlaneTracker.track)
+  # Timings: longest plane of each stage, 'Planes' (longest plane) and 'Fuse'
+  def fusePlanes(self, info, planeResults):
+    timer = StageTimer()
+    (tipRAS, errorThreshold) = (info['args'][0], info['args'][3])
+    planeResults = collections.OrderedDict(zip(info['planeNormals'].keys(), planeResults))
+    result = TrackingResult(predictionRAS=tuple(tipRAS))
+    fusePlaneResults(result, planeResults, info['planeNormals'], tipRAS, errorThreshold)
+    timer.mark('Fuse')
+    for planeResult in planeResults.values():
+      timer.merge(planeResult.timings)
+    timer.timings['Planes'] = max(planeResult.timings.get('Total', 0.0) for planeResult in planeResults.values())
+    timer.timings['Total'] = timer.timings['Planes'] + timer.timings['Fuse']
+    result.timings = timer.timings
+    return result
+
+  # Check if frames are waiting or being processed
+  def isBusy(self):
+    return len(self.jobs) > 0
+
+  # Collect finished jobs and release their buffers
+  def collectResults(self):
+    results = []
+    remaining = []
+    for (sequence, info, buffers, futures) in self.jobs:
+      if not all(future.done() for future in futures):
+        remaining.append((sequence, info, buffers, futures))
+        continue
+      self.freeBuffers.extend(buffers)
+      if any(future.cancelled() for future in futures):
+        self.droppedCount += 1
+        continue
+      try:
+        taskResults = [future.result() for future in futures]
+        result = self.fusePlanes(info, taskResults) if 'planeNormals' in info else taskResults[0]
+      except Exception:
+        logging.exception('Needle tracking failed in worker process')
+        self.failedCount += 1
+        continue
+      if sequence < self.lastResultSequence:
+        # A newer frame was already returned
+        self.droppedCount += 1
+        continue
+      self.lastResultSequence = sequence
+      self.processedCount += 1
+      results.append((info, result))
+    self.jobs = remaining
+    return results
+
+  # Get results finished since the last call: list of (frame info, result)
+  def popResults(self):
+    results = self.finishedResults + self.collectResults()
+    self.finishedResults = []
+    return results
@@ -0,0 +1,102 @@
+import collections
+import logging
+import threading
+
+
+################################################################################################################################################
+# Latest-frame-wins scheduler
+################################################################################################################################################
+
+# Runs processFunction(frame) on a worker thread, always on the newest submitted frame.
+# A frame submitted while another one is still waiting replaces it (the waiting one is dropped).
+# Results are collected with popResults() from the caller thread (e.g. a Qt timer on the main thread).
+class LatestFrameScheduler:
+
+  def __init__(self, processFunction):
+    self.processFunction = processFunction
+    self.condition = threading.Condition()
+    self.pendingFrame = None
+    self.results = collections.deque()  # (frame, result) pairs ready to be published
+    self.thread = None
+    self.running = False
+    self.busy = False
+    # Frame counters
+    self.processedCount = 0
+    self.droppedCount = 0
+    self.failedCount = 0
+
+  # Start worker thread
+  # A worker stopped without waiting is joined first (it must see running False and exit before the new one starts,
+  # else both would process frames on the same engine)
+  def start(self):
+    if self.running:
+      return
+    if self.thread is not None:
+      self.thread.join()
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='NeedleTrackingWorker', daemon=True)
+    self.thread.start()
+
+  # Stop worker thread (pending frame is dropped, frame being processed is finished)
+  # wait=False: return without waiting for that frame; the thread is kept and joined by the next start()
+  def stop(self, wait=True):
+    with self.condition:
+      self.running = False
+      if self.pendingFrame is not None:
+        self.pendingFrame = None
+        self.droppedCount += 1
+      self.condition.notify_all()
+    if wait and (self.thread is not None):
+      self.thread.join()
+      self.thread = None
+
+  # Reset frame counters
+  def resetCounters(self):
+    with self.condition:
+      self.processedCount = 0
+      self.droppedCount = 0
+      self.failedCount = 0
+
+  # Queue frame for processing, replacing the one still waiting (if any)
+  def submit(self, frame):
+    with self.condition:
+      if self.pendingFrame is not None:
+        self.droppedCount += 1
+      self.pendingFrame = frame
+      self.condition.notify()
+
+  # Check if a frame is waiting or being processed
+  def isBusy(self):
+    with self.condition:
+      return self.busy or (self.pendingFrame is not None)
+
+  # Get results finished since the last call: list of (frame, result)
+  def popResults(self):
+    results = []
+    while self.results:
+      results.append(self.results.popleft())
+    return results
+
+  # Worker loop
+  def run(self):
+    while True:
+      with self.condition:
+        while self.running and (self.pendingFrame is None):
+          self.condition.wait()
+        if not self.running:
+          return
+        frame = self.pendingFrame
+        self.pendingFrame = None
+        self.busy = True
+      try:
+        result = self.processFunction(frame)
+      except Exception:
+        logging.exception('Needle tracking failed in worker thread')
+        with self.condition:
+          self.failedCount += 1
+          self.busy = False
+        continue
+      self.results.append((frame, result))
+      with self.condition:
+        self.processedCount += 1
+        self.busy = False
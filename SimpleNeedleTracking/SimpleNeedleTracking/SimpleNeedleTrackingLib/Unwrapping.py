@@ -0,0 +1,197 @@
+import argparse
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+
+################################################################################################################################################
+# Phase unwrapping backends
+################################################################################################################################################
+
+# All backends take a phase array (slice, row, column) and a mask array (non-zero inside the tracking region)
+# and return the unwrapped phase as a masked array (masked outside the mask)
+
+# Check for phase jumps larger than pi between neighbor pixels inside mask
+def hasPhaseWraps(array_p, array_mask):
+  array_valid = (array_mask != 0)
+  jumps_x = np.abs(np.diff(array_p, axis=2)) > np.pi
+  if np.any(jumps_x & array_valid[:,:,1:] & array_valid[:,:,:-1]):
+    return True
+  jumps_y = np.abs(np.diff(array_p, axis=1)) > np.pi
+  return bool(np.any(jumps_y & array_valid[:,1:,:] & array_valid[:,:-1,:]))
+
+# Count phase jumps larger than pi between neighbor pixels inside mask
+def countPhaseWraps(array_p, array_mask):
+  array_valid = (array_mask != 0)
+  jumps_x = np.abs(np.diff(array_p, axis=2)) > np.pi
+  jumps_y = np.abs(np.diff(array_p, axis=1)) > np.pi
+  return int(np.sum(jumps_x & array_valid[:,:,1:] & array_valid[:,:,:-1]) + np.sum(jumps_y & array_valid[:,1:,:] & array_valid[:,:-1,:]))
+
+# Wrap phase values to interval [-pi to pi)
+def wrapPhase(array_p):
+  return (array_p + np.pi) % (2*np.pi) - np.pi
+
+
+# Reliability-sorting unwrapping from scikit-image (module: restoration)
+# A single slice is unwrapped in 2D, several slices together in 3D
+class ReliabilityUnwrapper:
+
+  name = 'Reliability'
+
+  def unwrap(self, array_p, array_mask):
+    from skimage.restoration import unwrap_phase  # Imported on first use (slow to import)
+    array_p_masked = np.ma.array(array_p, mask=np.logical_not(array_mask).astype(int))  # Mask phase image (inverted mask)
+    if array_p.shape[0] == 1: # 2D image in a 3D array: make it 2D array for improved performance
+        array_p_unwraped = np.ma.copy(array_p_masked)  # Initialize unwraped array as the original
+        array_p_unwraped[0,:,:] = unwrap_phase(array_p_masked[0,:,:], wrap_around=(False,False))
+    else:
+        array_p_unwraped = unwrap_phase(array_p_masked, wrap_around=(False,False,False))
+    return array_p_unwraped
+
+
+# Unweighted least-squares unwrapping (Ghiglia and Romero), solved with FFTs in NumPy
+# Each slice is unwrapped in 2D. Wrapped gradients crossing the mask border are ignored.
+# The solution is made congruent with the wrapped phase (differs from it only by multiples of 2*pi).
+class LeastSquaresUnwrapper:
+
+  name = 'LeastSquares'
+
+  def __init__(self):
+    self.eigenvalueCache = {}  # slice shape -> eigenvalues of the Laplacian on the mirrored slice
+
+  # Eigenvalues of the periodic Laplacian on the 2Mx2N mirrored grid (rfft layout)
+  def getEigenvalues(self, shape):
+    if shape not in self.eigenvalueCache:
+      (rows, columns) = shape
+      k = np.arange(2*rows).reshape(-1, 1)
+      l = np.arange(columns+1).reshape(1, -1)
+      eigenvalues = 2*np.cos(np.pi*k/rows) + 2*np.cos(np.pi*l/columns) - 4
+      eigenvalues[0, 0] = 1.0  # Constant term is free
+      self.eigenvalueCache[shape] = eigenvalues
+    return self.eigenvalueCache[shape]
+
+  # Unwrap one 2D slice
+  def unwrapSlice(self, slice_p, slice_valid):
+    (rows, columns) = slice_p.shape
+    # Wrapped gradients inside the mask
+    dx = wrapPhase(np.diff(slice_p, axis=1)) * (slice_valid[:,1:] & slice_valid[:,:-1])
+    dy = wrapPhase(np.diff(slice_p, axis=0)) * (slice_valid[1:,:] & slice_valid[:-1,:])
+    # Divergence of the wrapped gradient (Neumann boundary)
+    rho = np.zeros((rows, columns))
+    rho[:,:-1] += dx
+    rho[:,1:] -= dx
+    rho[:-1,:] += dy
+    rho[1:,:] -= dy
+    # Solve the Poisson equation on the mirrored (even) extension, equivalent to a DCT solver
+    rho = np.concatenate((rho, rho[::-1,:]), axis=0)
+    rho = np.concatenate((rho, rho[:,::-1]), axis=1)
+    spectrum = np.fft.rfft2(rho) / self.getEigenvalues((rows, columns))
+    spectrum[0, 0] = 0
+    solution = np.fft.irfft2(spectrum, s=rho.shape)[:rows, :columns]
+    # Congruence with the wrapped phase
+    weights = slice_valid if np.any(slice_valid) else np.ones_like(slice_valid)
+    offset = np.angle(np.sum(np.exp(1j*(slice_p - solution))[weights]))
+    solution += offset
+    return slice_p + 2*np.pi*np.round((solution - slice_p) / (2*np.pi))
+
+  def unwrap(self, array_p, array_mask):
+    array_valid = (array_mask != 0)
+    array_p_unwraped = np.empty(np.shape(array_p))
+    for index in range(np.shape(array_p)[0]):
+      array_p_unwraped[index] = self.unwrapSlice(np.asarray(array_p[index], dtype=float), array_valid[index])
+    return np.ma.array(array_p_unwraped, mask=np.logical_not(array_valid))
+
+
+# Available unwrapping backends
+UNWRAPPING_BACKENDS = {
+  ReliabilityUnwrapper.name: ReliabilityUnwrapper,
+  LeastSquaresUnwrapper.name: LeastSquaresUnwrapper,
+}
+
+# Create unwrapping backend by name
+def createUnwrapper(name):
+  if name not in UNWRAPPING_BACKENDS:
+    raise ValueError('Unknown unwrapping backend: %s' % name)
+  return UNWRAPPING_BACKENDS[name]()
+
+
+################################################################################################################################################
+# Benchmark
+################################################################################################################################################
+
+# Time and compare the unwrapping backends on phase arrays (already scaled to radians)
+# windowSizes: sizes (px) of centered square windows to test, None for the full frame
+# Accuracy is reported as:
+#   residualWraps: phase jumps larger than pi left inside the mask (0 when fully unwrapped)
+#   mismatch: fraction of mask pixels that differ from the reference backend by a multiple of 2*pi (after removing the global offset)
+# Returns a list of dicts, one per backend and window size
+def benchmarkUnwrapping(phaseArrays, mask, backends=None, windowSizes=(None,), repeats=5, reference=ReliabilityUnwrapper.name):
+  if backends is None:
+    backends = list(UNWRAPPING_BACKENDS.keys())
+  unwrappers = {name: createUnwrapper(name) for name in set(backends) | {reference}}
+  results = []
+  for windowSize in windowSizes:
+    crops = []
+    for array_p in phaseArrays:
+      (rows, columns) = np.shape(array_p)[1:]
+      if windowSize is None:
+        crop = (slice(None), slice(None), slice(None))
+      else:
+        (y0, x0) = ((rows - windowSize)//2, (columns - windowSize)//2)
+        crop = (slice(None), slice(y0, y0+windowSize), slice(x0, x0+windowSize))
+      crops.append((array_p[crop], mask[crop]))
+    references = [unwrappers[reference].unwrap(array_p, array_mask) for (array_p, array_mask) in crops]
+    for name in backends:
+      durations = []
+      residualWraps = 0
+      mismatch = []
+      for ((array_p, array_mask), array_reference) in zip(crops, references):
+        for repeat in range(repeats):
+          start = time.perf_counter()
+          array_unwraped = unwrappers[name].unwrap(array_p, array_mask)
+          durations.append(1000*(time.perf_counter() - start))
+        residualWraps += countPhaseWraps(array_unwraped.filled(0), array_mask)
+        difference = (array_unwraped - array_reference).compressed()
+        if difference.size > 0:
+          difference = difference - np.median(difference)
+          mismatch.append(float(np.mean(np.abs(difference) > np.pi)))
+      results.append({
+        'backend': name,
+        'window': 'full' if windowSize is None else windowSize,
+        'meanMs': float(np.mean(durations)),
+        'p95Ms': float(np.percentile(durations, 95)),
+        'residualWraps': residualWraps,
+        'mismatch': float(np.mean(mismatch)) if mismatch else 0.0,
+      })
+  return results
+
+
+# Command line benchmark on recorded phase images:
+#   python -m SimpleNeedleTrackingLib.Unwrapping --mask Segmentation.seg.nrrd "SRC Baseline P 0.nrrd" "SRC Image P 0.nrrd"
+def main(argv=None):
+  from .TrackingEngine import NeedleTrackingEngine
+  parser = argparse.ArgumentParser(description='Benchmark phase unwrapping backends on recorded phase images')
+  parser.add_argument('phase', nargs='+', help='Phase image files')
+  parser.add_argument('--mask', help='Mask image file (non-zero inside the tracking region)')
+  parser.add_argument('--backends', nargs='+', default=list(UNWRAPPING_BACKENDS.keys()), choices=list(UNWRAPPING_BACKENDS.keys()))
+  parser.add_argument('--windows', nargs='+', type=int, default=[], help='Sizes (px) of centered windows to test besides the full frame')
+  parser.add_argument('--repeats', type=int, default=5)
+  args = parser.parse_args(argv)
+
+  # Phase scaled to [0 to 2*pi] as in the tracking pipeline
+  engine = NeedleTrackingEngine()
+  phaseArrays = [engine.rescalePhaseArray(sitk.GetArrayFromImage(sitk.ReadImage(path)).astype(np.float32)) for path in args.phase]
+  if args.mask:
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(args.mask)).astype(np.uint8)
+  else:
+    mask = np.ones(np.shape(phaseArrays[0]), dtype=np.uint8)
+
+  results = benchmarkUnwrapping(phaseArrays, mask, args.backends, [None] + args.windows, args.repeats)
+  print('%-14s %8s %10s %10s %14s %10s' % ('Backend', 'Window', 'Mean (ms)', 'P95 (ms)', 'Residual wraps', 'Mismatch'))
+  for result in results:
+    print('%-14s %8s %10.2f %10.2f %14d %9.2f%%' % (result['backend'], result['window'], result['meanMs'], result['p95Ms'], result['residualWraps'], 100*result['mismatch']))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,35 @@
+# Needle tracking pipeline that can run without 3D Slicer (NumPy/SimpleITK only)
+# Names are imported from their submodule on first access, so that importing the package
+# (at Slicer startup) does not load SimpleITK, scikit-image and the pipeline modules
+import importlib
+
+_submodules = {
+  'TrackingEngine': ('FrameGeometry', 'TrackingResult', 'NeedleTrackingEngine', 'readFramePair', 'REASON_NAMES', 'REASON_SUCCESS', 'REASON_NOT_INITIALIZED',
+                     'REASON_INVALID_ROI', 'REASON_TOO_MANY_BLOBS', 'REASON_NO_BLOB', 'REASON_BLOB_TOO_BIG', 'REASON_TOO_FAR', 'REASON_NO_TIP', 'REASON_NO_MATCH',
+                     'REASON_SKIPPED'),
+  'TrackingScheduler': ('LatestFrameScheduler',),
+  'TrackingPool': ('SharedFrameBuffer', 'TrackingProcessPool'),
+  'Profiling': ('StageTimer', 'LatencyStatistics', 'OutcomeStatistics'),
+  'Deadline': ('FrameBudgetController', 'DEGRADATION_NAMES', 'getDegradationNames'),
+  'DebugWriter': ('DebugImageWriter',),
+  'Detection': ('TemplateMatchingDetector', 'TIP_DETECTORS'),
+  'Unwrapping': ('ReliabilityUnwrapper', 'LeastSquaresUnwrapper', 'UNWRAPPING_BACKENDS', 'createUnwrapper', 'benchmarkUnwrapping'),
+  'MultiPlane': ('MultiPlaneTracker', 'fusePlaneTips', 'fusePlaneResults'),
+  'Prediction': ('TipPredictor',),
+  'History': ('TrackingHistory',),
+  'Synthetic': ('SyntheticFrameGenerator',),
+  'Benchmark': ('Recording', 'loadRecording', 'runBenchmark', 'compareBenchmarks'),
+  'Batch': ('readSequenceFile', 'loadSequenceRecording', 'reprocessRecording', 'writeTrajectory'),
+}
+_exports = {name: submodule for (submodule, names) in _submodules.items() for name in names}
+__all__ = list(_exports)
+
+def __getattr__(name):
+  if name not in _exports:
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+  value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+  globals()[name] = value
+  return value
+
+def __dir__():
+  return sorted(set(globals()) | set(_exports))
@@ -0,0 +1,153 @@
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+# SimpleNeedleTrackingLib is imported from the module folder, the recorded insertion is next to it
+MODULE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+DATA_DIR = os.path.join(MODULE_DIR, '..', '2023_07_21_Insertion')
+sys.path.insert(0, MODULE_DIR)
+
+import SimpleNeedleTrackingLib
+
+
+################################################################################################################################################
+# Tracking engine
+################################################################################################################################################
+
+# Baseline and image frame pairs of the recorded insertion: (baseline first, baseline second, image first, image second, geometry)
+@pytest.fixture(scope='module')
+def recordedFrames():
+  if not os.path.exists(os.path.join(DATA_DIR, 'SRC Baseline M 0.nrrd')):
+    pytest.skip('Recorded insertion not available')
+  (baseline_m, baseline_p, geometry) = SimpleNeedleTrackingLib.readFramePair(os.path.join(DATA_DIR, 'SRC Baseline M 0.nrrd'), os.path.join(DATA_DIR, 'SRC Baseline P 0.nrrd'))
+  (image_m, image_p, _) = SimpleNeedleTrackingLib.readFramePair(os.path.join(DATA_DIR, 'SRC Image M 0.nrrd'), os.path.join(DATA_DIR, 'SRC Image P 0.nrrd'))
+  return (baseline_m, baseline_p, image_m, image_p, geometry)
+
+# The engine finds the tip of the original module on the recorded frame
+def test_trackRecordedFrame(recordedFrames):
+  (baseline_m, baseline_p, image_m, image_p, geometry) = recordedFrames
+  engine = SimpleNeedleTrackingLib.NeedleTrackingEngine()
+  engine.setBaseline(baseline_m, baseline_p, geometry)
+  result = engine.track(image_m, image_p, geometry, (-7.6, -15.2, 34.0), 1, roiSize=30, blobThreshold=2, errorThreshold=15)
+  assert result.success, result.message
+  assert result.reason == SimpleNeedleTrackingLib.REASON_SUCCESS
+  assert result.tipRAS == pytest.approx((-6.34, -15.22, 37.38), abs=0.01)
+  assert 'Total' in result.timings
+
+# The engine follows a synthetic tip moving through a phantom
+def test_trackSyntheticFrames():
+  geometry = SimpleNeedleTrackingLib.FrameGeometry((0.0, 0.0, 0.0), (1.0, 1.0, 5.0), (1, 0, 0, 0, 1, 0, 0, 0, 1))
+  shape = (1, 128, 128)
+  path = [geometry.getRASFromIndex((40, 40, 0)), geometry.getRASFromIndex((90, 80, 0))]
+  generator = SimpleNeedleTrackingLib.SyntheticFrameGenerator(geometry, shape, path, speed=5.0, seed=1)
+  engine = SimpleNeedleTrackingLib.NeedleTrackingEngine()
+  engine.setBaseline(*generator.getBaseline(), geometry)
+  tipRAS = generator.getTipRAS(0.0)
+  for timestamp in np.arange(0.0, 10.0, 1.0):
+    (first, second, trueTipRAS) = generator.generate(timestamp)
+    result = engine.track(first, second, geometry, tipRAS, 0, roiSize=30, blobThreshold=2, errorThreshold=15)
+    assert result.success, result.message
+    assert np.linalg.norm(np.subtract(result.tipRAS, trueTipRAS)) < 2.0
+    tipRAS = result.tipRAS
+
+
+################################################################################################################################################
+# Frame budget
+################################################################################################################################################
+
+# Cycles over budget degrade the settings one level at a time, then frames are skipped; fast cycles restore them
+def test_frameBudgetLevels():
+  controller = SimpleNeedleTrackingLib.FrameBudgetController(budget=50, smoothing=1.0, holdCycles=2)
+  numberOfLevels = len(SimpleNeedleTrackingLib.DEGRADATION_NAMES)
+  levels = []
+  for _ in range(2*numberOfLevels):
+    controller.addCycle(120)
+    levels.append(controller.level)
+  assert levels == [0, 1, 1, 2, 2, 3, 3, 4]
+  assert controller.apply(True, 40, 'Full') == (False, 28, 'ROI', sum(SimpleNeedleTrackingLib.DEGRADATION_NAMES))
+  assert controller.skipInterval == 3
+
+  # Frames every 50 ms: one out of three is tracked
+  skipped = [controller.skipFrame(0.05*index) for index in range(9)]
+  assert skipped == [False, True, True]*3
+  assert controller.skippedCount == 6
+
+  # Cycles back under budget: tracked frames become more frequent, then the levels are undone
+  for index in range(9, 200):
+    if not controller.skipFrame(0.05*index):
+      controller.addCycle(10)
+    if controller.level == 0:
+      break
+  assert controller.level == 0
+  assert controller.apply(True, 40, 'Full') == (True, 40, 'Full', 0)
+
+# The skip interval grows while the cycles take longer than the time between tracked frames
+def test_frameBudgetSkipThroughput():
+  controller = SimpleNeedleTrackingLib.FrameBudgetController(budget=50, smoothing=1.0, holdCycles=1)
+  timestamp = 0.0
+  for _ in range(100):
+    timestamp += 0.05
+    if not controller.skipFrame(timestamp):
+      controller.addCycle(180)
+  assert controller.level == len(SimpleNeedleTrackingLib.DEGRADATION_NAMES)
+  assert controller.skipInterval == 4
+
+
+################################################################################################################################################
+# Latest-frame scheduler
+################################################################################################################################################
+
+# Frames submitted while one is processed replace each other: only the newest is processed, the others are dropped
+def test_latestFrameSchedulerDrops():
+  started = threading.Event()
+  release = threading.Event()
+  def process(frame):
+    started.set()
+    release.wait(5)
+    return frame
+  scheduler = SimpleNeedleTrackingLib.LatestFrameScheduler(process)
+  scheduler.start()
+  try:
+    scheduler.submit(1)
+    assert started.wait(5)
+    for frame in (2, 3, 4):
+      scheduler.submit(frame)
+    release.set()
+    deadline = time.time() + 5
+    while scheduler.isBusy() and (time.time() < deadline):
+      time.sleep(0.01)
+  finally:
+    scheduler.stop()
+  assert [frame for (frame, _) in scheduler.popResults()] == [1, 4]
+  assert (scheduler.processedCount, scheduler.droppedCount, scheduler.failedCount) == (2, 2, 0)
+
+
+################################################################################################################################################
+# Tip prediction and plane fusion
+################################################################################################################################################
+
+# A tip moving at constant velocity is extrapolated, and the ROI shrinks while the track is stable
+def test_tipPredictorConstantVelocity():
+  predictor = SimpleNeedleTrackingLib.TipPredictor(measurementNoise=0.1)
+  velocity = np.array((1.0, 0.0, 5.0))
+  assert not predictor.isInitialized()
+  for timestamp in np.arange(0.0, 2.0, 0.1):
+    predictor.update(tuple(velocity*timestamp), timestamp)
+  assert predictor.isInitialized(2.0)
+  assert predictor.predict(2.5) == pytest.approx(tuple(velocity*2.5), abs=0.2)
+  assert predictor.getROISize(2.0, 40, 1.0) < 40
+  # Track dropped after the timeout
+  assert not predictor.isInitialized(1.9 + predictor.timeout + 0.1)
+
+# Single-slice planes constrain the tip in their own plane; the other direction keeps the prediction
+def test_fusePlaneTips():
+  axial = ((1.0, 2.0, 99.0), (0.0, 0.0, 1.0))
+  sagittal = ((99.0, 2.0, 3.0), (1.0, 0.0, 0.0))
+  assert SimpleNeedleTrackingLib.fusePlaneTips([axial, sagittal], (0.0, 0.0, 0.0)) == pytest.approx((1.0, 2.0, 3.0), abs=1e-4)
+  assert SimpleNeedleTrackingLib.fusePlaneTips([axial], (0.0, 0.0, 5.0)) == pytest.approx((1.0, 2.0, 5.0), abs=1e-4)
+  # Multi-slice planes constrain all coordinates
+  assert SimpleNeedleTrackingLib.fusePlaneTips([((1.0, 2.0, 3.0), None)], (0.0, 0.0, 0.0)) == pytest.approx((1.0, 2.0, 3.0), abs=1e-4)